@@ -0,0 +1,363 @@
+"""Micro-benchmarks for the pixel editor's hot paths
+
+Run the suite and store the results as JSON:
+
+    python benchmark.py run -o results.json
+
+Compare two runs and flag slowdowns beyond a threshold (exit status 1 if any):
+
+    python benchmark.py compare baseline.json results.json --threshold 0.1
+
+Measure how a large conversion scales with worker processes:
+
+    python benchmark.py scaling --source 8192x8192 --size 4096x4096 --workers 2,4,8
+
+Paths that need Tk are run under a virtual framebuffer. If no display is
+available, Xvfb is started for the duration of the run; if it is not
+installed, those benchmarks are skipped and only the headless paths run.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import pixel_editor
+from color_reduction import QUANTIZERS, reduce_colors
+
+DEFAULT_SIZES = "32x32,128x128,320x240,640x480"
+
+
+class QuietMessageBox:
+    """Stand-in for tkinter.messagebox so dialogs never block a benchmark"""
+
+    @staticmethod
+    def showinfo(*args, **kwargs):
+        return "ok"
+
+    @staticmethod
+    def showerror(*args, **kwargs):
+        return "ok"
+
+    @staticmethod
+    def askyesno(*args, **kwargs):
+        return True
+
+
+def parse_sizes(text):
+    """Parse "WxH,WxH" into a list of (width, height) tuples"""
+    sizes = []
+    for item in text.split(","):
+        width, height = item.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def synthetic_image(width, height, seed=0):
+    """Make a reproducible test image with flat regions, edges and noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = (x * 255) // max(1, width - 1)
+    pixels[..., 1] = (y * 255) // max(1, height - 1)
+    pixels[..., 2] = ((x // 8 + y // 8) % 2) * 255
+    noise = rng.random((height, width)) < 0.05
+    pixels[noise] = rng.integers(0, 256, (int(noise.sum()), 3), dtype=np.uint8)
+    return pixels
+
+
+def time_call(func, setup=None, repeat=3):
+    """Time func() repeat times, running setup() untimed before each call"""
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {"best": min(runs), "median": statistics.median(runs), "runs": runs}
+
+
+def start_virtual_display():
+    """Start Xvfb if there is no display, returning the process (or None)"""
+    if os.environ.get("DISPLAY"):
+        return None
+    if not shutil.which("Xvfb"):
+        return None
+
+    display = ":99"
+    process = subprocess.Popen(["Xvfb", display, "-screen", "0", "1920x1080x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    os.environ["DISPLAY"] = display
+    return process
+
+
+def headless_benchmarks(sizes, repeat):
+    """Benchmark the paths that do not need a Tk display"""
+    results = {}
+    settings = {
+        "var_name": "bench", "format": "Array", "rotation": 0, "mirror_h": False, "mirror_v": False,
+        "scan": "row", "tile_size": (8, 8), "bits": 4, "key565": None,
+    }
+
+    for width, height in sizes:
+        label = f"{width}x{height}"
+        pixels = synthetic_image(width, height)
+        source = Image.fromarray(synthetic_image(width * 4, height * 4, seed=1))
+
+        results[f"rgb888_to_rgb565@{label}"] = time_call(lambda: pixel_editor.rgb888_to_rgb565(pixels),
+                                                         repeat=repeat)
+        results[f"export_source@{label}"] = time_call(
+            lambda: "".join(pixel_editor.iter_export_source(pixels, settings)), repeat=repeat)
+        for method in pixel_editor.DOWNSCALERS:
+            name = "convert_frame" if method == "Lanczos" else f"convert_frame[{method}]"
+            results[f"{name}@{label}"] = time_call(
+                lambda: pixel_editor.convert_frame(source, width, height, method=method), repeat=repeat)
+        for quantizer in QUANTIZERS:
+            results[f"reduce_colors[{quantizer}]@{label}"] = time_call(
+                lambda: reduce_colors(pixels, 16, quantizer), repeat=repeat)
+
+        # Three layers: a full re-blend, then the single-pixel dirty update a pen stroke causes
+        stack = pixel_editor.LayerStack()
+        for index in (1, 2):
+            overlay = synthetic_image(width, height, seed=index + 1)
+            stack.layers.append(pixel_editor.Layer(f"Layer {index}", overlay, opacity=0.5,
+                                                   key=tuple(int(v) for v in overlay[0, 0])))
+        results[f"composite_full@{label}"] = time_call(lambda: stack.composite(pixels), setup=stack.invalidate,
+                                                       repeat=repeat)
+        results[f"composite_dirty@{label}"] = time_call(lambda: stack.composite(pixels),
+                                                        setup=lambda: stack.mark_dirty(0, 0, 1, 1), repeat=repeat)
+
+    return results
+
+
+def tk_benchmarks(sizes, repeat):
+    """Benchmark the PixelEditorApp methods, including Tk rendering time"""
+    import tkinter as tk
+
+    pixel_editor.messagebox = QuietMessageBox
+    root = tk.Tk()
+    root.geometry("1280x720")
+    app = pixel_editor.PixelEditorApp(root, recover=False)
+    root.update()
+    results = {}
+
+    def timed(method):
+        # Include the time Tk needs to process the resulting redraw
+        def run():
+            method()
+            root.update()
+        return run
+
+    try:
+        for width, height in sizes:
+            label = f"{width}x{height}"
+            pixels = synthetic_image(width, height)
+            app.max_width = max(app.max_width, width)
+            app.max_height = max(app.max_height, height)
+
+            def load(data=pixels, width=width, height=height):
+                app.width_var.set(str(width))
+                app.height_var.set(str(height))
+                app.new_image()
+                app.pixel_data[...] = data
+                app.edited_image = Image.fromarray(app.pixel_data)
+
+            def load_blank(width=width, height=height):
+                app.width_var.set(str(width))
+                app.height_var.set(str(height))
+                app.new_image()
+                app.current_color = "#123456"
+
+            load()
+            results[f"draw_editor@{label}"] = time_call(timed(app.draw_editor), repeat=repeat)
+            results[f"generate_c_array@{label}"] = time_call(timed(app.generate_c_array), repeat=repeat)
+            results[f"show_c_array@{label}"] = time_call(timed(app.show_c_array), repeat=repeat)
+
+            # Flood fill across a uniform image is the worst case
+            results[f"fill_area@{label}"] = time_call(timed(lambda: app.fill_area(0, 0)), setup=load_blank,
+                                                      repeat=repeat)
+
+            source_text = "".join(pixel_editor.iter_c_array_source(pixel_editor.rgb888_to_rgb565(pixels), "bench"))
+            results[f"parse_c_array@{label}"] = time_call(
+                timed(lambda: app.parse_c_array(source_text, width, height)), repeat=repeat)
+
+            app.reference_image = Image.fromarray(synthetic_image(width * 4, height * 4, seed=1))
+            results[f"do_import@{label}"] = time_call(timed(lambda: app.do_import(width, height)), repeat=repeat)
+    finally:
+        root.destroy()
+
+    return results
+
+
+def run(args):
+    sizes = parse_sizes(args.sizes)
+    results = headless_benchmarks(sizes, args.repeat)
+
+    display_process = None
+    if not args.headless:
+        display_process = start_virtual_display()
+        if os.environ.get("DISPLAY"):
+            try:
+                results.update(tk_benchmarks(sizes, args.repeat))
+            finally:
+                if display_process:
+                    display_process.terminate()
+        else:
+            print("No display and Xvfb not found; skipping Tk benchmarks", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    for name, result in sorted(results.items()):
+        print(f"{name:40s} {result['best'] * 1000:10.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    slowdowns = 0
+    for name in sorted(set(baseline) & set(current)):
+        before = baseline[name]["best"]
+        after = current[name]["best"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1.0 + args.threshold:
+            flag = "SLOWER"
+            slowdowns += 1
+        elif ratio < 1.0 - args.threshold:
+            flag = "faster"
+        print(f"{name:40s} {before * 1000:10.2f} ms {after * 1000:10.2f} ms {ratio:7.2f}x {flag}")
+
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"{name:40s} only in {'baseline' if name in baseline else 'current'}")
+
+    if slowdowns:
+        print(f"{slowdowns} benchmark(s) slowed down by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+def default_worker_counts():
+    """Powers of two up to the CPU count, plus the CPU count itself"""
+    cpus = os.cpu_count() or 1
+    counts = {cpus} if cpus > 1 else {2}
+    count = 2
+    while count < cpus:
+        counts.add(count)
+        count *= 2
+    return ",".join(str(count) for count in sorted(counts))
+
+
+def scaling(args):
+    """Time a large resize, reduce, pack and emit serially and with each worker count"""
+    from parallel_convert import ParallelConverter
+
+    (source_width, source_height), = parse_sizes(args.source)
+    (width, height), = parse_sizes(args.size)
+    source = Image.fromarray(synthetic_image(source_width, source_height, seed=1))
+    settings = {
+        "var_name": "bench", "format": "Array", "rotation": 0, "mirror_h": False, "mirror_v": False,
+        "scan": "row", "tile_size": (8, 8), "bits": 4, "key565": None,
+    }
+
+    def convert(converter=None):
+        if converter is None:
+            pixels = pixel_editor.convert_frame(source, width, height, args.dither, method=args.method)
+            return "".join(pixel_editor.iter_export_source(pixels, settings))
+        pixels = converter.convert_frame(source, width, height, args.dither, method=args.method)
+        return "".join(converter.iter_export_source(pixels, settings))
+
+    expected = convert()
+    results = {"serial": time_call(convert, repeat=args.repeat)}
+    serial = results["serial"]["best"]
+    print(f"{'workers':>8s} {'best':>12s} {'speedup':>8s}")
+    print(f"{'serial':>8s} {serial * 1000:9.0f} ms {1.0:7.2f}x")
+    for workers in (int(n) for n in args.workers.split(",")):
+        converter = ParallelConverter(workers, min_pixels=0)
+        try:
+            # The first run also starts the workers, so it is not timed
+            if convert(converter) != expected:
+                print(f"Output with {workers} workers differs from the serial path", file=sys.stderr)
+                return 1
+            result = time_call(lambda: convert(converter), repeat=args.repeat)
+        finally:
+            converter.shutdown()
+        results[f"workers={workers}"] = result
+        print(f"{workers:8d} {result['best'] * 1000:9.0f} ms {serial / result['best']:7.2f}x")
+
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "cpus": os.cpu_count(),
+                "source": args.source, "size": args.size, "method": args.method, "dither": args.dither,
+            },
+            "results": results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pixel editor micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark suite")
+    run_parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Image sizes (default: {DEFAULT_SIZES})")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark (default: 3)")
+    run_parser.add_argument("--headless", action="store_true", help="Skip the benchmarks that need Tk")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Relative slowdown to flag (default: 0.1)")
+    compare_parser.set_defaults(func=compare)
+
+    scaling_parser = subparsers.add_parser("scaling", help="Measure parallel conversion speedup by worker count")
+    scaling_parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    scaling_parser.add_argument("--source", default="6000x4000", help="Source image size (default: 6000x4000)")
+    scaling_parser.add_argument("--size", default="3000x2000", help="Converted size (default: 3000x2000)")
+    scaling_parser.add_argument("--method", default="Lanczos", choices=pixel_editor.DOWNSCALERS)
+    scaling_parser.add_argument("--dither", action="store_true", help="Include color reduction")
+    scaling_parser.add_argument("--workers", default=default_worker_counts(),
+                                help="Comma-separated worker counts (default: powers of two up to the CPU count)")
+    scaling_parser.add_argument("--repeat", type=int, default=3, help="Runs per configuration (default: 3)")
+    scaling_parser.set_defaults(func=scaling)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Color reduction to a palette of any size with median-cut or mini-batch k-means
+
+Both quantizers work on the histogram of distinct RGB565 colors rather than
+on raw pixels. An image can hold at most 65,536 such colors whatever its
+size, so the clustering cost does not grow with the pixel count; only the
+final table lookup touches every pixel.
+"""
+import numpy as np
+
+from palette_lut import rgb565_table
+
+QUANTIZERS = ("Median Cut", "K-Means")
+
+
+def pack_rgb565(pixels):
+    rgb = pixels.astype(np.uint32)
+    return ((((rgb[..., 0] * 31) // 255) << 11) | (((rgb[..., 1] * 63) // 255) << 5)
+            | ((rgb[..., 2] * 31) // 255)).astype(np.uint16)
+
+
+def rgb888_codes(pixels):
+    rgb = pixels.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def distinct_codes(pixels):
+    """Return the sorted 24-bit codes of the distinct colors of an (..., 3) array"""
+    return np.unique(rgb888_codes(pixels).ravel())
+
+
+def code_colors(codes):
+    return np.stack([codes >> 16, (codes >> 8) & 0xFF, codes & 0xFF], axis=1).astype(np.uint8)
+
+
+def rgb565_histogram(vga_array):
+    """Return (values, counts) for the distinct colors of an RGB565 array"""
+    counts = np.bincount(np.ravel(vga_array), minlength=65536)
+    values = np.flatnonzero(counts)
+    return values.astype(np.uint16), counts[values]
+
+
+def weighted_sse(colors, weights):
+    """Return the weighted squared error of a box around its mean, per channel"""
+    mean = np.average(colors, axis=0, weights=weights)
+    return (weights[:, None] * (colors - mean) ** 2).sum(axis=0)
+
+
+def median_cut(colors, weights, count):
+    """Split the color histogram into at most count boxes and return their weighted means
+
+    The box with the largest weighted variance is split at the weighted
+    median of its widest channel until there are count boxes or no box
+    holds more than one color.
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    boxes = [np.arange(len(colors))]
+    errors = [weighted_sse(colors, weights)]
+    while len(boxes) < count:
+        box = int(np.argmax([error.sum() for error in errors]))
+        if errors[box].sum() == 0:
+            break
+        members = boxes[box]
+        channel = int(np.argmax(errors[box]))
+        members = members[np.argsort(colors[members, channel], kind="stable")]
+        cumulative = np.cumsum(weights[members])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(members) - 1)
+        # Keep equal channel values on one side so the halves do not overlap
+        values = colors[members, channel]
+        if values[split] == values[split - 1]:
+            lower = int(np.searchsorted(values, values[split], side="left"))
+            split = lower if lower > 0 else int(np.searchsorted(values, values[split], side="right"))
+        halves = members[:split], members[split:]
+        boxes[box:box + 1] = halves
+        errors[box:box + 1] = [weighted_sse(colors[half], weights[half]) for half in halves]
+    return np.array([np.average(colors[box], axis=0, weights=weights[box]) for box in boxes])
+
+
+def nearest(points, centers, chunk=8192):
+    """Return the index of the nearest center for each point"""
+    points = np.asarray(points, dtype=np.float32)
+    centers = np.asarray(centers, dtype=np.float32)
+    center_norms = (centers * centers).sum(axis=1)
+    result = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk):
+        block = points[start:start + chunk]
+        # |p - c|^2 without the |p|^2 term, which does not change the argmin
+        result[start:start + chunk] = (center_norms - 2 * block @ centers.T).argmin(axis=1)
+    return result
+
+
+def kmeans(colors, weights, count, iterations=100, batch_size=2048, seed=0):
+    """Cluster the color histogram with mini-batch k-means seeded by median cut
+
+    Each iteration samples a batch of colors in proportion to their pixel
+    counts and moves every center toward the mean of its share of the
+    batch, with a step that shrinks as the center accumulates samples.
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    centers = median_cut(colors, weights, count)
+    if len(centers) < count:
+        return centers
+
+    rng = np.random.default_rng(seed)
+    probabilities = weights / weights.sum()
+    seen = np.zeros(len(centers))
+    for _ in range(iterations):
+        batch = colors[rng.choice(len(colors), batch_size, p=probabilities)]
+        labels = nearest(batch, centers)
+        hits = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, batch[:, channel], len(centers)) for channel in range(3)], axis=1)
+        hit = hits > 0
+        seen[hit] += hits[hit]
+        rate = (hits[hit] / seen[hit])[:, None]
+        centers[hit] += rate * (sums[hit] / hits[hit][:, None] - centers[hit])
+    return centers
+
+
+def choose_palette(values, weights, count, method="Median Cut"):
+    """Pick at most count colors for a histogram of RGB565 values; returns an (n, 3) uint8 array"""
+    if method not in QUANTIZERS:
+        raise ValueError(f"Unknown quantizer: {method}")
+    table = rgb565_table()
+    if len(values) <= count:
+        return table[values]
+    quantize = median_cut if method == "Median Cut" else kmeans
+    return np.clip(np.rint(quantize(table[values], weights, count)), 0, 255).astype(np.uint8)
+
+
+def palette_lookup(values, palette):
+    """Return a 65,536-entry table mapping each of the RGB565 values to its nearest palette index"""
+    lut = np.zeros(65536, dtype=np.uint8)
+    lut[values] = nearest(rgb565_table()[values], palette)
+    return lut
+
+
+def reduce_colors(pixels, count, method="Median Cut", mask=None):
+    """Reduce an (h, w, 3) image to at most count colors
+
+    Only pixels under mask (all pixels by default) shape the palette, but
+    every pixel is mapped. Returns (palette, indices) where palette is an
+    (n, 3) uint8 array and palette[indices] is the reduced image.
+    """
+    count = min(256, max(1, int(count)))
+    vga_array = pack_rgb565(pixels)
+    masked = mask is not None and mask.any()
+    values, weights = rgb565_histogram(vga_array[mask] if masked else vga_array)
+    if len(values) <= count:
+        # There may be no reduction to do, and then the exact colors are kept
+        codes = distinct_codes(pixels[mask] if masked else pixels)
+        if len(codes) <= count:
+            palette = code_colors(codes)
+            all_codes = rgb888_codes(pixels)
+            indices = np.minimum(np.searchsorted(codes, all_codes), len(codes) - 1)
+            missing = codes[indices] != all_codes
+            if missing.any():
+                indices[missing] = nearest(pixels[missing], palette)
+            return palette, indices.astype(np.uint8)
+    palette = choose_palette(values, weights, count, method)
+    present = np.flatnonzero(np.bincount(vga_array.ravel(), minlength=65536))
+    return palette, palette_lookup(present, palette)[vga_array]
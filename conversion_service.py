@@ -0,0 +1,362 @@
+"""Local image conversion service for build systems
+
+Run a long-lived service so each asset conversion does not pay the Python,
+NumPy and PIL start-up cost:
+
+    python conversion_service.py serve [--port 8765] [--workers 4]
+
+Convert through it with the thin client, which takes the same options as
+the editor's import and export settings:
+
+    python conversion_service.py convert sprite.png -o sprite.h --size 64x64 --format RLE
+
+The client itself only imports the standard library. If no service is
+running it converts in-process instead, so Makefile rules work either way. Service throughput and queue metrics:
+
+    python conversion_service.py stats
+
+The service listens on localhost only. POST /convert takes a JSON job
+({"image": base64 bytes, "options": {...}}) and returns the C source, or
+with "output": "binary" the raw little-endian RGB565 pixels in export scan
+order. GET /metrics returns the counters as JSON.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from file_modes import replacement_mode
+
+DEFAULT_PORT = 8765
+
+# Job options and their defaults; they mirror do_import and export_settings
+DEFAULT_OPTIONS = {
+    "width": None,  # Defaults to the source size
+    "height": None,
+    "dither": False,
+    "method": "Lanczos",
+    "colors": 16,
+    "quantizer": "Median Cut",
+    "transparent_color": None,
+    "alpha_threshold": 128,
+    "var_name": "pixel_data",
+    "format": "Array",
+    "rotation": 0,
+    "mirror_h": False,
+    "mirror_v": False,
+    "scan": "row",
+    "tile_size": [8, 8],
+    "bits": 4,
+    "mip_levels": 0,
+    "output": "source",
+}
+
+
+def warm_up():
+    """Pay the import cost once per worker process"""
+    import pixel_editor  # noqa: F401
+
+
+def convert(image_bytes, options):
+    """Convert an encoded image; returns (content type, body bytes, seconds spent)"""
+    import numpy as np
+    from PIL import Image
+
+    import pixel_editor
+    from color_reduction import QUANTIZERS
+
+    start = time.perf_counter()
+    options = dict(DEFAULT_OPTIONS, **options)
+    # Reject typos up front; a build must fail rather than emit some other format
+    for name, choices in (("format", pixel_editor.EXPORT_FORMATS), ("method", pixel_editor.DOWNSCALERS),
+                          ("quantizer", QUANTIZERS)):
+        if options[name] not in choices:
+            raise ValueError(f"Unknown {name} {options[name]!r} (choose from {', '.join(choices)})")
+    img = Image.open(io.BytesIO(image_bytes))
+    width = int(options["width"] or img.width)
+    height = int(options["height"] or img.height)
+
+    key = pixel_editor.hex_to_rgb(options["transparent_color"]) if options["transparent_color"] else None
+    pixels = pixel_editor.convert_frame(img, width, height, options["dither"], key,
+                                        int(options["alpha_threshold"]), options["method"],
+                                        int(options["colors"]), options["quantizer"])
+
+    settings = {name: options[name] for name in ("var_name", "format", "rotation", "mirror_h", "mirror_v",
+                                                 "scan", "bits", "mip_levels")}
+    settings["tile_size"] = tuple(options["tile_size"])
+    settings["key565"] = int(pixel_editor.rgb888_to_rgb565(np.array(key, dtype=np.uint8))) if key else None
+
+    if options["output"] == "binary":
+        vga = pixel_editor.rgb888_to_rgb565(pixels)
+        if settings["scan"] == "tile":
+            view = pixel_editor.tile_array(pixel_editor.orient_array(vga, settings["rotation"], settings["mirror_h"],
+                                                                     settings["mirror_v"]),
+                                           *settings["tile_size"])
+        else:
+            view = pixel_editor.scan_view(vga, settings["rotation"], settings["mirror_h"], settings["mirror_v"],
+                                          settings["scan"])
+        body = np.ascontiguousarray(view, dtype="<u2").tobytes()
+        content_type = "application/octet-stream"
+    else:
+        body = "".join(pixel_editor.iter_export_source(pixels, settings)).encode("utf-8")
+        content_type = "text/plain; charset=utf-8"
+    return content_type, body, time.perf_counter() - start
+
+
+class Metrics:
+    """Thread-safe job counters for the metrics endpoint"""
+
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.started = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.latency_seconds = 0.0
+        self.recent = deque()  # Completion times within the last minute
+
+    def submit(self):
+        with self.lock:
+            self.submitted += 1
+
+    def finish(self, latency, busy=None):
+        now = time.time()
+        with self.lock:
+            if busy is None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.busy_seconds += busy
+                self.latency_seconds += latency
+                self.recent.append(now)
+            while self.recent and self.recent[0] < now - 60:
+                self.recent.popleft()
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            in_flight = self.submitted - self.completed - self.failed
+            running = min(in_flight, self.workers)
+            return {
+                "uptime": uptime,
+                "workers": self.workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "running": running,
+                "queued": in_flight - running,
+                "throughput_per_s": self.completed / uptime if uptime else 0.0,
+                "recent_throughput_per_s": len(self.recent) / min(60.0, uptime) if uptime else 0.0,
+                "mean_latency_s": self.latency_seconds / self.completed if self.completed else 0.0,
+                "mean_convert_s": self.busy_seconds / self.completed if self.completed else 0.0,
+                # Busy time over available worker time
+                "utilization": self.busy_seconds / (uptime * self.workers) if uptime else 0.0,
+            }
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """Handle /convert and /metrics; the server carries the pool and metrics"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        self.reply(200, "application/json", json.dumps(self.server.metrics.snapshot()).encode("utf-8"))
+
+    def do_POST(self):
+        if self.path != "/convert":
+            self.send_error(404)
+            return
+        start = time.perf_counter()
+        metrics = self.server.metrics
+        metrics.submit()
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            future = self.server.pool.submit(convert, base64.b64decode(job["image"]), job.get("options", {}))
+            content_type, body, busy = future.result()
+        except Exception as e:
+            metrics.finish(time.perf_counter() - start)
+            self.reply(400, "text/plain; charset=utf-8", f"{type(e).__name__}: {e}".encode("utf-8"))
+            return
+        metrics.finish(time.perf_counter() - start, busy)
+        self.reply(200, content_type, body)
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(args):
+    workers = args.workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+    # Start every worker now so the first jobs do not pay for it
+    for future in [pool.submit(warm_up) for _ in range(workers)]:
+        future.result()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), ConversionHandler)
+    server.pool = pool
+    server.metrics = Metrics(workers)
+    server.verbose = args.verbose
+    print(f"Conversion service on http://127.0.0.1:{args.port} with {workers} worker(s)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+    return 0
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def client_convert(args):
+    options = {
+        "dither": args.dither,
+        "method": args.method,
+        "colors": args.colors,
+        "quantizer": args.quantizer,
+        "transparent_color": args.transparent,
+        "alpha_threshold": args.alpha_threshold,
+        "var_name": args.var_name or os.path.splitext(os.path.basename(args.input))[0],
+        "format": args.format,
+        "rotation": args.rotation,
+        "mirror_h": args.mirror_h,
+        "mirror_v": args.mirror_v,
+        "scan": args.scan,
+        "tile_size": list(parse_size(args.tile_size)),
+        "bits": args.bits,
+        "mip_levels": args.mip_levels,
+        "output": "binary" if args.binary else "source",
+    }
+    if args.size:
+        options["width"], options["height"] = parse_size(args.size)
+
+    with open(args.input, 'rb') as f:
+        image_bytes = f.read()
+
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{args.port}/convert",
+        data=json.dumps({"image": base64.b64encode(image_bytes).decode("ascii"), "options": options}).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        print(f"{args.input}: {e.read().decode('utf-8', 'replace')}", file=sys.stderr)
+        return 1
+    except urllib.error.URLError:
+        if args.no_fallback:
+            print(f"No conversion service on port {args.port}", file=sys.stderr)
+            return 1
+        # No service running; do the work here so builds still succeed
+        try:
+            _, body, _ = convert(image_bytes, options)
+        except Exception as e:
+            print(f"{args.input}: {type(e).__name__}: {e}", file=sys.stderr)
+            return 1
+
+    if not args.output:
+        sys.stdout.buffer.write(body)
+        return 0
+
+    write_atomically(args.output, body)
+    return 0
+
+
+def write_atomically(file_path, data):
+    """Replace a file in one step, so a failed build never leaves a partial output"""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".convert-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, replacement_mode(file_path))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def stats(args):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{args.port}/metrics") as response:
+            metrics = json.loads(response.read())
+    except urllib.error.URLError:
+        print(f"No conversion service on port {args.port}", file=sys.stderr)
+        return 1
+    for name, value in metrics.items():
+        print(f"{name:24s} {value:.3f}" if isinstance(value, float) else f"{name:24s} {value}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local image to C array conversion service")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--port", type=int, default=int(os.environ.get("PIXEL_SERVICE_PORT", DEFAULT_PORT)),
+                        help=f"Service port on localhost (default: $PIXEL_SERVICE_PORT or {DEFAULT_PORT})")
+
+    serve_parser = subparsers.add_parser("serve", parents=[common], help="Run the conversion service")
+    serve_parser.add_argument("--workers", type=int, help="Worker processes (default: CPU count)")
+    serve_parser.add_argument("--verbose", action="store_true", help="Log every request")
+    serve_parser.set_defaults(func=serve)
+
+    convert_parser = subparsers.add_parser("convert", parents=[common], help="Convert an image through the service")
+    convert_parser.add_argument("input")
+    convert_parser.add_argument("-o", "--output", help="Output file (default: standard output)")
+    convert_parser.add_argument("--size", help="Target size as WxH (default: the image size)")
+    convert_parser.add_argument("--method", default="Lanczos", help="Downscaler (default: Lanczos)")
+    convert_parser.add_argument("--dither", action="store_true", help="Reduce the colors before export")
+    convert_parser.add_argument("--colors", type=int, default=16, help="Colors kept by --dither (default: 16)")
+    convert_parser.add_argument("--quantizer", default="Median Cut", help="Median Cut or K-Means (default: Median Cut)")
+    convert_parser.add_argument("--transparent", help="Transparency key color as #RRGGBB")
+    convert_parser.add_argument("--alpha-threshold", type=int, default=128)
+    convert_parser.add_argument("--var-name", help="C variable name (default: the input file name)")
+    convert_parser.add_argument("--format", default="Array", help="Export format (default: Array)")
+    convert_parser.add_argument("--rotation", type=int, default=0, choices=(0, 90, 180, 270))
+    convert_parser.add_argument("--mirror-h", action="store_true")
+    convert_parser.add_argument("--mirror-v", action="store_true")
+    convert_parser.add_argument("--scan", default="row", choices=("row", "column", "tile"))
+    convert_parser.add_argument("--tile-size", default="8x8")
+    convert_parser.add_argument("--bits", type=int, default=4, help="Bits per pixel for Indexed")
+    convert_parser.add_argument("--mip-levels", type=int, default=0,
+                                help="Levels for the Mipmap format (default: down to 1x1)")
+    convert_parser.add_argument("--binary", action="store_true", help="Write raw RGB565 instead of C source")
+    convert_parser.add_argument("--no-fallback", action="store_true",
+                                help="Fail instead of converting in-process when no service is running")
+    convert_parser.set_defaults(func=client_convert)
+
+    stats_parser = subparsers.add_parser("stats", parents=[common], help="Show service throughput and queue metrics")
+    stats_parser.set_defaults(func=stats)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Find data symbols in ELF executables and object files and read their bytes
+
+The file is memory-mapped and only the ELF header, the section headers and
+the symbol tables are parsed, so listing a multi-megabyte firmware image
+touches a few pages. A symbol's contents come back as a zero-copy view of
+the mapping, which lets artwork be recovered from a build when the source
+header is gone:
+
+    python elf_symbols.py list firmware.elf
+    python elf_symbols.py extract firmware.elf splash_image --width 240 -o splash.png
+"""
+import argparse
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+ELF_MAGIC = b"\x7fELF"
+ET_REL = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+STT_OBJECT = 1
+SHN_LORESERVE = 0xFF00
+SHN_XINDEX = 0xFFFF
+
+
+def symbol_dtype(is64, order):
+    """NumPy record layout of an Elf32_Sym or Elf64_Sym entry"""
+    if is64:
+        fields = [("name", "u4"), ("info", "u1"), ("other", "u1"), ("shndx", "u2"), ("value", "u8"), ("size", "u8")]
+    else:
+        fields = [("name", "u4"), ("value", "u4"), ("size", "u4"), ("info", "u1"), ("other", "u1"), ("shndx", "u2")]
+    return np.dtype([(name, order + kind) for name, kind in fields])
+
+
+class Section:
+    def __init__(self, name, kind, address, offset, size, link):
+        self.name = name
+        self.kind = kind
+        self.address = address
+        self.offset = offset
+        self.size = size
+        self.link = link
+
+
+class Symbol:
+    """A sized data object; offset is its position in the file, or None if it has no file data (.bss)"""
+
+    def __init__(self, name, section, size, offset):
+        self.name = name
+        self.section = section
+        self.size = size
+        self.offset = offset
+
+
+class ElfFile:
+    """Read-only, memory-mapped view of an ELF file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError("File is empty") from None
+        try:
+            self.read_headers()
+        except (struct.error, IndexError) as e:
+            self.mm.close()
+            raise ValueError(f"Truncated or corrupt ELF file ({e})") from None
+        except ValueError:
+            self.mm.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+
+    def read_headers(self):
+        mm = self.mm
+        if mm[:4] != ELF_MAGIC:
+            raise ValueError("Not an ELF file")
+        if mm[4] not in (1, 2) or mm[5] not in (1, 2):
+            raise ValueError("Unsupported ELF class or byte order")
+        self.is64 = mm[4] == 2
+        self.order = "<" if mm[5] == 1 else ">"
+
+        if self.is64:
+            header = struct.unpack_from(self.order + "HHIQQQIHHHHHH", mm, 16)
+        else:
+            header = struct.unpack_from(self.order + "HHIIIIIHHHHHH", mm, 16)
+        self.type = header[0]
+        section_offset, entry_size, count, names_index = header[5], header[10], header[11], header[12]
+        if section_offset == 0:
+            raise ValueError("ELF file has no section headers")
+
+        section_format = self.order + ("IIQQQQIIQQ" if self.is64 else "IIIIIIIIII")
+
+        def section_header(index):
+            return struct.unpack_from(section_format, mm, section_offset + index * entry_size)
+
+        # Files with very many sections keep the real counts in section 0
+        if count == 0:
+            count = section_header(0)[5]
+        if names_index == SHN_XINDEX:
+            names_index = section_header(0)[6]
+
+        headers = [section_header(index) for index in range(count)]
+        names = headers[names_index]
+        self.sections = [Section(self.string(names[4], name), kind, address, offset, size, link)
+                         for name, kind, _, address, offset, size, link, *_ in headers]
+
+    def string(self, table_offset, index):
+        start = table_offset + index
+        end = self.mm.find(b"\0", start)
+        return self.mm[start:end if end >= 0 else len(self.mm)].decode("utf-8", "replace")
+
+    def data_symbols(self):
+        """Return every sized data object from the symbol tables, sorted by name and offset
+
+        .symtab is used when present; stripped images fall back to .dynsym.
+        Static objects from different translation units can share a name, so
+        each distinct (name, section, offset) is listed.
+        """
+        tables = [s for s in self.sections if s.kind == SHT_SYMTAB] or [s for s in self.sections
+                                                                       if s.kind == SHT_DYNSYM]
+        dtype = symbol_dtype(self.is64, self.order)
+        symbols = {}
+        for table in tables:
+            if table.link >= len(self.sections) or table.offset + table.size > len(self.mm):
+                raise ValueError(f"Symbol table {table.name} is corrupt")
+            entries = np.frombuffer(self.mm, dtype, table.size // dtype.itemsize, table.offset)
+            keep = (((entries["info"] & 0xF) == STT_OBJECT) & (entries["size"] > 0)
+                    & (entries["shndx"] > 0) & (entries["shndx"] < min(SHN_LORESERVE, len(self.sections))))
+            names_offset = self.sections[table.link].offset
+            for name, value, size, index in zip(entries["name"][keep], entries["value"][keep],
+                                                entries["size"][keep], entries["shndx"][keep]):
+                section = self.sections[index]
+                symbol = Symbol(self.string(names_offset, int(name)), section.name, int(size),
+                                self.file_offset(section, int(value), int(size)))
+                symbols.setdefault((symbol.name, symbol.section, symbol.offset), symbol)
+            del entries  # Release the view so the mapping can be closed
+        return sorted(symbols.values(), key=lambda symbol: (symbol.name, symbol.offset is None, symbol.offset or 0))
+
+    def file_offset(self, section, value, size):
+        """Translate a symbol value to a file offset, or None if its bytes are not in the file"""
+        if section.kind == SHT_NOBITS:
+            return None
+        # Object files give offsets within the section, linked images addresses
+        start = value if self.type == ET_REL else value - section.address
+        if start < 0 or start + size > section.size:
+            return None
+        return section.offset + start
+
+    def symbol_bytes(self, symbol):
+        """Return a symbol's contents as a uint8 view of the mapping; no data is copied"""
+        if symbol.offset is None:
+            raise ValueError(f"{symbol.name} has no data in the file (it lives in {symbol.section})")
+        return np.frombuffer(self.mm, np.uint8, symbol.size, symbol.offset)
+
+    def find(self, name, offset=None):
+        """Return the data symbol called name, or the one at a file offset when several share it"""
+        matches = [symbol for symbol in self.data_symbols()
+                   if symbol.name == name and (offset is None or symbol.offset == offset)]
+        if not matches:
+            raise KeyError(name)
+        if len(matches) > 1:
+            offsets = ", ".join(f"0x{symbol.offset:X}" if symbol.offset is not None else "(no data)"
+                                for symbol in matches)
+            raise ValueError(f"{len(matches)} symbols are named {name}, at file offsets {offsets}")
+        return matches[0]
+
+
+def list_symbols(args):
+    with ElfFile(args.file) as elf:
+        symbols = elf.data_symbols()
+        for symbol in symbols:
+            if args.min_size and symbol.size < args.min_size:
+                continue
+            location = f"0x{symbol.offset:08X}" if symbol.offset is not None else "(no data)"
+            print(f"{symbol.name:40s} {symbol.section:16s} {symbol.size:10d} {location}")
+    return 0
+
+
+def extract(args):
+    from PIL import Image
+
+    import pixel_editor
+
+    with ElfFile(args.file) as elf:
+        try:
+            symbol = elf.find(args.symbol, args.offset)
+        except KeyError:
+            print(f"No data symbol named {args.symbol}", file=sys.stderr)
+            return 1
+        except ValueError as e:
+            print(f"{e}; pick one with --offset", file=sys.stderr)
+            return 1
+        pixels = pixel_editor.decode_raw_pixels(elf.symbol_bytes(symbol), args.width, args.format)
+    Image.fromarray(pixels).save(args.output)
+    print(f"{symbol.name}: {pixels.shape[1]}x{pixels.shape[0]} written to {args.output}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and extract data symbols from ELF files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List sized data symbols")
+    list_parser.add_argument("file")
+    list_parser.add_argument("--min-size", type=int, default=0, help="Hide symbols smaller than this many bytes")
+    list_parser.set_defaults(func=list_symbols)
+
+    extract_parser = subparsers.add_parser("extract", help="Decode a symbol as an image")
+    extract_parser.add_argument("file")
+    extract_parser.add_argument("symbol")
+    extract_parser.add_argument("--width", type=int, required=True)
+    extract_parser.add_argument("--format", default="RGB565", help="Pixel format (default: RGB565)")
+    extract_parser.add_argument("--offset", type=lambda text: int(text, 0),
+                                help="File offset of the symbol, when several share its name")
+    extract_parser.add_argument("-o", "--output", required=True, help="Output image file")
+    extract_parser.set_defaults(func=extract)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""Permissions for files written through a temporary file and a rename
+
+mkstemp creates files readable only by their owner, and os.replace keeps
+that mode, so atomically written outputs need their mode set explicitly.
+The umask can only be read by changing it, which is not safe once other
+threads may be creating files, so it is read once when this module is
+first imported.
+"""
+import os
+
+
+def read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = read_umask()
+
+
+def replacement_mode(path):
+    """Return the mode for a file about to replace path
+
+    An existing file keeps its mode; a new one gets the permissions a plain
+    open() would give it.
+    """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
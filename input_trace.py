@@ -0,0 +1,272 @@
+"""Record and replay editor input for end-to-end latency testing
+
+Recording is started from the editor's Tools menu. A trace is a JSON-lines
+file: the first line holds the starting document, and each later line is
+one input event with its time offset in seconds.
+
+Replay a trace and report per-event handler latency:
+
+    python input_trace.py replay session.jsonl [--realtime] [-o stats.json]
+
+Replay needs a display; like the benchmarks, Xvfb is started if there is
+none.
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+TRACE_VERSION = 1
+
+# Menu commands that run without opening a dialog, so they are safe to replay
+REPLAYABLE_COMMANDS = {
+    "New", "Clear All", "Zoom In", "Zoom Out", "Reset Zoom", "Show Grid",
+    "Previous Frame", "Next Frame", "Set Transparent Color", "Clear Transparent Color",
+    "Select All", "Deselect", "Copy", "Cut", "Paste", "Delete Selection",
+    "Flip Horizontal", "Flip Vertical", "Rotate 90° Clockwise",
+}
+
+
+class TraceRecorder:
+    """Capture canvas, wheel, palette and menu input from a PixelEditorApp"""
+
+    def __init__(self, app):
+        self.app = app
+        self.events = []
+        self.header = None
+        self.start_time = None
+        self.bindings = []
+        self.var_traces = []
+
+    def start(self):
+        app = self.app
+        self.start_time = time.perf_counter()
+        self.header = {
+            "version": TRACE_VERSION,
+            "width": app.editor_width,
+            "height": app.editor_height,
+            "zoom": app.editor_zoom,
+            "tool": app.tool_var.get(),
+            "color": app.current_color,
+            "grid": app.show_grid_var.get(),
+            "pixels": base64.b64encode(np.ascontiguousarray(app.pixel_data, dtype=np.uint8).tobytes()).decode("ascii"),
+        }
+
+        # Editor canvas events are stored in canvas coordinates so scrolling does not matter on replay
+        self.bind(app.canvas, "<Button-1>", lambda e: self.record_pointer("canvas_click", e, app.canvas))
+        self.bind(app.canvas, "<B1-Motion>", lambda e: self.record_pointer("canvas_drag", e, app.canvas))
+        self.bind(app.canvas, "<ButtonRelease-1>", lambda e: self.record_pointer("canvas_release", e, app.canvas))
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.bind(app.canvas, sequence, self.record_wheel)
+        self.bind(app.palette_canvas, "<Button-1>", lambda e: self.record_pointer("palette_click", e))
+        self.bind(app.reference_canvas, "<Button-1>", lambda e: self.record_pointer("reference_click", e))
+
+        self.var_traces.append((app.tool_var, app.tool_var.trace_add(
+            "write", lambda *args: self.record("tool", value=app.tool_var.get()))))
+        self.var_traces.append((app.show_grid_var, app.show_grid_var.trace_add(
+            "write", lambda *args: self.record("grid", value=app.show_grid_var.get()))))
+
+    def stop(self):
+        for widget, sequence, funcid in self.bindings:
+            # Removing one function from a binding means rewriting the binding script
+            script = widget.bind(sequence)
+            widget.bind(sequence, "\n".join(line for line in script.split("\n") if funcid not in line))
+            widget.deletecommand(funcid)
+        self.bindings = []
+        for var, name in self.var_traces:
+            var.trace_remove("write", name)
+        self.var_traces = []
+
+    def bind(self, widget, sequence, callback):
+        funcid = widget.bind(sequence, callback, add="+")
+        self.bindings.append((widget, sequence, funcid))
+
+    def record(self, kind, **fields):
+        fields["t"] = time.perf_counter() - self.start_time
+        fields["kind"] = kind
+        self.events.append(fields)
+
+    def record_pointer(self, kind, event, canvas=None):
+        x, y = event.x, event.y
+        if canvas is not None:
+            x, y = canvas.canvasx(x), canvas.canvasy(y)
+        # The color in use decides what a pen stroke paints, even if it came from a dialog
+        self.record(kind, x=x, y=y, color=self.app.current_color)
+
+    def record_wheel(self, event):
+        self.record("wheel", num=event.num, delta=getattr(event, "delta", 0))
+
+    def record_command(self, label):
+        self.record("command", label=label)
+
+    def save(self, file_path):
+        with open(file_path, 'w') as f:
+            f.write(json.dumps(self.header) + "\n")
+            for event in self.events:
+                f.write(json.dumps(event) + "\n")
+
+
+def load_trace(file_path):
+    """Read a trace file into (header, events)"""
+    with open(file_path) as f:
+        header = json.loads(f.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError(f"Unsupported trace version {header.get('version')}")
+        events = [json.loads(line) for line in f if line.strip()]
+    return header, events
+
+
+def restore_document(app, header):
+    """Put the editor back into the state the trace started from"""
+    width, height = header["width"], header["height"]
+    app.max_width = max(app.max_width, width)
+    app.max_height = max(app.max_height, height)
+    app.width_var.set(str(width))
+    app.height_var.set(str(height))
+    app.new_image()
+
+    pixels = np.frombuffer(base64.b64decode(header["pixels"]), dtype=np.uint8)
+    app.pixel_data[...] = pixels.reshape(height, width, 3)
+    app.edited_image = Image.fromarray(app.pixel_data)
+    app.update_preview()
+    app.current_color = header["color"]
+    app.tool_var.set(header["tool"])
+    app.show_grid_var.set(header["grid"])
+    app.set_zoom(header["zoom"])
+    app.canvas.xview_moveto(0)
+    app.canvas.yview_moveto(0)
+
+
+def dispatch(app, event):
+    """Feed one trace event to the matching PixelEditorApp handler
+
+    Returns False if the event was skipped.
+    """
+    kind = event["kind"]
+    if "color" in event:
+        app.current_color = event["color"]
+    tk_event = SimpleNamespace(x=event.get("x", 0), y=event.get("y", 0), num=event.get("num", 0),
+                               delta=event.get("delta", 0))
+
+    if kind == "canvas_click":
+        app.on_canvas_click(tk_event)
+    elif kind == "canvas_drag":
+        app.on_canvas_drag(tk_event)
+    elif kind == "canvas_release":
+        app.on_canvas_release(tk_event)
+    elif kind == "wheel":
+        app.on_mouse_wheel(tk_event)
+    elif kind == "palette_click":
+        app.on_palette_click(tk_event)
+    elif kind == "reference_click":
+        app.on_reference_click(tk_event)
+    elif kind == "tool":
+        app.tool_var.set(event["value"])
+    elif kind == "grid":
+        app.show_grid_var.set(event["value"])
+        app.toggle_grid()
+    elif kind == "command" and event["label"] in REPLAYABLE_COMMANDS:
+        app.menu_commands[event["label"]]()
+    else:
+        return False
+    return True
+
+
+def replay_trace(app, events, realtime=False):
+    """Replay events into an app, timing each handler including Tk's redraw
+
+    With realtime=True the recorded gaps between events are kept. Returns a
+    dict of per-kind latency statistics (in seconds) and the total wall time.
+    """
+    root = app.root
+    latencies = {}
+    skipped = 0
+    start = time.perf_counter()
+
+    for event in events:
+        if realtime:
+            delay = event["t"] - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        begin = time.perf_counter()
+        handled = dispatch(app, event)
+        root.update()
+        elapsed = time.perf_counter() - begin
+
+        if handled:
+            latencies.setdefault(event["kind"], []).append(elapsed)
+        else:
+            skipped += 1
+
+    wall_time = time.perf_counter() - start
+    stats = {}
+    for kind, values in latencies.items():
+        ordered = sorted(values)
+        stats[kind] = {
+            "count": len(values),
+            "mean": statistics.mean(values),
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1],
+            "total": sum(values),
+        }
+    return {"events": stats, "skipped": skipped, "wall_time": wall_time}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded pixel editor input traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a trace and report handler latency")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--realtime", action="store_true", help="Keep the recorded timing between events")
+    replay_parser.add_argument("-o", "--output", help="Write the statistics to this JSON file")
+
+    args = parser.parse_args(argv)
+
+    import tkinter as tk
+    import benchmark
+    import pixel_editor
+
+    header, events = load_trace(args.trace)
+
+    display_process = benchmark.start_virtual_display()
+    if not os.environ.get("DISPLAY"):
+        print("No display and Xvfb not found; cannot replay", file=sys.stderr)
+        return 1
+
+    pixel_editor.messagebox = benchmark.QuietMessageBox
+    root = tk.Tk()
+    root.geometry("1280x720")
+    try:
+        app = pixel_editor.PixelEditorApp(root, recover=False)
+        root.update()
+        restore_document(app, header)
+        root.update()
+        result = replay_trace(app, events, args.realtime)
+    finally:
+        root.destroy()
+        if display_process:
+            display_process.terminate()
+
+    for kind, stats in sorted(result["events"].items()):
+        print(f"{kind:16s} n={stats['count']:5d}  mean {stats['mean'] * 1000:8.2f} ms  "
+              f"p95 {stats['p95'] * 1000:8.2f} ms  max {stats['max'] * 1000:8.2f} ms")
+    print(f"{result['skipped']} event(s) skipped, wall time {result['wall_time']:.3f} s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
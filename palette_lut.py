@@ -0,0 +1,112 @@
+"""RGB565 to palette index lookup tables for snapping colors to a fixed palette
+
+Every RGB565 value is matched to its perceptually nearest palette entry
+once, giving a 65,536-entry table. Snapping an image is then a single
+array-indexing step. Tables are cached in memory and on disk, keyed by a
+hash of the palette, so a palette only ever has to be matched once.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pixel_editor", "lut")
+
+
+def palette_array(colors):
+    """Turn "#RRGGBB" strings into an (n, 3) uint8 array"""
+    return np.array([[int(color.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4)] for color in colors],
+                    dtype=np.uint8).reshape(-1, 3)
+
+
+def palette_hash(palette):
+    return hashlib.blake2b(np.ascontiguousarray(palette, dtype=np.uint8).tobytes(), digest_size=16).hexdigest()
+
+
+def rgb565_table():
+    """Return the RGB888 color of every RGB565 value as a (65536, 3) array"""
+    v = np.arange(65536, dtype=np.uint32)
+    r8 = (((v >> 11) & 0x1F) * 255) // 31
+    g8 = (((v >> 5) & 0x3F) * 255) // 63
+    b8 = ((v & 0x1F) * 255) // 31
+    return np.stack([r8, g8, b8], axis=-1).astype(np.uint8)
+
+
+def build_lut(palette):
+    """Map every RGB565 value to its nearest palette index
+
+    Distance is the "redmean" weighted RGB metric, a cheap approximation of
+    perceived color difference. Entries are compared one at a time against
+    a running minimum, so memory stays at a few table-sized arrays.
+    """
+    colors = rgb565_table().astype(np.float32)
+    best = np.zeros(len(colors), dtype=np.uint8 if len(palette) <= 256 else np.uint16)
+    best_distance = np.full(len(colors), np.inf, dtype=np.float32)
+    for index, entry in enumerate(np.asarray(palette, dtype=np.float32)):
+        mean_red = (colors[:, 0] + entry[0]) / 2
+        dr, dg, db = (colors - entry).T
+        distance = (2 + mean_red / 256) * dr * dr + 4 * dg * dg + (2 + (255 - mean_red) / 256) * db * db
+        closer = distance < best_distance
+        best[closer] = index
+        best_distance[closer] = distance[closer]
+    return best
+
+
+class PaletteLUT:
+    """Snap colors to a palette through a cached RGB565 lookup table"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.palette = None
+        self.key = None
+        self.table = None
+
+    def load(self, palette):
+        """Make palette the active one, reading or building its table"""
+        palette = np.asarray(palette, dtype=np.uint8)
+        key = palette_hash(palette)
+        if key == self.key:
+            return
+
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        table = None
+        if os.path.exists(path):
+            try:
+                table = np.load(path)
+                if table.shape != (65536,) or int(table.max()) >= len(palette):
+                    table = None
+            except (OSError, ValueError):
+                table = None
+        if table is None:
+            table = build_lut(palette)
+            self.save(path, table)
+
+        self.palette = palette
+        self.key = key
+        self.table = table
+
+    def save(self, path, table):
+        """Write a table to the disk cache; failing to cache is not an error"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".lut-", suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, table)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def indices(self, pixels):
+        """Return the palette index of each pixel of an (..., 3) array"""
+        rgb = pixels.astype(np.uint32)
+        key = (((rgb[..., 0] * 31) // 255) << 11) | (((rgb[..., 1] * 63) // 255) << 5) | ((rgb[..., 2] * 31) // 255)
+        return self.table[key]
+
+    def snap(self, pixels):
+        """Replace each pixel of an (..., 3) array with its nearest palette color"""
+        return self.palette[self.indices(pixels)]
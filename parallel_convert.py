@@ -0,0 +1,361 @@
+"""Parallel conversion of very large images in row bands
+
+The decoded source, every intermediate and the result live in
+multiprocessing.shared_memory blocks. Worker processes attach to a block by
+name and write their band in place, so pixel arrays are never pickled.
+Each stage is split so a band sees exactly the inputs the serial code would,
+which keeps the output byte-identical to pixel_editor.convert_frame and
+iter_export_source:
+
+- Lanczos runs as PIL's two separable passes, the horizontal pass over row
+  bands and the vertical pass over column bands.
+- The block downscalers work on bands of whole output rows.
+- Color reduction merges per-band RGB565 histograms, picks the palette once
+  and maps every band through its lookup table.
+- Packing to RGB565 and formatting C rows are independent per row.
+
+Images below min_pixels, or a pool of one worker, take the serial path.
+
+    python parallel_convert.py atlas.png -o atlas.h --size 2048x2048 --workers 8
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from color_reduction import choose_palette, distinct_codes, pack_rgb565, palette_lookup
+from pixel_editor import (DOWNSCALERS, c_array_declaration, c_array_header, convert_frame, describe_orientation,
+                          downscale, format_c_row, has_alpha, hex_to_rgb, iter_export_source, orient_array,
+                          rgb888_to_rgb565, write_source_atomically)
+
+# Smaller images convert faster serially than it takes to hand them out
+DEFAULT_MIN_PIXELS = 4_000_000
+
+# Bands per worker; more than one evens out the load when bands differ in cost
+BANDS_PER_WORKER = 4
+
+
+class SharedArray:
+    """A NumPy array in a named shared memory block"""
+
+    def __init__(self, shape, dtype=np.uint8, name=None):
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        if name is None:
+            size = max(1, math.prod(shape) * dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(shape, dtype, buffer=self.shm.buf)
+        self.spec = (self.shm.name, shape, dtype.str)
+
+    @classmethod
+    def from_array(cls, array):
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def close(self):
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # A view outlived the call, e.g. in a traceback; the mapping goes when it does
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def split(length, parts, minimum=16):
+    """Split range(length) into at most `parts` contiguous (start, stop) bands"""
+    size = max(minimum, -(-length // max(1, parts)))
+    return [(start, min(length, start + size)) for start in range(0, length, size)]
+
+
+def call_attached(task, band, specs, args):
+    """Worker entry point: map the shared arrays named by specs and run task(band, *arrays, *args)"""
+    shared = [SharedArray(shape, dtype, name) for name, shape, dtype in specs]
+    try:
+        return task(band, *[array.array for array in shared], *args)
+    finally:
+        for array in shared:
+            array.close()
+
+
+# Worker tasks; each gets its (start, stop) band and the mapped shared arrays,
+# writes its share of the result in place and returns little or nothing
+
+def resize_rows(band, src, dst, premultiply):
+    """Horizontal Lanczos pass over source rows top:bottom"""
+    top, bottom = band
+    image = Image.fromarray(np.ascontiguousarray(src[top:bottom]))
+    if premultiply:
+        image = image.convert("RGBa")  # What PIL does to RGBA before resampling
+    image = image.resize((dst.shape[1], bottom - top), Image.LANCZOS)
+    dst[top:bottom] = np.frombuffer(image.tobytes(), np.uint8).reshape(bottom - top, dst.shape[1], -1)
+
+
+def resize_columns(band, src, dst, premultiply):
+    """Vertical Lanczos pass over columns left:right of the horizontal pass"""
+    left, right = band
+    mode = "RGBa" if premultiply else "RGB"
+    image = Image.frombuffer(mode, (right - left, src.shape[0]), np.ascontiguousarray(src[:, left:right]),
+                             "raw", mode, 0, 1)
+    image = image.resize((right - left, dst.shape[0]), Image.LANCZOS)
+    if premultiply:
+        image = image.convert("RGBA")
+    dst[:, left:right] = np.asarray(image)
+
+
+def downscale_rows(band, src, dst, method):
+    """Block-downscale the source rows behind output rows top:bottom"""
+    top, bottom = band
+    # The rows image_blocks would sample for these blocks over the whole image
+    block_height = max(1, src.shape[0] // dst.shape[0])
+    rows = (np.arange(top * block_height, bottom * block_height) * src.shape[0]) // (dst.shape[0] * block_height)
+    dst[top:bottom] = downscale(src[rows], dst.shape[1], bottom - top, method)
+
+
+def histogram_rows(band, src, alpha_threshold):
+    """Return (values, counts) of all RGB565 colors in rows top:bottom and of the opaque ones"""
+    top, bottom = band
+    vga_array = pack_rgb565(src[top:bottom, :, :3])
+    counts = np.bincount(vga_array.ravel(), minlength=65536)
+    opaque = counts
+    if alpha_threshold is not None:
+        opaque = np.bincount(vga_array[src[top:bottom, :, 3] >= alpha_threshold], minlength=65536)
+    values, opaque_values = np.flatnonzero(counts), np.flatnonzero(opaque)
+    return (values, counts[values]), (opaque_values, opaque[opaque_values])
+
+
+def distinct_rows(band, src, alpha_threshold):
+    """Return the 24-bit codes of the distinct colors in rows top:bottom, opaque ones only with a threshold"""
+    top, bottom = band
+    pixels = src[top:bottom, :, :3]
+    if alpha_threshold is not None:
+        pixels = pixels[src[top:bottom, :, 3] >= alpha_threshold]
+    return distinct_codes(pixels)
+
+
+def map_rows(band, src, table):
+    """Replace the colors of rows top:bottom through an RGB565-indexed color table"""
+    top, bottom = band
+    src[top:bottom, :, :3] = table[pack_rgb565(src[top:bottom, :, :3])]
+
+
+def key_rows(band, src, key, alpha_threshold):
+    """Set the rows' pixels whose alpha is below the threshold to the transparency key"""
+    top, bottom = band
+    src[top:bottom, :, :3][src[top:bottom, :, 3] < alpha_threshold] = key
+
+
+def pack_rows(band, src, dst):
+    top, bottom = band
+    dst[top:bottom] = rgb888_to_rgb565(src[top:bottom])
+
+
+def format_rows(band, src, rotation, mirror_h, mirror_v, scan):
+    """Return the C initializer lines start:stop of the oriented array"""
+    start, stop = band
+    view = orient_array(src, rotation, mirror_h, mirror_v)
+    if scan == "column":
+        view = view.T
+    last = view.shape[0] - 1
+    return "".join(format_c_row(view[y], y == last) for y in range(start, stop))
+
+
+class ParallelConverter:
+    """Convert large images with a pool of worker processes"""
+
+    def __init__(self, workers=None, min_pixels=DEFAULT_MIN_PIXELS):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_pixels = min_pixels
+        self.executor = None
+
+    def pool(self):
+        # Spawned workers do not inherit the editor's Tk state or held locks
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def parallel(self, pixel_count):
+        return self.workers > 1 and pixel_count >= self.min_pixels
+
+    def bands(self, length):
+        return split(length, self.workers * BANDS_PER_WORKER)
+
+    def map(self, task, bands, arrays, *args):
+        """Run task(band, *arrays, *args) for every band in the pool
+
+        arrays are SharedArrays, passed to the workers by name. Returns an
+        iterator over the results in band order.
+        """
+        specs = [array.spec for array in arrays]
+        count = len(bands)
+        return self.pool().map(call_attached, [task] * count, bands, [specs] * count, [args] * count)
+
+    def resize(self, source, width, height, method, premultiply, shared):
+        """Resize a shared (h, w, c) array into a new shared array, which is added to shared"""
+        source_height, _, channels = source.array.shape
+        result = SharedArray((height, width, channels))
+        shared.append(result)
+        if method == "Lanczos":
+            middle = SharedArray((source_height, width, channels))
+            shared.append(middle)
+            list(self.map(resize_rows, self.bands(source_height), (source, middle), premultiply))
+            list(self.map(resize_columns, self.bands(width), (middle, result), premultiply))
+            middle.unlink()
+            shared.remove(middle)
+        else:
+            list(self.map(downscale_rows, self.bands(height), (source, result), method))
+        return result
+
+    def convert_frame(self, frame, width, height, dither=False, key=None, alpha_threshold=128, method="Lanczos",
+                      colors=16, quantizer="Median Cut"):
+        """Parallel equivalent of pixel_editor.convert_frame"""
+        if not self.parallel(frame.width * frame.height):
+            return convert_frame(frame, width, height, dither, key, alpha_threshold, method, colors, quantizer)
+        if method not in DOWNSCALERS:
+            raise ValueError(f"Unknown downscaler: {method}")
+
+        keyed = key is not None and has_alpha(frame)
+        mode = "RGBA" if keyed else "RGB"
+        if frame.mode != mode:
+            frame = frame.convert(mode)
+
+        shared = []
+        try:
+            # Decode straight into shared memory a strip at a time
+            source = SharedArray((frame.height, frame.width, len(mode)))
+            shared.append(source)
+            for top, bottom in split(frame.height, frame.height // 256 + 1):
+                source.array[top:bottom] = np.asarray(frame.crop((0, top, frame.width, bottom)))
+
+            if (frame.width, frame.height) == (width, height):
+                # Neither PIL nor the block filters change an image resized to its own size
+                result = source
+            else:
+                result = self.resize(source, width, height, method, keyed, shared)
+                source.unlink()
+                shared.remove(source)
+
+            rows = self.bands(height)
+            threshold = alpha_threshold if keyed else None
+            if dither:
+                counts = np.zeros(65536, dtype=np.int64)
+                opaque = np.zeros(65536, dtype=np.int64)
+                for (values, value_counts), (opaque_values, opaque_counts) in self.map(histogram_rows, rows,
+                                                                                       (result,), threshold):
+                    counts[values] += value_counts
+                    opaque[opaque_values] += opaque_counts
+                weights = opaque if opaque.any() else counts
+                colors = min(256, max(1, int(colors)))
+                exact = False
+                if np.count_nonzero(weights) <= colors:
+                    # Few enough colors that reduce_colors keeps them exactly, so nothing changes
+                    codes = np.unique(np.concatenate(list(self.map(distinct_rows, rows, (result,),
+                                                                   threshold if opaque.any() else None))))
+                    exact = len(codes) <= colors
+                if not exact:
+                    palette = choose_palette(np.flatnonzero(weights).astype(np.uint16), weights[weights > 0],
+                                             colors, quantizer)
+                    table = SharedArray.from_array(palette[palette_lookup(np.flatnonzero(counts), palette)])
+                    shared.append(table)
+                    list(self.map(map_rows, rows, (result, table)))
+            if keyed:
+                list(self.map(key_rows, rows, (result,), key, threshold))
+            return np.array(result.array[..., :3])
+        finally:
+            for array in shared:
+                array.unlink()
+
+    def iter_export_source(self, pixels, settings, progress=None):
+        """Parallel equivalent of pixel_editor.iter_export_source
+
+        Only row- and column-major RGB565 arrays are split up; every other
+        format is generated serially.
+        """
+        height, width = pixels.shape[:2]
+        if (not self.parallel(width * height) or settings["format"] != "Array"
+                or settings["scan"] not in ("row", "column")):
+            yield from iter_export_source(pixels, settings, progress)
+            return
+
+        rotation, mirror_h, mirror_v = settings["rotation"], settings["mirror_h"], settings["mirror_v"]
+        scan = settings["scan"]
+        source = SharedArray.from_array(pixels)
+        packed = SharedArray((height, width), np.uint16)
+        try:
+            list(self.map(pack_rows, self.bands(height), (source, packed)))
+            source.unlink()
+
+            oriented_height, oriented_width = orient_array(packed.array, rotation, mirror_h, mirror_v).shape
+            yield c_array_header(oriented_width, oriented_height, settings["key565"],
+                                 describe_orientation(rotation, mirror_h, mirror_v, scan))
+            yield c_array_declaration(settings["var_name"], scan)
+            line_count = oriented_width if scan == "column" else oriented_height
+            lines = self.bands(line_count)
+            chunks = self.map(format_rows, lines, (packed,), rotation, mirror_h, mirror_v, scan)
+            for (_, stop), chunk in zip(lines, chunks):
+                yield chunk
+                if progress:
+                    progress(stop, line_count)
+            yield "};\n\n"
+        finally:
+            if source.array is not None:
+                source.unlink()
+            packed.unlink()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a large image to a C array using several processes")
+    parser.add_argument("input")
+    parser.add_argument("-o", "--output", required=True, help="Output C file")
+    parser.add_argument("--size", help="Target size as WxH (default: the image size)")
+    parser.add_argument("--method", default="Lanczos", choices=DOWNSCALERS)
+    parser.add_argument("--dither", action="store_true", help="Reduce the colors before export")
+    parser.add_argument("--colors", type=int, default=16)
+    parser.add_argument("--quantizer", default="Median Cut")
+    parser.add_argument("--transparent", help="Transparency key color as #RRGGBB")
+    parser.add_argument("--alpha-threshold", type=int, default=128)
+    parser.add_argument("--var-name", help="C variable name (default: the input file name)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    img = Image.open(args.input)
+    width, height = img.size
+    if args.size:
+        width, height = (int(n) for n in args.size.lower().split("x"))
+    key = hex_to_rgb(args.transparent) if args.transparent else None
+
+    converter = ParallelConverter(args.workers, min_pixels=0)
+    try:
+        pixels = converter.convert_frame(img, width, height, args.dither, key, args.alpha_threshold, args.method,
+                                         args.colors, args.quantizer)
+        settings = {
+            "var_name": args.var_name or os.path.splitext(os.path.basename(args.input))[0],
+            "format": "Array", "rotation": 0, "mirror_h": False, "mirror_v": False, "scan": "row",
+            "tile_size": (8, 8), "bits": 4,
+            "key565": int(rgb888_to_rgb565(np.array(key, dtype=np.uint8))) if key else None,
+        }
+        write_source_atomically(args.output, converter.iter_export_source(pixels, settings))
+    finally:
+        converter.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
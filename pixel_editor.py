@@ -1,21 +1,1276 @@
 
 import tkinter as tk
-from tkinter import filedialog, ttk, messagebox, colorchooser
-from PIL import Image, ImageTk
+from tkinter import filedialog, ttk, messagebox, colorchooser, simpledialog
+import tkinter.font as tkfont
+from PIL import Image, ImageTk, ImageSequence
 import numpy as np
+import json
 import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import project_format
+from color_reduction import QUANTIZERS, code_colors, reduce_colors, rgb888_codes
+from file_modes import replacement_mode
+from palette_lut import PaletteLUT, palette_array
+from profiler import PROFILER, profiled
+from scratch_buffer import ScratchBuffer, find_leftovers, read_header
+
+
+def rgb888_to_rgb565(pixels):
+    """Pack an (..., 3) RGB888 array into 16-bit 5R-6G-5B values"""
+    rgb = pixels.astype(np.uint32)
+    r5 = (rgb[..., 0] * 31) // 255  # 5 bits (0-31)
+    g6 = (rgb[..., 1] * 63) // 255  # 6 bits (0-63)
+    b5 = (rgb[..., 2] * 31) // 255  # 5 bits (0-31)
+    return ((r5 << 11) | (g6 << 5) | b5).astype(np.uint16)
+
+
+def rgb565_to_rgb888(values):
+    """Unpack 16-bit 5R-6G-5B values into an (..., 3) RGB888 array"""
+    v = values.astype(np.uint32)
+    r8 = (((v >> 11) & 0x1F) * 255) // 31
+    g8 = (((v >> 5) & 0x3F) * 255) // 63
+    b8 = ((v & 0x1F) * 255) // 31
+    return np.stack([r8, g8, b8], axis=-1).astype(np.uint8)
+
+
+# Raw pixel layouts that can be decoded from binary data, with bits per pixel
+RAW_FORMATS = {
+    "RGB565": 16,
+    "RGB565 Big-Endian": 16,
+    "RGB888": 24,
+    "RGBA8888": 32,
+    "Grayscale 8": 8,
+    "Monochrome 1": 1,
+}
+
+
+def decode_raw_pixels(data, width, pixel_format="RGB565"):
+    """Decode packed pixel bytes into a new (h, w, 3) RGB array
+
+    The height is however many whole rows the data holds; trailing bytes
+    are ignored. Monochrome rows are padded to whole bytes, most
+    significant pixel first, as pack_indices writes them.
+    """
+    if pixel_format not in RAW_FORMATS:
+        raise ValueError(f"Unknown pixel format: {pixel_format}")
+    data = np.frombuffer(data, dtype=np.uint8)
+    row_bytes = -(-width * RAW_FORMATS[pixel_format] // 8)
+    height = len(data) // row_bytes if width > 0 else 0
+    if height == 0:
+        raise ValueError(f"Not enough data for one row of {width} {pixel_format} pixels")
+    rows = data[:height * row_bytes].reshape(height, row_bytes)
+
+    if pixel_format == "Monochrome 1":
+        gray = np.unpackbits(rows, axis=1)[:, :width] * np.uint8(255)
+        return np.repeat(gray[..., None], 3, axis=2)
+    if pixel_format == "Grayscale 8":
+        return np.repeat(rows[..., None], 3, axis=2)
+    if pixel_format.startswith("RGB565"):
+        order = ">" if pixel_format.endswith("Big-Endian") else "<"
+        return rgb565_to_rgb888(rows.view(order + "u2"))
+    channels = RAW_FORMATS[pixel_format] // 8
+    return np.array(rows.reshape(height, width, channels)[..., :3])
+
+
+def iter_source_frames(img, grid=None):
+    """Yield the frames of an image one at a time
+
+    Animated GIF/APNG frames are decoded lazily as the iterator advances, so
+    only the current frame is held in memory. With grid=(cols, rows) the image
+    is treated as a sprite sheet and each cell is yielded instead.
+    """
+    if grid:
+        cols, rows = grid
+        cell_width = img.width // cols
+        cell_height = img.height // rows
+        for row in range(rows):
+            for col in range(cols):
+                x1 = col * cell_width
+                y1 = row * cell_height
+                yield img.crop((x1, y1, x1 + cell_width, y1 + cell_height))
+    else:
+        for frame in ImageSequence.Iterator(img):
+            yield frame
+
+
+def hex_to_rgb(hex_color):
+    """Parse a #RRGGBB color string into an (r, g, b) tuple"""
+    hex_color = hex_color.lstrip('#')
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+
+def has_alpha(img):
+    """Return True if a PIL image carries transparency information"""
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+
+DOWNSCALERS = ("Lanczos", "Box", "Mode", "Median", "Edge-Preserving")
+
+
+def image_blocks(pixels, width, height):
+    """View an (h, w, c) array as (height, block_h, width, block_w, c) pixel blocks
+    
+    Sources that are not an exact multiple of the target size are first
+    sampled down (nearest neighbour) to the nearest multiple, which keeps
+    every block the same shape so the reductions stay vectorized.
+    """
+    source_height, source_width, channels = pixels.shape
+    block_height = max(1, source_height // height)
+    block_width = max(1, source_width // width)
+    if (source_height, source_width) != (height * block_height, width * block_width):
+        pixels = scale_nearest(pixels, width * block_width, height * block_height)
+    return pixels.reshape(height, block_height, width, block_width, channels)
+
+
+def block_mode(blocks):
+    """Pick the most common color in each block, the lowest value winning ties"""
+    keys = np.zeros(blocks.shape[:-1], dtype=np.int64)
+    for channel in range(blocks.shape[-1]):
+        keys |= blocks[..., channel].astype(np.int64) << (8 * channel)
+    keys.sort(axis=-1)
+    
+    # Length of the run of equal keys ending at each position
+    count = keys.shape[-1]
+    positions = np.arange(count)
+    run_start = np.where(np.concatenate([np.ones(keys.shape[:-1] + (1,), dtype=bool),
+                                         keys[..., 1:] != keys[..., :-1]], axis=-1), positions, 0)
+    run_length = positions - np.maximum.accumulate(run_start, axis=-1)
+    best = np.take_along_axis(keys, run_length.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+    return np.stack([(best >> (8 * channel)) & 0xFF for channel in range(blocks.shape[-1])],
+                    axis=-1).astype(np.uint8)
+
+
+def downscale(pixels, width, height, method="Box"):
+    """Shrink an (h, w, c) uint8 array with a pixel-art friendly block filter
+    
+    Box averages each block, Mode keeps its most common color, Median takes
+    the per-channel median and Edge-Preserving keeps the block pixel nearest
+    the block average, so edges stay hard instead of blending.
+    """
+    if method not in DOWNSCALERS[1:]:
+        raise ValueError(f"Unknown downscaler: {method}")
+    view = image_blocks(pixels, width, height)
+    count = view.shape[1] * view.shape[3]
+    if method in ("Box", "Edge-Preserving"):
+        # Summing one axis at a time is several times faster than axis=(1, 3)
+        total = view.sum(axis=1, dtype=np.uint32).sum(axis=2)
+        mean = (total + count // 2) // count
+        if method == "Box":
+            return mean.astype(np.uint8)
+    
+    # The remaining filters work on each block as a flat list of pixels
+    blocks = view.swapaxes(1, 2).reshape(height, width, count, view.shape[-1])
+    if method == "Mode":
+        return block_mode(blocks)
+    if method == "Median":
+        return np.median(blocks, axis=2).round().astype(np.uint8)
+    difference = blocks.astype(np.int16) - mean[:, :, None].astype(np.int16)
+    distance = np.einsum("ijkc,ijkc->ijk", difference, difference, dtype=np.int32)
+    return np.take_along_axis(blocks, distance.argmin(axis=2)[:, :, None, None], axis=2)[:, :, 0]
+
+
+def reduce_half(pixels, key=None):
+    """Halve an (h, w, 3) array with a 2x2 box filter
+
+    Odd rows and columns are dropped. With a transparency key only opaque
+    pixels are averaged, and a block that is mostly key stays key, so
+    sprite edges do not pick up a fringe of the key color.
+    """
+    height, width = pixels.shape[:2]
+    view = image_blocks(pixels, max(1, width // 2), max(1, height // 2))
+    if key is None:
+        return downscale(pixels, view.shape[2], view.shape[0], "Box")
+
+    opaque = (view != np.array(key, dtype=np.uint8)).any(axis=-1)
+    count = opaque.sum(axis=1, dtype=np.uint32).sum(axis=2)
+    total = (view * opaque[..., None]).sum(axis=1, dtype=np.uint32).sum(axis=2)
+    reduced = ((total + count[..., None] // 2) // np.maximum(count, 1)[..., None]).astype(np.uint8)
+    reduced[count * 2 < view.shape[1] * view.shape[3]] = key
+    return reduced
+
+
+def mipmap_chain(pixels, levels=0, key=None):
+    """Return a list of successively halved copies of pixels, starting with pixels itself
+
+    Each level is reduced from the one before it. levels=0 continues down
+    to a single pixel.
+    """
+    chain = [pixels]
+    while (levels <= 0 or len(chain) < levels) and max(chain[-1].shape[:2]) > 1:
+        chain.append(reduce_half(chain[-1], key))
+    return chain
+
+
+def resize_image(img, width, height, method="Lanczos"):
+    """Resize a PIL image with one of DOWNSCALERS"""
+    if method == "Lanczos":
+        return img.resize((width, height), Image.LANCZOS)
+    mode = "RGBA" if has_alpha(img) else "RGB"
+    return Image.fromarray(downscale(np.asarray(img.convert(mode)), width, height, method), mode)
+
+
+def convert_frame(frame, width, height, dither=False, key=None, alpha_threshold=128, method="Lanczos",
+                  colors=16, quantizer="Median Cut"):
+    """Resize and quantize a single frame to an RGB pixel array
+
+    With dither set the frame is reduced to at most `colors` colors. If a
+    transparency key color is given, pixels whose alpha falls below the
+    threshold are replaced by the key so the transparency survives export.
+    """
+    alpha = None
+    if key is not None and has_alpha(frame):
+        rgba = resize_image(frame.convert("RGBA"), width, height, method)
+        alpha = np.array(rgba.getchannel("A"))
+        resized = rgba.convert("RGB")
+    else:
+        if frame.mode != "RGB":
+            frame = frame.convert("RGB")
+        resized = resize_image(frame, width, height, method)
+    pixels = np.array(resized)
+    if dither:
+        # Transparent pixels are about to become the key, so they get no say in the palette
+        palette, indices = reduce_colors(pixels, colors, quantizer,
+                                         alpha >= alpha_threshold if alpha is not None else None)
+        pixels = palette[indices]
+    if alpha is not None:
+        pixels[alpha < alpha_threshold] = key
+    return pixels
+
+
+def iter_import_frames(img, width, height, dither=False, grid=None, key=None, alpha_threshold=128,
+                       method="Lanczos", colors=16, quantizer="Median Cut"):
+    """Stream converted frames from an animation or sprite sheet"""
+    for frame in iter_source_frames(img, grid):
+        yield convert_frame(frame, width, height, dither, key, alpha_threshold, method, colors, quantizer)
+
+
+def orient_array(vga_array, rotation=0, mirror_h=False, mirror_v=False):
+    """Return a zero-copy view of the array as the panel is mounted
+
+    Mirroring is applied first, then a clockwise rotation by a multiple of 90
+    degrees. Only strides change, so no pixel data is copied.
+    """
+    view = vga_array
+    if mirror_h:
+        view = view[:, ::-1]
+    if mirror_v:
+        view = view[::-1]
+    if rotation % 360:
+        view = np.rot90(view, -(rotation // 90))
+    return view
+
+
+def oriented_position(x, y, width, height, rotation=0, mirror_h=False, mirror_v=False):
+    """Return the (row, column) of pixel (x, y) in the orient_array view of a width x height array"""
+    if mirror_h:
+        x = width - 1 - x
+    if mirror_v:
+        y = height - 1 - y
+    turns = (rotation // 90) % 4
+    if turns == 1:
+        return x, height - 1 - y
+    if turns == 2:
+        return height - 1 - y, width - 1 - x
+    if turns == 3:
+        return width - 1 - x, y
+    return y, x
+
+
+def source_position(row, column, width, height, rotation=0, mirror_h=False, mirror_v=False):
+    """Return the pixel (x, y) at (row, column) of the orient_array view; inverse of oriented_position"""
+    turns = (rotation // 90) % 4
+    if turns == 1:
+        x, y = row, height - 1 - column
+    elif turns == 2:
+        x, y = width - 1 - column, height - 1 - row
+    elif turns == 3:
+        x, y = width - 1 - row, column
+    else:
+        x, y = column, row
+    if mirror_h:
+        x = width - 1 - x
+    if mirror_v:
+        y = height - 1 - y
+    return x, y
+
+
+def tile_array(view, tile_width, tile_height):
+    """Return a zero-copy (tile rows, tile columns, tile height, tile width) view"""
+    height, width = view.shape
+    if width % tile_width or height % tile_height:
+        raise ValueError(f"Image size {width}x{height} is not a multiple of the "
+                         f"{tile_width}x{tile_height} tile size")
+    
+    # Splitting an axis never needs a copy, whatever the strides are
+    tiles = view.reshape(height // tile_height, tile_height, width // tile_width, tile_width)
+    return tiles.transpose(0, 2, 1, 3)
+
+
+def describe_orientation(rotation=0, mirror_h=False, mirror_v=False, scan="row"):
+    """Return a comment line describing a non-default export orientation"""
+    parts = []
+    if mirror_h:
+        parts.append("mirrored horizontally")
+    if mirror_v:
+        parts.append("mirrored vertically")
+    if rotation % 360:
+        parts.append(f"rotated {rotation % 360} degrees clockwise")
+    if scan == "column":
+        parts.append("column-major order")
+    elif scan == "tile":
+        parts.append("tile order")
+    if not parts:
+        return ""
+    return "// Layout: " + ", ".join(parts) + "\n"
+
+
+def c_array_header(width, height, key565=None, layout=""):
+    """Return the comment and #define block that opens an RGB565 array export"""
+    header = f"// VGA Image Data - {width}x{height} - 16-bit color (5R-6G-5B)\n"
+    header += "// Generated by Pixel Editor\n"
+    header += layout + "\n"
+    header += f"#define IMAGE_WIDTH {width}\n"
+    header += f"#define IMAGE_HEIGHT {height}\n\n"
+    if key565 is not None:
+        header += f"#define TRANSPARENT_COLOR 0x{key565:04X}\n\n"
+    return header
+
+
+def c_array_declaration(var_name, scan="row"):
+    """Return the opening line of a row-major or column-major array"""
+    if scan == "column":
+        return f"const unsigned short {var_name}[IMAGE_WIDTH][IMAGE_HEIGHT] = {{\n"
+    return f"const unsigned short {var_name}[IMAGE_HEIGHT][IMAGE_WIDTH] = {{\n"
+
+
+def format_c_row(values, last=False):
+    """Format one line of RGB565 values as a braced C initializer"""
+    row = ", ".join(f"0x{v:04X}" for v in values)
+    return "    {" + row + ("}\n" if last else "},\n")
+
+
+def iter_c_array_source(vga_array, var_name, key565=None, scan="row", tile_size=(8, 8), layout="",
+                        progress=None):
+    """Yield the C source for an RGB565 array, one row at a time
+
+    scan selects the order pixels are emitted in: "row" (row-major), "column"
+    (column-major) or "tile" (tile by tile, each tile row-major). If given,
+    progress(done, total) is called as the pixel data is emitted.
+    """
+    height, width = vga_array.shape
+    
+    yield c_array_header(width, height, key565, layout)
+    
+    if scan == "tile":
+        tile_width, tile_height = tile_size
+        tiles = tile_array(vga_array, tile_width, tile_height)
+        tile_rows, tile_cols = tiles.shape[:2]
+        yield f"#define TILE_WIDTH {tile_width}\n"
+        yield f"#define TILE_HEIGHT {tile_height}\n"
+        yield f"#define TILE_COUNT {tile_rows * tile_cols}\n\n"
+        yield f"const unsigned short {var_name}[TILE_COUNT][TILE_HEIGHT][TILE_WIDTH] = {{\n"
+        
+        for ty in range(tile_rows):
+            for tx in range(tile_cols):
+                rows = ",\n".join("        {" + ", ".join(f"0x{v:04X}" for v in row) + "}"
+                                  for row in tiles[ty, tx])
+                last = ty == tile_rows - 1 and tx == tile_cols - 1
+                yield "    {\n" + rows + ("\n    }\n" if last else "\n    },\n")
+                if progress:
+                    progress(ty * tile_cols + tx + 1, tile_rows * tile_cols)
+    else:
+        if scan == "column":
+            vga_array = vga_array.T
+        yield c_array_declaration(var_name, scan)
+        
+        line_count = vga_array.shape[0]
+        for y in range(line_count):
+            yield format_c_row(vga_array[y], y == line_count - 1)
+            if progress:
+                progress(y + 1, line_count)
+    
+    yield "};\n\n"
+
+
+def find_opaque_spans(mask):
+    """Find the runs of True values in each row of a 2-D mask
+
+    Returns (rows, starts, lengths) arrays in row-major order.
+    """
+    height, width = mask.shape
+    
+    # Pad each row with a False on both sides so every run has an edge
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - starts
+
+
+def iter_span_list_source(vga_array, var_name, key565, scan="row", layout="", progress=None):
+    """Yield C source listing the opaque spans of each row
+
+    The output has a per-row table of (first span, span count), a span table of
+    (x start, length, pixel offset) and the packed opaque pixels, so a blitter
+    can copy whole runs and never test for the transparent color. With
+    scan="column" the spans run down each column instead.
+    """
+    if scan == "tile":
+        raise ValueError("Span lists can only be exported in row or column order")
+    image_height, image_width = vga_array.shape
+    if scan == "column":
+        vga_array = vga_array.T
+    height, width = vga_array.shape
+    mask = vga_array != key565 if key565 is not None else np.ones(vga_array.shape, dtype=bool)
+    rows, starts, lengths = find_opaque_spans(mask)
+    
+    # Opaque pixels in row-major order line up with the spans
+    pixels = vga_array[mask]
+    offsets = np.cumsum(lengths) - lengths
+    row_first = np.searchsorted(rows, np.arange(height))
+    row_count = np.bincount(rows, minlength=height)
+    
+    line_macro, length_macro = ("IMAGE_WIDTH", "IMAGE_HEIGHT") if scan == "column" else ("IMAGE_HEIGHT", "IMAGE_WIDTH")
+    
+    yield f"// VGA Sprite Spans - {image_width}x{image_height} - 16-bit color (5R-6G-5B)\n"
+    yield "// Generated by Pixel Editor\n"
+    yield layout + "\n"
+    yield f"#define {length_macro} {width}\n"
+    yield f"#define {line_macro} {height}\n"
+    yield f"#define SPAN_COUNT {len(starts)}\n"
+    yield f"#define PIXEL_COUNT {len(pixels)}\n\n"
+    if key565 is not None:
+        yield f"#define TRANSPARENT_COLOR 0x{key565:04X}\n\n"
+    yield "#ifndef PIXEL_SPAN_T_DEFINED\n"
+    yield "#define PIXEL_SPAN_T_DEFINED\n"
+    yield "typedef struct {\n"
+    yield "    unsigned short x;       // First opaque pixel along the row\n"
+    yield "    unsigned short length;  // Number of opaque pixels\n"
+    yield "    unsigned long offset;   // Index of the first pixel in the pixel table\n"
+    yield "} pixel_span_t;\n"
+    yield "#endif\n\n"
+    
+    # Per-row index into the span table: {first span, span count}
+    yield f"const unsigned short {var_name}_rows[{line_macro}][2] = {{\n"
+    for y in range(height):
+        yield f"    {{{row_first[y]}, {row_count[y]}}}" + (",\n" if y < height - 1 else "\n")
+    yield "};\n\n"
+    
+    # C does not allow empty arrays, so a fully transparent image gets a placeholder
+    yield f"const pixel_span_t {var_name}_spans[{max(1, len(starts))}] = {{\n"
+    if len(starts):
+        for y in range(height):
+            first = row_first[y]
+            spans = ", ".join(f"{{{starts[i]}, {lengths[i]}, {offsets[i]}}}"
+                              for i in range(first, first + row_count[y]))
+            if spans:
+                yield f"    {spans}" + (",\n" if first + row_count[y] < len(starts) else "\n")
+    else:
+        yield "    {0, 0, 0}\n"
+    yield "};\n\n"
+    
+    yield f"const unsigned short {var_name}_pixels[{max(1, len(pixels))}] = {{\n"
+    if len(pixels):
+        for i in range(0, len(pixels), width):
+            chunk = ", ".join(f"0x{v:04X}" for v in pixels[i:i + width])
+            yield f"    {chunk}" + (",\n" if i + width < len(pixels) else "\n")
+            if progress:
+                progress(min(i + width, len(pixels)), len(pixels))
+    else:
+        yield "    0x0000\n"
+    yield "};\n\n"
+
+
+def scan_view(array, rotation=0, mirror_h=False, mirror_v=False, scan="row"):
+    """Return a zero-copy view of an image (2-D or RGB) in export scan order
+
+    Column-major output is returned transposed so that each row of the view is
+    one emitted line. Tile order is not a line order, so it is rejected here.
+    """
+    if scan == "tile":
+        raise ValueError("This export format can only be written in row or column order")
+    view = orient_array(array, rotation, mirror_h, mirror_v)
+    if scan == "column":
+        view = view.swapaxes(0, 1)
+    return view
+
+
+def color_error(pixels, decoded):
+    """Return the root-mean-square difference between two RGB arrays"""
+    diff = pixels.astype(np.float64) - decoded
+    return float(np.sqrt(np.mean(diff * diff))) if diff.size else 0.0
+
+
+def quantize_indices(pixels, colors, key565=None):
+    """Map an RGB image onto a palette of at most `colors` RGB565 entries
+
+    Images that already use few enough colors are indexed exactly. With a
+    transparency key, entry 0 is reserved for key565: pixels that pack to it
+    get index 0 and take no part in choosing the other entries. Returns
+    (palette, indices) where palette is uint16 RGB565 and indices is uint8.
+    """
+    pixels = np.ascontiguousarray(pixels)
+    vga_array = rgb888_to_rgb565(pixels)
+    if key565 is None:
+        palette, inverse = np.unique(vga_array, return_inverse=True)
+        if len(palette) <= colors:
+            return palette, inverse.reshape(vga_array.shape).astype(np.uint8)
+        
+        # Too many colors: fall back to a median-cut quantizer
+        quant_palette, indices = reduce_colors(pixels, colors)
+        return rgb888_to_rgb565(quant_palette), indices
+    
+    opaque = vga_array != key565
+    indices = np.zeros(vga_array.shape, dtype=np.uint8)
+    palette, inverse = np.unique(vga_array[opaque], return_inverse=True)
+    if len(palette) < colors:
+        indices[opaque] = inverse + 1
+    else:
+        quant_palette, quant_indices = reduce_colors(pixels, colors - 1, mask=opaque)
+        palette = rgb888_to_rgb565(quant_palette)
+        indices[opaque] = quant_indices[opaque] + 1
+    return np.concatenate([[key565], palette]).astype(np.uint16), indices
+
+
+def pack_indices(indices, bits):
+    """Pack palette indices into bytes, most significant pixel first
+
+    Each row is padded to a whole number of bytes. Returns a
+    (height, row bytes) uint8 array.
+    """
+    height, width = indices.shape
+    per_byte = 8 // bits
+    row_bytes = -(-width // per_byte)
+    
+    padded = np.zeros((height, row_bytes * per_byte), dtype=np.uint8)
+    padded[:, :width] = indices
+    groups = padded.reshape(height, row_bytes, per_byte).astype(np.uint16)
+    shifts = (8 - bits) - bits * np.arange(per_byte, dtype=np.uint16)
+    return (groups << shifts).sum(axis=2).astype(np.uint8)
+
+
+def run_lengths(values, max_run=255):
+    """Run-length encode the values of an array in C order
+
+    Runs longer than max_run are split. Returns (counts, run values).
+    """
+    flat = np.ravel(values)
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint8), flat
+    
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    lengths = np.diff(np.append(starts, flat.size))
+    
+    # Split long runs into max_run pieces plus a remainder
+    pieces = -(-lengths // max_run)
+    counts = np.full(pieces.sum(), max_run, dtype=np.uint8)
+    counts[np.cumsum(pieces) - 1] = lengths - (pieces - 1) * max_run
+    return counts, np.repeat(flat[starts], pieces)
+
+
+def iter_indexed_source(palette, packed, width, bits, var_name, key565=None, scan="row", layout="", progress=None):
+    """Yield C source for a palette plus packed per-line index data
+
+    With a transparency key, palette entry 0 is the key (see quantize_indices).
+    """
+    line_count, row_bytes = packed.shape
+    line_macro, length_macro = ("IMAGE_WIDTH", "IMAGE_HEIGHT") if scan == "column" else ("IMAGE_HEIGHT", "IMAGE_WIDTH")
+    image_width, image_height = (line_count, width) if scan == "column" else (width, line_count)
+    
+    yield f"// VGA Indexed Image Data - {image_width}x{image_height} - {bits}bpp, 16-bit color (5R-6G-5B) palette\n"
+    yield "// Generated by Pixel Editor\n"
+    yield layout + "\n"
+    yield f"#define {length_macro} {width}\n"
+    yield f"#define {line_macro} {line_count}\n"
+    yield f"#define IMAGE_BPP {bits}\n"
+    yield f"#define ROW_BYTES {row_bytes}\n"
+    yield f"#define PALETTE_SIZE {len(palette)}\n\n"
+    if key565 is not None:
+        yield f"#define TRANSPARENT_COLOR 0x{key565:04X}\n"
+        yield "#define TRANSPARENT_INDEX 0\n\n"
+    
+    yield f"const unsigned short {var_name}_palette[PALETTE_SIZE] = {{\n"
+    yield "    " + ", ".join(f"0x{v:04X}" for v in palette) + "\n"
+    yield "};\n\n"
+    
+    # Pixels are packed most significant bits first
+    yield f"const unsigned char {var_name}[{line_macro}][ROW_BYTES] = {{\n"
+    for y in range(line_count):
+        row = ", ".join(f"0x{v:02X}" for v in packed[y])
+        yield "    {" + row + ("},\n" if y < line_count - 1 else "}\n")
+        if progress:
+            progress(y + 1, line_count)
+    yield "};\n\n"
+
+
+def iter_rle_source(counts, values, width, line_count, var_name, palette=None, key565=None, scan="row", layout="",
+                    progress=None):
+    """Yield C source for run-length encoded pixels
+
+    Runs are stored as parallel count and value tables. With a palette the
+    values are 8-bit palette indices, otherwise RGB565 colors. width and
+    line_count describe the scan_view lines the runs were taken from. With a
+    transparency key and a palette, palette entry 0 is the key.
+    """
+    run_count = len(counts)
+    kind = "8-bit palette indices" if palette is not None else "16-bit color (5R-6G-5B)"
+    line_macro, length_macro = ("IMAGE_WIDTH", "IMAGE_HEIGHT") if scan == "column" else ("IMAGE_HEIGHT", "IMAGE_WIDTH")
+    image_width, image_height = (line_count, width) if scan == "column" else (width, line_count)
+    
+    yield f"// VGA RLE Image Data - {image_width}x{image_height} - {kind}\n"
+    yield "// Generated by Pixel Editor\n"
+    yield layout + "\n"
+    yield f"#define {length_macro} {width}\n"
+    yield f"#define {line_macro} {line_count}\n"
+    yield f"#define RUN_COUNT {run_count}\n"
+    if palette is not None:
+        yield f"#define PALETTE_SIZE {len(palette)}\n"
+    yield "\n"
+    if key565 is not None:
+        yield f"#define TRANSPARENT_COLOR 0x{key565:04X}\n"
+        if palette is not None:
+            yield "#define TRANSPARENT_INDEX 0\n"
+        yield "\n"
+    if palette is not None:
+        yield f"const unsigned short {var_name}_palette[PALETTE_SIZE] = {{\n"
+        yield "    " + ", ".join(f"0x{v:04X}" for v in palette) + "\n"
+        yield "};\n\n"
+    
+    yield f"const unsigned char {var_name}_counts[RUN_COUNT] = {{\n"
+    for i in range(0, run_count, 16):
+        chunk = ", ".join(str(v) for v in counts[i:i + 16])
+        yield f"    {chunk}" + (",\n" if i + 16 < run_count else "\n")
+    yield "};\n\n"
+    
+    value_type, digits = ("unsigned char", 2) if palette is not None else ("unsigned short", 4)
+    yield f"const {value_type} {var_name}_values[RUN_COUNT] = {{\n"
+    for i in range(0, run_count, 16):
+        chunk = ", ".join(f"0x{v:0{digits}X}" for v in values[i:i + 16])
+        yield f"    {chunk}" + (",\n" if i + 16 < run_count else "\n")
+        if progress:
+            progress(min(i + 16, run_count), run_count)
+    yield "};\n\n"
+
+
+def iter_mipmap_source(levels, var_name, key565=None, scan="row", layout="", progress=None):
+    """Yield C source for a chain of RGB565 arrays packed into one data array
+
+    Each level's position in the data array is given by the offsets table,
+    its size by the widths and heights tables. scan is "row" or "column".
+    """
+    sizes = [level.shape for level in levels]
+    if scan == "column":
+        levels = [level.T for level in levels]
+    offsets = np.concatenate([[0], np.cumsum([h * w for h, w in sizes])])
+    height, width = sizes[0]
+
+    yield f"// VGA Mipmap Chain - {width}x{height}, {len(levels)} levels - 16-bit color (5R-6G-5B)\n"
+    yield "// Generated by Pixel Editor\n"
+    yield layout + "\n"
+    yield f"#define IMAGE_WIDTH {width}\n"
+    yield f"#define IMAGE_HEIGHT {height}\n"
+    yield f"#define MIP_LEVELS {len(levels)}\n"
+    yield f"#define MIP_DATA_SIZE {offsets[-1]}\n\n"
+    if key565 is not None:
+        yield f"#define TRANSPARENT_COLOR 0x{key565:04X}\n\n"
+
+    yield f"const unsigned short {var_name}_widths[MIP_LEVELS] = {{{', '.join(str(w) for _, w in sizes)}}};\n"
+    yield f"const unsigned short {var_name}_heights[MIP_LEVELS] = {{{', '.join(str(h) for h, _ in sizes)}}};\n"
+    yield f"const unsigned long {var_name}_offsets[MIP_LEVELS] = {{{', '.join(str(o) for o in offsets[:-1])}}};\n\n"
+
+    yield f"const unsigned short {var_name}[MIP_DATA_SIZE] = {{\n"
+    line_count = sum(level.shape[0] for level in levels)
+    done = 0
+    for index, level in enumerate(levels):
+        yield f"    // Level {index}: {sizes[index][1]}x{sizes[index][0]} at offset {offsets[index]}\n"
+        for y in range(level.shape[0]):
+            done += 1
+            row = ", ".join(f"0x{v:04X}" for v in level[y])
+            yield f"    {row}" + ("\n" if done == line_count else ",\n")
+            if progress:
+                progress(done, line_count)
+    yield "};\n\n"
+
+
+# Export formats offered in the toolbar
+EXPORT_FORMATS = ("Array", "Span List", "Indexed", "RLE", "Indexed RLE", "Mipmap")
+
+def iter_export_source(pixels, settings, progress=None):
+    """Yield the C source for an RGB image with the given export settings
+
+    settings is a dict as returned by PixelEditorApp.export_settings(). Only
+    the arguments are used, so this can run on a worker thread against a
+    snapshot of the pixel data.
+    """
+    rotation = settings["rotation"]
+    mirror_h = settings["mirror_h"]
+    mirror_v = settings["mirror_v"]
+    scan = settings["scan"]
+    var_name = settings["var_name"]
+    export_format = settings["format"]
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    
+    layout = describe_orientation(rotation, mirror_h, mirror_v, scan)
+    
+    if export_format in ("Indexed", "RLE", "Indexed RLE"):
+        pixels = scan_view(pixels, rotation, mirror_h, mirror_v, scan)
+        height, width = pixels.shape[:2]
+        key565 = settings["key565"]
+        if export_format == "RLE":
+            counts, values = run_lengths(rgb888_to_rgb565(pixels))
+            return iter_rle_source(counts, values, width, height, var_name, key565=key565, scan=scan, layout=layout,
+                                   progress=progress)
+        
+        bits = 8 if export_format == "Indexed RLE" else settings["bits"]
+        palette, indices = quantize_indices(pixels, 1 << bits, key565)
+        if export_format == "Indexed RLE":
+            counts, values = run_lengths(indices)
+            return iter_rle_source(counts, values, width, height, var_name, palette, key565, scan, layout, progress)
+        return iter_indexed_source(palette, pack_indices(indices, bits), width, bits, var_name, key565, scan, layout,
+                                   progress)
+
+    if export_format == "Mipmap":
+        if scan == "tile":
+            raise ValueError("Mipmap chains are exported row- or column-major, not in tiles")
+        key565 = settings["key565"]
+        key = None
+        if key565 is not None:
+            # Give every key pixel the same RGB value, one that packs back to key565
+            key = np.array([((key565 >> 11) * 255 + 30) // 31, (((key565 >> 5) & 0x3F) * 255 + 62) // 63,
+                            ((key565 & 0x1F) * 255 + 30) // 31], dtype=np.uint8)
+            pixels = np.where((rgb888_to_rgb565(pixels) == key565)[..., None], key, pixels)
+        levels = [orient_array(rgb888_to_rgb565(level), rotation, mirror_h, mirror_v)
+                  for level in mipmap_chain(pixels, settings.get("mip_levels", 0), key)]
+        return iter_mipmap_source(levels, var_name, key565, scan, layout, progress)
+
+    # Reorient as a view so the device can stream pixels in its native order
+    view = orient_array(rgb888_to_rgb565(pixels), rotation, mirror_h, mirror_v)
+    if export_format == "Span List":
+        return iter_span_list_source(view, var_name, settings["key565"], scan, layout, progress)
+    return iter_c_array_source(view, var_name, settings["key565"], scan, settings["tile_size"], layout, progress)
+
+
+def write_source_atomically(file_path, chunks, cancel_event=None):
+    """Write text chunks to a file via a temporary file and a rename
+
+    The target is only replaced once everything has been written, so an
+    interrupted or cancelled export never leaves a partial file behind.
+    Returns False if cancel_event was set before the write completed.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".export-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for chunk in chunks:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                f.write(chunk)
+            else:
+                f.flush()
+                os.fsync(f.fileno())
+        if cancel_event is not None and cancel_event.is_set():
+            os.remove(temp_path)
+            return False
+        os.chmod(temp_path, replacement_mode(file_path))
+        os.replace(temp_path, file_path)
+        return True
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Candidate encodings for the memory budget report as (format, bits per pixel)
+BUDGET_ENCODINGS = (
+    ("Array", 16),
+    ("Indexed", 8),
+    ("Indexed", 4),
+    ("Indexed", 2),
+    ("Indexed", 1),
+    ("RLE", 16),
+    ("Indexed RLE", 8),
+    ("Span List", 16),
+)
+
+
+def measure_encoding(pixels, export_format, bits, key565=None):
+    """Return the exact data size in bytes and the RMS color error of an encoding
+
+    Sizes count the array payloads the C export emits; span offsets are
+    counted as 32-bit values. Returns None if the encoding does not apply.
+    """
+    height, width = pixels.shape[:2]
+    
+    # Error is measured over the opaque pixels only; the key is not a real color
+    vga_array = rgb888_to_rgb565(pixels)
+    mask = vga_array != key565 if key565 is not None else np.ones(vga_array.shape, dtype=bool)
+    
+    if export_format == "Array":
+        return width * height * 2, color_error(pixels[mask], rgb565_to_rgb888(vga_array[mask]))
+    
+    if export_format == "Span List":
+        if key565 is None:
+            return None
+        _, starts, _ = find_opaque_spans(mask)
+        size = height * 4 + len(starts) * 8 + int(mask.sum()) * 2
+        return size, color_error(pixels[mask], rgb565_to_rgb888(vga_array[mask]))
+    
+    if export_format == "RLE":
+        counts, _ = run_lengths(vga_array)
+        return len(counts) * 3, color_error(pixels[mask], rgb565_to_rgb888(vga_array[mask]))
+    
+    palette, indices = quantize_indices(pixels, 1 << bits, key565)
+    error = color_error(pixels[mask], rgb565_to_rgb888(palette[indices[mask]]))
+    if export_format == "Indexed RLE":
+        counts, _ = run_lengths(indices)
+        return len(palette) * 2 + len(counts) * 2, error
+    return len(palette) * 2 + pack_indices(indices, bits).size, error
+
+
+def evaluate_encodings(pixels, key565=None, encodings=BUDGET_ENCODINGS):
+    """Measure every candidate encoding in parallel
+
+    Returns a list of dicts with format, bits, bytes and error, in the order
+    of the candidates. NumPy and PIL release the GIL for the heavy lifting,
+    so a thread pool is enough.
+    """
+    def measure(candidate):
+        export_format, bits = candidate
+        result = measure_encoding(pixels, export_format, bits, key565)
+        if result is None:
+            return None
+        size, error = result
+        return {"format": export_format, "bits": bits, "bytes": size, "error": error}
+    
+    with ThreadPoolExecutor() as pool:
+        results = list(pool.map(measure, encodings))
+    return [r for r in results if r is not None]
+
+
+def choose_encoding(results, budget=None, max_error=None):
+    """Pick the smallest encoding within the byte budget and error threshold"""
+    candidates = [r for r in results
+                  if (budget is None or r["bytes"] <= budget)
+                  and (max_error is None or r["error"] <= max_error)]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda r: (r["bytes"], r["error"]))
+
+
+def write_frames_c_array(f, frames, var_name, width, height):
+    """Write frames to a C source file as they arrive
+
+    Each frame is packed and written before the next one is pulled from the
+    iterator. Returns the number of frames written.
+    """
+    f.write(f"// VGA Animation Data - {width}x{height} - 16-bit color (5R-6G-5B)\n")
+    f.write("// Generated by Pixel Editor\n\n")
+    f.write(f"#define IMAGE_WIDTH {width}\n")
+    f.write(f"#define IMAGE_HEIGHT {height}\n\n")
+    f.write(f"const unsigned short {var_name}[][IMAGE_HEIGHT][IMAGE_WIDTH] = {{\n")
+    
+    count = 0
+    for pixels in frames:
+        if count:
+            f.write(",\n")
+        vga_array = rgb888_to_rgb565(pixels)
+        rows = ("        {" + ", ".join(f"0x{v:04X}" for v in row) + "}" for row in vga_array)
+        f.write(f"    {{ // frame {count}\n" + ",\n".join(rows) + "\n    }")
+        count += 1
+    
+    f.write("\n};\n\n")
+    f.write(f"#define FRAME_COUNT {count}\n")
+    return count
+
+
+def spread_runs(mask, same):
+    """Grow mask along each row to cover the whole runs of same it touches"""
+    starts = same.copy()
+    starts[:, 1:] &= ~same[:, :-1]
+    run_ids = np.cumsum(starts.ravel()).reshape(same.shape) * same
+    hit = np.bincount(run_ids[mask & same], minlength=int(run_ids.max()) + 1) > 0
+    hit[0] = False
+    return hit[run_ids]
+
+
+def flood_mask(pixels, x, y):
+    """Return the 4-connected region of pixels matching the color at (x, y)
+    
+    Whole row and column runs are added per step, so the number of steps
+    grows with how often the region changes direction, not with its area.
+    """
+    same = (pixels == pixels[y, x]).all(axis=-1)
+    mask = np.zeros(same.shape, dtype=bool)
+    mask[y, x] = True
+    while True:
+        grown = spread_runs(mask, same)
+        grown = spread_runs(grown.T, same.T).T
+        if (grown == mask).all():
+            return mask
+        mask = grown
+
+
+def mask_bounds(mask):
+    """Return the (x0, y0, x1, y1) bounding box of a mask, with exclusive ends"""
+    ys, xs = np.nonzero(mask)
+    return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+
+def scale_nearest(pixels, width, height):
+    """Nearest-neighbour resize of an (h, w, ...) array"""
+    rows = (np.arange(height) * pixels.shape[0]) // height
+    columns = (np.arange(width) * pixels.shape[1]) // width
+    return pixels[rows[:, None], columns]
+
+
+def stamp(dest, pixels, mask, x, y):
+    """Copy the masked pixels into dest with their top-left at (x, y), clipped
+    
+    Returns the (x0, y0, x1, y1) region of dest that was touched, or None.
+    """
+    height, width = mask.shape
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(dest.shape[1], x + width), min(dest.shape[0], y + height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    source = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    region = dest[y0:y1, x0:x1]
+    region[mask[source]] = pixels[source][mask[source]]
+    return x0, y0, x1, y1
+
+
+def line_points(x0, y0, x1, y1):
+    """Rasterize a line into (xs, ys) arrays with one pixel per step of the longer axis"""
+    steps = max(abs(x1 - x0), abs(y1 - y0))
+    t = np.arange(steps + 1) / max(1, steps)
+    xs = np.floor(x0 + (x1 - x0) * t + 0.5).astype(np.intp)
+    ys = np.floor(y0 + (y1 - y0) * t + 0.5).astype(np.intp)
+    return xs, ys
+
+
+def shape_points(shape, x0, y0, x1, y1, filled=False):
+    """Rasterize a line, rectangle or ellipse spanning two corners into (xs, ys) arrays"""
+    if shape == "line":
+        return line_points(x0, y0, x1, y1)
+    
+    left, right = min(x0, x1), max(x0, x1)
+    top, bottom = min(y0, y1), max(y0, y1)
+    ys, xs = np.mgrid[top:bottom + 1, left:right + 1]
+    if shape == "rect":
+        inside = np.ones(xs.shape, dtype=bool)
+    elif shape == "ellipse":
+        cx, cy = (left + right) / 2, (top + bottom) / 2
+        rx, ry = (right - left) / 2 + 0.5, (bottom - top) / 2 + 0.5
+        inside = ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 <= 1.0
+    else:
+        raise ValueError(f"Unknown shape: {shape}")
+    
+    if not filled:
+        # The outline is every inside pixel with a 4-neighbour outside
+        padded = np.pad(inside, 1)
+        interior = inside & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+        inside &= ~interior
+    return xs[inside], ys[inside]
+
+
+def points_mask(xs, ys, width, height):
+    """Turn (xs, ys) arrays into a (height, width) mask, dropping points off the image"""
+    keep = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    mask = np.zeros((height, width), dtype=bool)
+    mask[ys[keep], xs[keep]] = True
+    return mask
+
+
+def render_swatches(palette, columns, swatch_size):
+    """Render an (n, 3) palette as a grid of outlined swatches in one RGB array"""
+    count = len(palette)
+    rows = max(1, -(-count // columns))
+    ys, xs = np.mgrid[0:rows * swatch_size, 0:columns * swatch_size]
+    index = (ys // swatch_size) * columns + xs // swatch_size
+    index[index >= count] = count  # Empty slots after the last swatch stay white
+    colors = np.vstack([np.asarray(palette, dtype=np.uint8).reshape(-1, 3), [[255, 255, 255]]])
+    image = colors[index]
+    
+    edge_y, edge_x = ys % swatch_size, xs % swatch_size
+    outline = (edge_y == 0) | (edge_x == 0) | (edge_y == swatch_size - 1) | (edge_x == swatch_size - 1)
+    image[outline & (index < count)] = 0
+    return image
+
+
+def rgb565_plane(blue5, scale=4):
+    """Render every red/green combination of RGB565 for one blue level
+    
+    Red runs down (32 rows) and green across (64 columns), each value drawn
+    as a scale x scale block.
+    """
+    red, green = np.mgrid[0:32, 0:64]
+    plane = rgb565_to_rgb888((red << 11) | (green << 5) | blue5)
+    return plane.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+class Layer:
+    """One layer of the document
+    
+    The active layer's pixels live in PixelEditorApp.pixel_data, so its
+    pixels attribute is None while it is active. Pixels matching the key
+    color are fully transparent.
+    """
+    def __init__(self, name, pixels=None, visible=True, opacity=1.0, key=None):
+        self.name = name
+        self.pixels = pixels
+        self.visible = visible
+        self.opacity = opacity
+        self.key = key  # (r, g, b) tuple or None
+
+
+class LayerStack:
+    """Composite a stack of layers, caching the flattened result
+    
+    Edits mark a dirty rectangle and only that region is re-blended on the
+    next composite() call. A single opaque layer is returned as-is.
+    """
+    def __init__(self):
+        self.version = 0  # Bumped whenever the whole composite must be rebuilt
+        self.reset()
+    
+    def reset(self):
+        self.layers = [Layer("Background")]
+        self.active = 0
+        self.invalidate()
+    
+    def invalidate(self):
+        self.cache = None
+        self.dirty = None
+        self.version += 1
+    
+    def mark_dirty(self, x0, y0, x1, y1):
+        """Add a rectangle (exclusive end) to the region needing recompositing"""
+        if self.dirty is None:
+            self.dirty = (x0, y0, x1, y1)
+        else:
+            dx0, dy0, dx1, dy1 = self.dirty
+            self.dirty = (min(x0, dx0), min(y0, dy0), max(x1, dx1), max(y1, dy1))
+    
+    def detach(self, array, replacement):
+        """Point any layer sharing array at replacement instead"""
+        for layer in self.layers:
+            if layer.pixels is array:
+                layer.pixels = replacement
+    
+    def layer_pixels(self, index, active_pixels):
+        return active_pixels if index == self.active else self.layers[index].pixels
+    
+    def conform(self, layer, shape):
+        """Crop or pad an inactive layer to the document size"""
+        fill = layer.key if layer.key is not None else (255, 255, 255)
+        pixels = np.empty(shape, dtype=np.uint8)
+        pixels[...] = fill
+        height = min(shape[0], layer.pixels.shape[0])
+        width = min(shape[1], layer.pixels.shape[1])
+        pixels[:height, :width] = layer.pixels[:height, :width]
+        layer.pixels = pixels
+    
+    def composite(self, active_pixels):
+        """Return the flattened image, re-blending only the dirty region"""
+        if len(self.layers) == 1:
+            layer = self.layers[0]
+            if layer.visible and layer.opacity >= 1.0 and layer.key is None:
+                return active_pixels
+        
+        shape = active_pixels.shape
+        for index, layer in enumerate(self.layers):
+            if index != self.active and layer.pixels.shape != shape:
+                self.conform(layer, shape)
+                self.cache = None
+        
+        if self.cache is None or self.cache.shape != shape:
+            self.cache = np.empty(shape, dtype=np.uint8)
+            self.dirty = (0, 0, shape[1], shape[0])
+        
+        if self.dirty is not None:
+            x0, y0, x1, y1 = self.dirty
+            x0, y0 = max(0, x0), max(0, y0)
+            x1, y1 = min(shape[1], x1), min(shape[0], y1)
+            if x1 > x0 and y1 > y0:
+                self.cache[y0:y1, x0:x1] = self.blend(active_pixels, (slice(y0, y1), slice(x0, x1)))
+            self.dirty = None
+        return self.cache
+    
+    def blend(self, active_pixels, region):
+        """Alpha-blend the visible layers over white within a region"""
+        out = None
+        for index, layer in enumerate(self.layers):
+            if not layer.visible or layer.opacity <= 0.0:
+                continue
+            src = self.layer_pixels(index, active_pixels)[region].astype(np.float32)
+            if out is None:
+                out = np.full(src.shape, 255.0, dtype=np.float32)
+            
+            if layer.key is None and layer.opacity >= 1.0:
+                out = src
+                continue
+            alpha = np.full(src.shape[:2], layer.opacity, dtype=np.float32)
+            if layer.key is not None:
+                alpha[(src == layer.key).all(axis=-1)] = 0.0
+            out += (src - out) * alpha[..., None]
+        
+        if out is None:
+            return 255
+        return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+
+
+class VirtualArrayPreview:
+    """Scroll a long C source listing through a small tk.Text window
+    
+    Lines are produced on demand by a get_line(index) callback, and only the
+    lines in view plus a small buffer are ever formatted and inserted into the
+    text widget. The vertical scrollbar is driven from the full line count.
+    """
+    BUFFER_LINES = 20
+    
+    def __init__(self, text, scrollbar):
+        self.text = text
+        self.scrollbar = scrollbar
+        self.line_count = 0
+        self.get_line = lambda index: ""
+        self.top = 0
+        self.rendered = (0, 0)
+        self.highlighted = None
+        self.line_height = max(1, tkfont.Font(font=text["font"]).metrics("linespace"))
+        
+        self.scrollbar.config(command=self.on_scrollbar)
+        self.text.bind("<MouseWheel>", self.on_mouse_wheel)  # Windows and macOS
+        self.text.bind("<Button-4>", self.on_mouse_wheel)    # Linux - scroll up
+        self.text.bind("<Button-5>", self.on_mouse_wheel)    # Linux - scroll down
+        self.text.bind("<Configure>", lambda e: self.render())
+        self.text.tag_configure("highlight", background="#FFFF66")
+    
+    def set_source(self, line_count, get_line):
+        """Show a new listing of line_count lines, starting from the top"""
+        self.line_count = line_count
+        self.get_line = get_line
+        self.top = 0
+        self.highlighted = None
+        self.render(force=True)
+    
+    def visible_lines(self):
+        return max(1, self.text.winfo_height() // self.line_height)
+    
+    def on_scrollbar(self, command, *args):
+        if command == "moveto":
+            self.scroll_to(int(float(args[0]) * self.line_count))
+        elif command == "scroll":
+            amount = int(args[0])
+            if args[1] == "pages":
+                amount *= self.visible_lines()
+            self.scroll_to(self.top + amount)
+    
+    def on_mouse_wheel(self, event):
+        if event.num == 4:
+            delta = 1
+        elif event.num == 5:
+            delta = -1
+        else:
+            delta = event.delta // 120
+        self.scroll_to(self.top - 3 * delta)
+        return "break"
+    
+    def update_source(self, line_count, get_line):
+        """Swap in new contents for the listing, keeping the scroll position"""
+        if line_count != self.line_count:
+            self.highlighted = None
+        self.line_count = line_count
+        self.get_line = get_line
+        self.top = max(0, min(self.top, line_count - self.visible_lines()))
+        self.render(force=True)
+    
+    def scroll_to(self, line):
+        self.top = max(0, min(line, self.line_count - self.visible_lines()))
+        self.render()
+    
+    def render(self, force=False):
+        """Make sure the lines in view are in the text widget and show them"""
+        visible = self.visible_lines()
+        first, last = self.rendered
+        
+        # Only reformat when the view leaves the buffered range
+        if force or self.top < first or min(self.top + visible, self.line_count) > last:
+            first = max(0, self.top - self.BUFFER_LINES)
+            last = min(self.line_count, self.top + visible + self.BUFFER_LINES)
+            self.text.delete("1.0", tk.END)
+            self.text.insert("1.0", "\n".join(self.get_line(i) for i in range(first, last)))
+            self.rendered = (first, last)
+            self.apply_highlight()
+        
+        self.text.yview(f"{self.top - first + 1}.0")
+        if self.line_count:
+            self.scrollbar.set(self.top / self.line_count, min(1.0, (self.top + visible) / self.line_count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+    
+    def apply_highlight(self):
+        self.text.tag_remove("highlight", "1.0", tk.END)
+        if self.highlighted:
+            line, start, end = self.highlighted
+            first, last = self.rendered
+            if first <= line < last:
+                row = line - first + 1
+                self.text.tag_add("highlight", f"{row}.{start}", f"{row}.{end}")
+    
+    def highlight(self, line, start, end):
+        """Highlight columns start..end of a line, scrolling it into view"""
+        self.highlighted = (line, start, end)
+        visible = self.visible_lines()
+        if not self.top <= line < self.top + visible:
+            self.scroll_to(line - visible // 2)
+        self.apply_highlight()
+        self.text.xview(tk.MOVETO, 0.0)
+        self.text.see(f"{line - self.rendered[0] + 1}.{end}")
+    
+    def position_at(self, x, y):
+        """Return the (line, column) of the listing under widget coordinates"""
+        row, column = map(int, self.text.index(f"@{x},{y}").split("."))
+        return self.rendered[0] + row - 1, column
+
 
 class PixelEditorApp:
-    def __init__(self, root):
+    def __init__(self, root, recover=True):
         self.root = root
         self.root.title("Pixel Editor to VGA C Array Converter")
         self.root.geometry("1280x720")
         
         # Image properties
+        self.scratch = None  # Memory-mapped backing for pixel_data, when enabled
+        self.layer_stack = LayerStack()  # The active layer's pixels are always in pixel_data
         self.source_image = None
         self.edited_image = None
         self.pixel_data = None
         self.canvas_image = None
+        self.cell_items = None  # Canvas rectangle id of each editor cell
+        
+        # Selection on the active layer
+        self.selection = None  # (x0, y0, x1, y1) with exclusive ends; may lie partly off the image
+        self.selection_mask = None  # Which pixels inside the selection rectangle are selected
+        self.floating = None  # (pixels, base) while the selection is moved or transformed
+        self.clipboard = None  # (pixels, mask)
+        self.drag_start = None
+        
+        # Stroke and shape tool state
+        self.last_point = None  # Previous pen position, so fast strokes can be joined up
+        self.shape_start = None
+        self.shape_preview = None  # Mask of the cells showing the rubber-band preview
+        
+        # Animation frames (the pixel data of the frame being edited is pixel_data)
+        self.frames = []
+        self.current_frame = 0
         
         # Editor settings
         self.cell_size = 16  # Size of each pixel in the editor
@@ -24,10 +1279,57 @@ class PixelEditorApp:
         self.current_color = "#FF0000"  # Default color (red)
         self.editor_zoom = 1.0  # Initial zoom level
         
+        # Transparency settings
+        self.transparent_color = None  # Key color marking transparent pixels
+        self.alpha_threshold = 128  # Alpha below this becomes the key color on import
+        
+        # Export orientation and scan order
+        self.export_rotation = tk.IntVar(value=0)
+        self.export_mirror_h = tk.BooleanVar(value=False)
+        self.export_mirror_v = tk.BooleanVar(value=False)
+        self.export_scan = tk.StringVar(value="row")
+        self.export_tile_width = tk.IntVar(value=8)
+        self.export_tile_height = tk.IntVar(value=8)
+        self.export_bits = tk.IntVar(value=4)  # Bits per pixel for indexed formats
+        self.export_mip_levels = tk.IntVar(value=0)  # Mipmap chain length, 0 = down to 1x1
+        
+        # Filter used to shrink images on import
+        self.downscale_method = tk.StringVar(value="Lanczos")
+        
+        # Color reduction applied on import when "Reduce colors" is ticked
+        self.reduce_count = tk.IntVar(value=16)
+        self.quantizer = tk.StringVar(value="Median Cut")
+        
+        # Lookup table that snaps colors to the palette while it is locked
+        self.palette_lut = PaletteLUT()
+        
+        # Worker processes for converting very large images, started on first use
+        self.converter = None
+        
         # VGA specific settings
         self.max_width = 320
         self.max_height = 240
         
+        # Native project file and autosave
+        self.project = None
+        self.project_saves = []  # Log of explicit saves, stored in the "saves" chunk
+        self.project_lock = threading.Lock()
+        self.autosave_interval = 60000  # Milliseconds between autosaves
+        self.autosave_after = None
+        self.autosave_running = False
+        self.autosave_failures = 0  # Consecutive failures; each one doubles the retry interval
+        
+        # Input trace recorder, set while recording
+        self.trace_recorder = None
+        
+        # Profiling HUD overlay, shown while profiling is on
+        self.hud_label = None
+        self.hud_after = None
+        self.hud_interval = 250  # Milliseconds between refreshes
+        
+        # Pending idle callback that redraws the preview after painting
+        self.preview_after = None
+        
         # Create UI components
         self.create_menu()
         self.create_toolbar()
@@ -39,6 +1341,112 @@ class PixelEditorApp:
         # Initialize with an empty editor
         self.new_image()
         
+        # Offer to recover the working buffer of a session that crashed
+        self.root.protocol("WM_DELETE_WINDOW", self.on_exit)
+        if recover:
+            self.check_scratch_recovery()
+    
+    @property
+    def pixel_data(self):
+        return self._pixel_data
+    
+    @pixel_data.setter
+    def pixel_data(self, value):
+        # With a crash-safe buffer, every new working image is copied into the scratch file
+        if self.scratch is not None and value is not None and value is not self._pixel_data:
+            # Frames and layers still holding the old mapped buffer need their own copy before it is reused
+            old = self._pixel_data
+            if old is not None:
+                copy = np.array(old)
+                self.frames = [copy if frame is old else frame for frame in self.frames]
+                self.layer_stack.detach(old, copy)
+            value = self.scratch.store(value)
+        self._pixel_data = value
+        self.layer_stack.invalidate()
+        
+        # A different buffer means a different document, frame or layer
+        self.selection = None
+        self.floating = None
+    
+    def check_scratch_recovery(self):
+        """Restore the pixels left in a scratch file by a crashed session
+        
+        Only files whose editor process is no longer running are offered, so
+        a second editor never touches the buffer of one that is still open.
+        """
+        for leftover in find_leftovers():
+            width, height, _ = read_header(leftover)
+            if messagebox.askyesno("Restore Work",
+                                   f"A {width}x{height} image from a previous session that did not exit "
+                                   "cleanly was found. Would you like to restore it?"):
+                break
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+        else:
+            return
+        
+        scratch = ScratchBuffer()
+        try:
+            pixels = scratch.restore(leftover)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to restore image: {str(e)}")
+            return
+        
+        self.scratch = scratch
+        self.layer_stack.reset()
+        self._pixel_data = pixels
+        self.frames = [pixels]
+        self.current_frame = 0
+        self.refresh_layer_list()
+        self.scratch_var.set(True)
+        
+        self.editor_width = width
+        self.editor_height = height
+        self.width_var.set(str(width))
+        self.height_var.set(str(height))
+        self.edited_image = Image.fromarray(np.array(pixels))
+        self.setup_canvas()
+        self.draw_editor()
+        self.update_preview()
+    
+    def toggle_scratch_buffer(self):
+        """Move the working buffer into or out of a memory-mapped scratch file"""
+        if self.scratch_var.get():
+            try:
+                self.scratch = ScratchBuffer()
+                current = self._pixel_data
+                self._pixel_data = None
+                self.pixel_data = current
+                self.frames = [self.pixel_data if frame is current else frame for frame in self.frames]
+            except Exception as e:
+                self.scratch = None
+                self._pixel_data = current
+                self.scratch_var.set(False)
+                messagebox.showerror("Error", f"Failed to create scratch file: {str(e)}")
+        elif self.scratch is not None:
+            mapped = self._pixel_data
+            self._pixel_data = np.array(mapped)
+            self.frames = [self._pixel_data if frame is mapped else frame for frame in self.frames]
+            self.scratch.discard()
+            self.scratch = None
+    
+    def on_exit(self):
+        """Shut down cleanly, removing the scratch file"""
+        if self.scratch is not None:
+            self.scratch.discard()
+        if self.converter is not None:
+            self.converter.shutdown()
+        self.root.quit()
+    
+    def large_converter(self):
+        """Return the converter that splits very large images across processes"""
+        if self.converter is None:
+            from parallel_convert import ParallelConverter
+            self.converter = ParallelConverter()
+        return self.converter
+    
     def open_image(self):
         """Open an image file and load it into the editor"""
         file_path = filedialog.askopenfilename(
@@ -54,6 +1462,14 @@ class PixelEditorApp:
                 # Open the image with PIL
                 img = Image.open(file_path)
                 
+                # Offer to stream in every frame of an animation
+                if getattr(img, "n_frames", 1) > 1:
+                    if messagebox.askyesno("Animated Image",
+                                          f"This image has {img.n_frames} frames. "
+                                          "Would you like to import all of them?"):
+                        self.import_animation(file_path)
+                        return
+                
                 # Ask if user wants to resize the image
                 if img.width > self.max_width or img.height > self.max_height:
                     if messagebox.askyesno("Resize Image", 
@@ -63,7 +1479,7 @@ class PixelEditorApp:
                         ratio = min(self.max_width / img.width, self.max_height / img.height)
                         new_width = int(img.width * ratio)
                         new_height = int(img.height * ratio)
-                        img = img.resize((new_width, new_height), Image.LANCZOS)
+                        img = resize_image(img, new_width, new_height, self.downscale_method.get())
                 
                 # Update dimensions
                 self.editor_width = img.width
@@ -71,13 +1487,25 @@ class PixelEditorApp:
                 self.width_var.set(str(self.editor_width))
                 self.height_var.set(str(self.editor_height))
                 
+                # Keep transparent areas by replacing them with the key color
+                if has_alpha(img):
+                    if self.transparent_color is None:
+                        self.transparent_color = "#FF00FF"
+                    pixel_data = convert_frame(img, img.width, img.height, key=self.transparent_key(),
+                                               alpha_threshold=self.alpha_threshold)
+                    img = Image.fromarray(pixel_data)
+                
                 # Convert to RGB mode if needed
                 if img.mode != "RGB":
                     img = img.convert("RGB")
                 
                 # Update the image and pixel data
                 self.edited_image = img
-                self.pixel_data = np.array(img)
+                self.layer_stack.reset()
+                self.refresh_layer_list()
+                self.pixel_data = self.snap_pixels(np.array(img))
+                self.frames = [self.pixel_data]
+                self.current_frame = 0
                 
                 # Reset canvas and redraw
                 self.setup_canvas()
@@ -87,42 +1515,104 @@ class PixelEditorApp:
                 # Ask if user wants to also use this as a reference image
                 if messagebox.askyesno("Reference Image", 
                                       "Would you like to also use this image as a reference?"):
-                    self.reference_image = img.copy()
-                    self.display_reference()
+                    self.set_reference(img.copy())
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to open image: {str(e)}")
         
+    def add_menu_command(self, menu, label, command):
+        """Add a menu entry that input traces can record and replay by label"""
+        self.menu_commands[label] = command
+        
+        def run():
+            if self.trace_recorder is not None:
+                self.trace_recorder.record_command(label)
+            command()
+        
+        menu.add_command(label=label, command=run)
+    
     def create_menu(self):
         menubar = tk.Menu(self.root)
+        self.menu_commands = {}
         
         # File menu
         file_menu = tk.Menu(menubar, tearoff=0)
-        file_menu.add_command(label="New", command=self.new_image)
-        file_menu.add_command(label="Open Image", command=self.open_image)
-        file_menu.add_command(label="Load Reference", command=self.load_reference)
+        self.add_menu_command(file_menu, "New", self.new_image)
+        self.add_menu_command(file_menu, "Open Image", self.open_image)
+        self.add_menu_command(file_menu, "Load Reference", self.load_reference)
+        self.add_menu_command(file_menu, "Import Animation / Sprite Sheet", self.import_animation)
+        file_menu.add_separator()
+        self.add_menu_command(file_menu, "Open Project", self.open_project)
+        self.add_menu_command(file_menu, "Save Project", self.save_project)
+        self.add_menu_command(file_menu, "Save Project As", self.save_project_as)
+        self.autosave_var = tk.BooleanVar(value=False)
+        file_menu.add_checkbutton(label="Autosave Project", variable=self.autosave_var, command=self.toggle_autosave)
         file_menu.add_separator()
-        file_menu.add_command(label="Import C Array", command=self.import_c_array)
-        file_menu.add_command(label="Save C Array", command=self.save_c_array)
+        self.add_menu_command(file_menu, "Import C Array", self.import_c_array)
+        self.add_menu_command(file_menu, "Import from Binary...", self.import_binary)
+        self.add_menu_command(file_menu, "Save C Array", self.save_c_array)
+        self.add_menu_command(file_menu, "Export Options...", self.export_options)
+        self.add_menu_command(file_menu, "Memory Budget Report...", self.budget_report)
         file_menu.add_separator()
-        file_menu.add_command(label="Exit", command=self.root.quit)
+        self.scratch_var = tk.BooleanVar(value=False)
+        file_menu.add_checkbutton(label="Crash-Safe Working Buffer", variable=self.scratch_var,
+                                  command=self.toggle_scratch_buffer)
+        file_menu.add_separator()
+        self.add_menu_command(file_menu, "Exit", self.on_exit)
         menubar.add_cascade(label="File", menu=file_menu)
         
         # Edit menu
         edit_menu = tk.Menu(menubar, tearoff=0)
-        edit_menu.add_command(label="Clear All", command=self.clear_all)
-        edit_menu.add_command(label="Choose Color", command=self.choose_color)
+        self.add_menu_command(edit_menu, "Clear All", self.clear_all)
+        self.add_menu_command(edit_menu, "Choose Color", self.choose_color)
+        edit_menu.add_separator()
+        self.add_menu_command(edit_menu, "Select All", self.select_all)
+        self.add_menu_command(edit_menu, "Deselect", self.deselect)
+        self.add_menu_command(edit_menu, "Copy", self.copy_selection)
+        self.add_menu_command(edit_menu, "Cut", self.cut_selection)
+        self.add_menu_command(edit_menu, "Paste", self.paste)
+        self.add_menu_command(edit_menu, "Delete Selection", self.delete_selection)
+        edit_menu.add_separator()
+        self.add_menu_command(edit_menu, "Flip Horizontal", lambda: self.flip_selection(1))
+        self.add_menu_command(edit_menu, "Flip Vertical", lambda: self.flip_selection(0))
+        self.add_menu_command(edit_menu, "Rotate 90° Clockwise", self.rotate_selection)
+        self.add_menu_command(edit_menu, "Scale Selection...", self.scale_selection)
+        edit_menu.add_separator()
+        self.add_menu_command(edit_menu, "Set Transparent Color", self.set_transparent_color)
+        self.add_menu_command(edit_menu, "Clear Transparent Color", self.clear_transparent_color)
+        self.add_menu_command(edit_menu, "Alpha Threshold...", self.set_alpha_threshold)
+        edit_menu.add_separator()
+        self.palette_lock_var = tk.BooleanVar(value=False)
+        edit_menu.add_checkbutton(label="Lock to Palette", variable=self.palette_lock_var,
+                                  command=self.toggle_palette_lock)
+        self.palette_lock_var.trace_add("write", lambda *args: self.load_palette_lut())
+        self.add_menu_command(edit_menu, "Reduce Colors...", self.reduce_image_colors)
         menubar.add_cascade(label="Edit", menu=edit_menu)
         
         # View menu
         view_menu = tk.Menu(menubar, tearoff=0)
-        view_menu.add_command(label="Zoom In", command=lambda: self.set_zoom(self.editor_zoom * 1.2))
-        view_menu.add_command(label="Zoom Out", command=lambda: self.set_zoom(self.editor_zoom * 0.8))
-        view_menu.add_command(label="Reset Zoom", command=lambda: self.set_zoom(1.0))
+        self.add_menu_command(view_menu, "Zoom In", lambda: self.set_zoom(self.editor_zoom * 1.2))
+        self.add_menu_command(view_menu, "Zoom Out", lambda: self.set_zoom(self.editor_zoom * 0.8))
+        self.add_menu_command(view_menu, "Reset Zoom", lambda: self.set_zoom(1.0))
+        view_menu.add_separator()
+        self.add_menu_command(view_menu, "Previous Frame", lambda: self.show_frame(self.current_frame - 1))
+        self.add_menu_command(view_menu, "Next Frame", lambda: self.show_frame(self.current_frame + 1))
+        view_menu.add_separator()
+        self.add_menu_command(view_menu, "Show Grid", self.toggle_grid)
+        self.add_menu_command(view_menu, "Color Usage...", self.color_usage)
         view_menu.add_separator()
-        view_menu.add_command(label="Show Grid", command=self.toggle_grid)
+        self.profiling_var = tk.BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Profiling HUD", variable=self.profiling_var, command=self.toggle_profiling)
         menubar.add_cascade(label="View", menu=view_menu)
         
+        # Tools menu
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        self.add_menu_command(tools_menu, "Start Trace Recording", self.start_trace_recording)
+        self.add_menu_command(tools_menu, "Stop Trace Recording...", self.stop_trace_recording)
+        tools_menu.add_separator()
+        self.add_menu_command(tools_menu, "Dump Profile Trace...", self.dump_profile_trace)
+        menubar.add_cascade(label="Tools", menu=tools_menu)
+        
         self.root.config(menu=menubar)
     
     def create_toolbar(self):
@@ -151,6 +1641,13 @@ class PixelEditorApp:
         ttk.Radiobutton(toolbar_frame, text="Pen", variable=self.tool_var, value="pen").pack(side=tk.LEFT, padx=5)
         ttk.Radiobutton(toolbar_frame, text="Fill", variable=self.tool_var, value="fill").pack(side=tk.LEFT, padx=5)
         ttk.Radiobutton(toolbar_frame, text="Picker", variable=self.tool_var, value="picker").pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(toolbar_frame, text="Line", variable=self.tool_var, value="line").pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(toolbar_frame, text="Rect", variable=self.tool_var, value="rect").pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(toolbar_frame, text="Ellipse", variable=self.tool_var, value="ellipse").pack(side=tk.LEFT, padx=5)
+        self.fill_shapes_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(toolbar_frame, text="Filled", variable=self.fill_shapes_var).pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(toolbar_frame, text="Select", variable=self.tool_var, value="select").pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(toolbar_frame, text="Wand", variable=self.tool_var, value="wand").pack(side=tk.LEFT, padx=5)
         
         ttk.Label(toolbar_frame, text="(You can also pick colors directly from the reference image)").pack(side=tk.LEFT, padx=5)
         
@@ -166,6 +1663,12 @@ class PixelEditorApp:
         # C Array preview button
         ttk.Button(toolbar_frame, text="Preview C Array", command=self.show_c_array).pack(side=tk.RIGHT, padx=5)
         
+        # Export format
+        self.export_format_var = tk.StringVar(value="Array")
+        ttk.Combobox(toolbar_frame, textvariable=self.export_format_var, values=EXPORT_FORMATS,
+                     state="readonly", width=11).pack(side=tk.RIGHT, padx=2)
+        ttk.Label(toolbar_frame, text="Format:").pack(side=tk.RIGHT, padx=2)
+        
         # Variable name entry for the C array
         ttk.Label(toolbar_frame, text="Variable Name:").pack(side=tk.RIGHT, padx=2)
         self.var_name = tk.StringVar(value="pixel_data")
@@ -196,6 +1699,18 @@ class PixelEditorApp:
         ttk.Button(ref_controls, text="Clear Reference", command=self.clear_reference).pack(side=tk.LEFT, padx=5)
         ttk.Button(ref_controls, text="Import to Editor", command=self.import_to_editor).pack(side=tk.LEFT, padx=5)
         
+        # Onion skin controls
+        onion_controls = ttk.Frame(reference_frame)
+        onion_controls.pack(fill=tk.X, pady=(0, 5))
+        
+        self.onion_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(onion_controls, text="Onion Skin in Editor", variable=self.onion_var,
+                        command=self.draw_editor).pack(side=tk.LEFT, padx=5)
+        ttk.Label(onion_controls, text="Opacity:").pack(side=tk.LEFT, padx=(10, 0))
+        self.onion_opacity_var = tk.IntVar(value=40)
+        tk.Scale(onion_controls, from_=0, to=100, orient=tk.HORIZONTAL, showvalue=False, length=100,
+                 variable=self.onion_opacity_var, command=self.set_onion_opacity).pack(side=tk.LEFT)
+        
         # Reference canvas events for color picking
         self.reference_canvas.bind("<Button-1>", self.on_reference_click)
         
@@ -222,10 +1737,24 @@ class PixelEditorApp:
         # Canvas events
         self.canvas.bind("<Button-1>", self.on_canvas_click)
         self.canvas.bind("<B1-Motion>", self.on_canvas_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
         self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # Windows and macOS
         self.canvas.bind("<Button-4>", self.on_mouse_wheel)    # Linux - scroll up
         self.canvas.bind("<Button-5>", self.on_mouse_wheel)    # Linux - scroll down
         
+        # Selection keys, active once the canvas has been clicked
+        self.canvas.bind("<Control-c>", lambda e: self.copy_selection())
+        self.canvas.bind("<Control-x>", lambda e: self.cut_selection())
+        self.canvas.bind("<Control-v>", lambda e: self.paste())
+        self.canvas.bind("<Control-a>", lambda e: self.select_all())
+        self.canvas.bind("<Delete>", lambda e: self.delete_selection())
+        self.canvas.bind("<Escape>", lambda e: self.deselect())
+        self.canvas.bind("<Return>", lambda e: self.commit_selection())
+        self.canvas.bind("<Left>", lambda e: self.nudge_selection(-1, 0))
+        self.canvas.bind("<Right>", lambda e: self.nudge_selection(1, 0))
+        self.canvas.bind("<Up>", lambda e: self.nudge_selection(0, -1))
+        self.canvas.bind("<Down>", lambda e: self.nudge_selection(0, 1))
+        
         # Right panel - Tools and Preview
         right_panel = ttk.Frame(main_frame)
         right_panel.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
@@ -234,10 +1763,52 @@ class PixelEditorApp:
         palette_frame = ttk.LabelFrame(right_panel, text="Color Palette")
         palette_frame.pack(fill=tk.X, pady=5)
         
-        self.palette_canvas = tk.Canvas(palette_frame, height=100, bg="white")
+        palette_scroll = ttk.Scrollbar(palette_frame, orient=tk.VERTICAL)
+        palette_scroll.pack(side=tk.RIGHT, fill=tk.Y, pady=5)
+        self.palette_canvas = tk.Canvas(palette_frame, height=100, bg="white", highlightthickness=0,
+                                        yscrollcommand=palette_scroll.set)
         self.palette_canvas.pack(fill=tk.X, padx=5, pady=5)
+        palette_scroll.config(command=self.palette_canvas.yview)
         self.palette_canvas.bind("<Button-1>", self.on_palette_click)
         
+        # The swatches are one cached image, redrawn only when the panel width changes
+        self.palette_canvas.bind("<Configure>", lambda e: self.draw_palette())
+        self.palette_photo = None
+        self.palette_layout = None  # (key, columns, swatch size) of the cached image
+        
+        ttk.Button(palette_frame, text="RGB565 Picker...", command=self.rgb565_picker).pack(anchor=tk.W, padx=5,
+                                                                                           pady=(0, 5))
+        
+        # Layers
+        layer_frame = ttk.LabelFrame(right_panel, text="Layers")
+        layer_frame.pack(fill=tk.X, pady=5)
+        
+        self.layer_list = tk.Listbox(layer_frame, height=4, exportselection=False)
+        self.layer_list.pack(fill=tk.X, padx=5, pady=5)
+        self.layer_list.bind("<<ListboxSelect>>", self.on_layer_select)
+        
+        layer_buttons = ttk.Frame(layer_frame)
+        layer_buttons.pack(fill=tk.X, padx=5)
+        ttk.Button(layer_buttons, text="Add", width=6, command=self.add_layer).pack(side=tk.LEFT)
+        ttk.Button(layer_buttons, text="Delete", width=6, command=self.delete_layer).pack(side=tk.LEFT)
+        ttk.Button(layer_buttons, text="Up", width=4, command=lambda: self.move_layer(1)).pack(side=tk.LEFT)
+        ttk.Button(layer_buttons, text="Down", width=5, command=lambda: self.move_layer(-1)).pack(side=tk.LEFT)
+        
+        layer_options = ttk.Frame(layer_frame)
+        layer_options.pack(fill=tk.X, padx=5, pady=5)
+        self.layer_visible_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(layer_options, text="Visible", variable=self.layer_visible_var,
+                        command=self.toggle_layer_visible).pack(side=tk.LEFT)
+        ttk.Label(layer_options, text="Opacity:").pack(side=tk.LEFT, padx=(10, 0))
+        self.layer_opacity_var = tk.IntVar(value=100)
+        tk.Scale(layer_options, from_=0, to=100, orient=tk.HORIZONTAL, showvalue=False, length=80,
+                 variable=self.layer_opacity_var, command=self.set_layer_opacity).pack(side=tk.LEFT)
+        
+        layer_key = ttk.Frame(layer_frame)
+        layer_key.pack(fill=tk.X, padx=5, pady=(0, 5))
+        ttk.Button(layer_key, text="Key = Current Color", command=self.set_layer_key).pack(side=tk.LEFT)
+        ttk.Button(layer_key, text="Clear Key", command=self.clear_layer_key).pack(side=tk.LEFT)
+        
         # VGA Preview
         preview_frame = ttk.LabelFrame(right_panel, text="VGA Preview")
         preview_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -256,9 +1827,12 @@ class PixelEditorApp:
         self.array_text = tk.Text(array_text_frame, height=10, wrap=tk.NONE, font=("Courier", 10))
         self.array_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
-        array_y_scroll = ttk.Scrollbar(array_text_frame, orient=tk.VERTICAL, command=self.array_text.yview)
+        # The vertical scrollbar is driven by the virtualized preview, not the text widget
+        array_y_scroll = ttk.Scrollbar(array_text_frame, orient=tk.VERTICAL)
         array_y_scroll.pack(side=tk.RIGHT, fill=tk.Y)
-        self.array_text.config(yscrollcommand=array_y_scroll.set)
+        self.array_preview = VirtualArrayPreview(self.array_text, array_y_scroll)
+        self.array_text.bind("<ButtonRelease-1>", self.on_array_text_click)
+        self.preview_map = None  # Maps preview elements back to pixels
         
         array_x_scroll = ttk.Scrollbar(self.array_frame, orient=tk.HORIZONTAL, command=self.array_text.xview)
         array_x_scroll.pack(side=tk.BOTTOM, fill=tk.X)
@@ -267,6 +1841,10 @@ class PixelEditorApp:
         # Initialize reference image
         self.reference_image = None
         self.reference_photo = None
+        
+        # Onion skin: the reference resampled to the document grid, and its blend with the image
+        self.onion_underlay = None  # (key, pixels as float32)
+        self.onion_blend = None  # (key, blended uint8 pixels)
     
     def init_color_palette(self):
         # Define a set of predefined colors for the palette
@@ -288,31 +1866,29 @@ class PixelEditorApp:
         # Draw the palette
         self.draw_palette()
     
+    @profiled("stage")
     def draw_palette(self):
-        self.palette_canvas.delete("all")
-        
         # Calculate the size and arrangement of color swatches
         palette_width = self.palette_canvas.winfo_width()
         if palette_width < 10:  # Not yet sized properly
             palette_width = 300  # Default width
-            
-        swatch_size = 20
+        
+        # Large palettes get smaller swatches so more of them fit
+        swatch_size = 20 if len(self.palette_colors) <= 64 else 12
         swatches_per_row = max(1, palette_width // swatch_size)
         
-        # Draw each color swatch
-        for i, color in enumerate(self.palette_colors):
-            row = i // swatches_per_row
-            col = i % swatches_per_row
-            x1 = col * swatch_size
-            y1 = row * swatch_size
-            x2 = x1 + swatch_size
-            y2 = y1 + swatch_size
-            
-            self.palette_canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="black", tags=("palette", color))
+        key = (tuple(self.palette_colors), swatches_per_row, swatch_size)
+        if self.palette_layout is not None and self.palette_layout[0] == key:
+            return
+        self.palette_layout = (key, swatches_per_row, swatch_size)
+        
+        image = render_swatches(palette_array(self.palette_colors), swatches_per_row, swatch_size)
+        self.palette_photo = ImageTk.PhotoImage(Image.fromarray(image))
+        self.palette_canvas.delete("all")
+        self.palette_canvas.create_image(0, 0, anchor=tk.NW, image=self.palette_photo)
         
         # Update canvas size for scrolling
-        rows_needed = (len(self.palette_colors) + swatches_per_row - 1) // swatches_per_row
-        self.palette_canvas.config(height=min(100, rows_needed * swatch_size))
+        self.palette_canvas.config(height=min(100, image.shape[0]), scrollregion=(0, 0, image.shape[1], image.shape[0]))
     
     def new_image(self):
         # Initialize a blank image with white pixels
@@ -320,7 +1896,11 @@ class PixelEditorApp:
         self.editor_height = int(self.height_var.get())
         
         # Create a blank pixel data array (filled with white)
+        self.layer_stack.reset()
+        self.refresh_layer_list()
         self.pixel_data = np.ones((self.editor_height, self.editor_width, 3), dtype=np.uint8) * 255
+        self.frames = [self.pixel_data]
+        self.current_frame = 0
         
         # Create a PIL Image from the pixel data
         self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
@@ -337,17 +1917,20 @@ class PixelEditorApp:
         
         self.canvas.config(scrollregion=(0, 0, canvas_width, canvas_height))
     
+    @profiled("stage")
     def draw_editor(self):
         self.canvas.delete("all")
         
         # Calculate cell size with zoom factor
         cell_size = int(self.cell_size * self.editor_zoom)
         
-        # Draw each pixel from the data
+        # Draw each pixel of the flattened layers
+        display = self.display_pixels()
+        self.cell_items = np.zeros((self.editor_height, self.editor_width), dtype=np.int64)
         for y in range(self.editor_height):
             for x in range(self.editor_width):
                 # Get the RGB values from the pixel data
-                r, g, b = self.pixel_data[y, x]
+                r, g, b = display[y, x]
                 color = f"#{r:02x}{g:02x}{b:02x}"
                 
                 # Create a rectangle for this pixel
@@ -357,12 +1940,16 @@ class PixelEditorApp:
                 y2 = y1 + cell_size
                 
                 # Draw the filled rectangle
-                self.canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="", tags=("pixel", f"{x},{y}"))
+                self.cell_items[y, x] = self.canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="",
+                                                                     tags=("pixel", f"{x},{y}"))
         
         # Draw grid if enabled
         if self.show_grid_var.get():
             self.draw_grid()
+        
+        self.draw_selection()
     
+    @profiled("stage")
     def draw_grid(self):
         cell_size = int(self.cell_size * self.editor_zoom)
         width = self.editor_width * cell_size
@@ -376,9 +1963,75 @@ class PixelEditorApp:
         for y in range(0, height + 1, cell_size):
             self.canvas.create_line(0, y, width, y, fill="#cccccc", tags="grid")
     
+    def onion_pixels(self):
+        """Return the reference resampled to the document grid, or None if the onion skin is off"""
+        if not self.onion_var.get() or self.reference_image is None:
+            return None
+        # set_reference drops the cache, so the key only covers what can change under one reference
+        key = (self.editor_width, self.editor_height, self.downscale_method.get())
+        if self.onion_underlay is None or self.onion_underlay[0] != key:
+            # The same conversion as Import to Editor, so the underlay lines up with an import
+            pixels = convert_frame(self.reference_image, self.editor_width, self.editor_height,
+                                   method=self.downscale_method.get())
+            self.onion_underlay = (key, pixels.astype(np.float32))
+        return self.onion_underlay[1]
+    
+    def display_pixels(self):
+        """Return the colors shown in the editor: the composite, with the onion skin blended in
+        
+        The blend is cached, so redrawing at another zoom level reuses it.
+        """
+        composite = self.composite()
+        underlay = self.onion_pixels()
+        if underlay is None:
+            return composite
+        
+        opacity = self.onion_opacity_var.get() / 100.0
+        key = (self.onion_underlay[0], self.layer_stack.version, opacity)
+        if self.onion_blend is None or self.onion_blend[0] != key:
+            blended = composite + (underlay - composite) * opacity
+            self.onion_blend = (key, np.rint(blended).astype(np.uint8))
+        return self.onion_blend[1]
+    
+    def refresh_display(self, x0, y0, x1, y1):
+        """Recomposite a region after an edit to the active layer and return its display colors
+        
+        Only the region is re-blended, both for the layers and the onion skin.
+        """
+        self.layer_stack.mark_dirty(x0, y0, x1, y1)
+        region = self.composite()[y0:y1, x0:x1]
+        underlay = self.onion_pixels()
+        if underlay is None:
+            return region
+        
+        opacity = self.onion_opacity_var.get() / 100.0
+        blended = region + (underlay[y0:y1, x0:x1] - region) * opacity
+        blended = np.rint(blended).astype(np.uint8)
+        if self.onion_blend is not None:
+            self.onion_blend[1][y0:y1, x0:x1] = blended
+        return blended
+    
+    @profiled("stage")
+    def refresh_cells(self, x0, y0, x1, y1):
+        """Recolor the editor cells in a region in place, without redrawing the canvas"""
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(self.editor_width, x1), min(self.editor_height, y1)
+        if x1 <= x0 or y1 <= y0:
+            return
+        colors = self.refresh_display(x0, y0, x1, y1)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                r, g, b = colors[y - y0, x - x0]
+                self.canvas.itemconfig(int(self.cell_items[y, x]), fill=f"#{r:02x}{g:02x}{b:02x}")
+    
+    def set_onion_opacity(self, value):
+        if self.onion_var.get() and self.reference_image is not None:
+            self.draw_editor()
+    
     def toggle_grid(self):
         self.draw_editor()
     
+    @profiled("handler")
     def set_zoom(self, zoom_level):
         # Limit zoom to reasonable values
         zoom_level = max(0.1, min(5.0, zoom_level))
@@ -387,6 +2040,7 @@ class PixelEditorApp:
         self.setup_canvas()
         self.draw_editor()
     
+    @profiled("handler")
     def on_mouse_wheel(self, event):
         # Handle mouse wheel for zooming
         delta = 0
@@ -403,6 +2057,7 @@ class PixelEditorApp:
         new_zoom = self.editor_zoom * (1.1 if delta > 0 else 0.9)
         self.set_zoom(new_zoom)
     
+    @profiled("handler")
     def on_canvas_click(self, event):
         # Get mouse coordinates
         canvas_x = self.canvas.canvasx(event.x)
@@ -413,94 +2068,157 @@ class PixelEditorApp:
         x = int(canvas_x // cell_size)
         y = int(canvas_y // cell_size)
         
+        # Take keyboard focus for the selection shortcuts
+        self.canvas.focus_set()
+        
         # Check bounds
         if 0 <= x < self.editor_width and 0 <= y < self.editor_height:
             tool = self.tool_var.get()
+            if tool not in ("select", "wand"):
+                self.commit_selection()
             
             if tool == "pen":
                 self.set_pixel(x, y)
+                self.last_point = (x, y)
+            elif tool in ("line", "rect", "ellipse"):
+                self.shape_start = (x, y)
+                self.preview_shape(x, y)
             elif tool == "fill":
                 self.fill_area(x, y)
             elif tool == "picker":
                 self.pick_color(x, y)
-    
-    def on_canvas_drag(self, event):
-        # Only respond to drag if the pen tool is active
-        if self.tool_var.get() == "pen":
-            # Get mouse coordinates
-            canvas_x = self.canvas.canvasx(event.x)
-            canvas_y = self.canvas.canvasy(event.y)
+            elif tool == "select":
+                self.start_selection_drag(x, y)
+            elif tool == "wand":
+                self.wand_select(x, y)
             
-            # Calculate pixel coordinates
-            cell_size = int(self.cell_size * self.editor_zoom)
-            x = int(canvas_x // cell_size)
-            y = int(canvas_y // cell_size)
-            
-            # Check bounds
-            if 0 <= x < self.editor_width and 0 <= y < self.editor_height:
-                self.set_pixel(x, y)
+            # Follow the selected pixel in the C array preview
+            self.select_preview_element(x, y)
     
-    def on_palette_click(self, event):
+    @profiled("handler")
+    def on_canvas_drag(self, event):
         # Get mouse coordinates
-        x = event.x
-        y = event.y
-        
-        # Get color from palette canvas
-        items = self.palette_canvas.find_overlapping(x, y, x, y)
-        if items:
-            tags = self.palette_canvas.gettags(items[0])
-            for tag in tags:
-                if tag.startswith("#"):
-                    self.current_color = tag
-                    self.color_preview.config(bg=self.current_color)
-                    break
-    
-    def set_pixel(self, x, y):
-        # Parse the current color to RGB values
-        hex_color = self.current_color.lstrip('#')
-        r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-        
-        # Ensure RGB values are in the correct range
-        r = max(0, min(255, r))
-        g = max(0, min(255, g))
-        b = max(0, min(255, b))
-        
-        # Update the pixel data
-        self.pixel_data[y, x] = [r, g, b]
+        canvas_x = self.canvas.canvasx(event.x)
+        canvas_y = self.canvas.canvasy(event.y)
         
-        # Calculate cell position in canvas
+        # Calculate pixel coordinates; they may be off the image while dragging
         cell_size = int(self.cell_size * self.editor_zoom)
-        x1 = x * cell_size
-        y1 = y * cell_size
-        x2 = x1 + cell_size
-        y2 = y1 + cell_size
+        x = int(canvas_x // cell_size)
+        y = int(canvas_y // cell_size)
         
-        # Update the canvas pixel
-        self.canvas.delete(f"pixel && {x},{y}")
-        self.canvas.create_rectangle(x1, y1, x2, y2, fill=self.current_color, outline="", tags=("pixel", f"{x},{y}"))
+        tool = self.tool_var.get()
+        if tool == "select" and self.drag_start is not None:
+            self.drag_selection(x, y)
+        elif tool == "pen":
+            # Join up to the previous position so fast strokes have no gaps
+            if self.last_point is None:
+                if 0 <= x < self.editor_width and 0 <= y < self.editor_height:
+                    self.set_pixel(x, y)
+                    self.last_point = (x, y)
+            elif (x, y) != self.last_point:
+                xs, ys = line_points(*self.last_point, x, y)
+                xs, ys = xs[1:], ys[1:]
+                inside = (xs >= 0) & (xs < self.editor_width) & (ys >= 0) & (ys < self.editor_height)
+                self.paint_points(xs[inside], ys[inside])
+                self.last_point = (x, y)
+        elif tool in ("line", "rect", "ellipse") and self.shape_start is not None:
+            self.preview_shape(x, y)
+    
+    @profiled("handler")
+    def on_canvas_release(self, event):
+        self.last_point = None
+        if self.shape_start is None:
+            return
         
-        # If grid is enabled, redraw the grid lines for this cell
-        if self.show_grid_var.get():
-            self.canvas.create_line(x1, y1, x1, y2, fill="#cccccc", tags="grid")
-            self.canvas.create_line(x1, y1, x2, y1, fill="#cccccc", tags="grid")
-            self.canvas.create_line(x2, y1, x2, y2, fill="#cccccc", tags="grid")
-            self.canvas.create_line(x1, y2, x2, y2, fill="#cccccc", tags="grid")
+        cell_size = int(self.cell_size * self.editor_zoom)
+        x = int(self.canvas.canvasx(event.x) // cell_size)
+        y = int(self.canvas.canvasy(event.y) // cell_size)
+        mask = self.shape_mask(x, y)
+        self.shape_start = None
+        self.clear_shape_preview(mask)
+        self.shape_preview = None
+        self.paint_mask(mask)
+    
+    @profiled("handler")
+    def on_palette_click(self, event):
+        if self.palette_layout is None:
+            return
         
-        # Update the edited image
-        self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
+        # Get mouse coordinates, allowing for the palette being scrolled
+        x = int(self.palette_canvas.canvasx(event.x))
+        y = int(self.palette_canvas.canvasy(event.y))
         
-        # Update the preview
+        # Swatches are on a fixed grid, so the index follows from the position
+        _, columns, swatch_size = self.palette_layout
+        column, row = x // swatch_size, y // swatch_size
+        index = row * columns + column
+        if 0 <= column < columns and 0 <= row and index < len(self.palette_colors):
+            self.current_color = self.snap_color(self.palette_colors[index])
+            self.color_preview.config(bg=self.current_color)
+    
+    def set_pixel(self, x, y):
+        self.paint_points(np.array([x]), np.array([y]))
+    
+    def paint_mask(self, mask):
+        """Paint the current color under a mask, as for shapes and fills"""
+        ys, xs = np.nonzero(mask)
+        self.paint_points(xs, ys)
+    
+    @profiled("stage")
+    def paint_points(self, xs, ys):
+        """Paint the current color at pixel coordinates in one write, then recolor just those cells"""
+        if not len(xs):
+            return
+        self.pixel_data[ys, xs] = hex_to_rgb(self.snap_color(self.current_color))
+        
+        # Composite the bounding box once, but only touch the painted cells on the canvas
+        x0, y0 = int(xs.min()), int(ys.min())
+        colors = self.refresh_display(x0, y0, int(xs.max()) + 1, int(ys.max()) + 1)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            r, g, b = colors[y - y0, x - x0]
+            self.canvas.itemconfig(int(self.cell_items[y, x]), fill=f"#{r:02x}{g:02x}{b:02x}")
+        
+        # A stroke delivers many motion events; redraw the preview once they have been handled
+        if self.preview_after is None:
+            self.preview_after = self.root.after_idle(self.flush_preview)
+    
+    def flush_preview(self):
+        self.preview_after = None
         self.update_preview()
     
+    def shape_mask(self, x, y):
+        """Rasterize the shape being dragged from shape_start to (x, y)"""
+        xs, ys = shape_points(self.tool_var.get(), *self.shape_start, x, y, self.fill_shapes_var.get())
+        return points_mask(xs, ys, self.editor_width, self.editor_height)
+    
+    def preview_shape(self, x, y):
+        """Show the shape as a rubber band by recoloring cells, without touching the pixels"""
+        mask = self.shape_mask(x, y)
+        self.clear_shape_preview(mask)
+        previous = self.shape_preview if self.shape_preview is not None else np.zeros_like(mask)
+        for y, x in zip(*np.nonzero(mask & ~previous)):
+            self.canvas.itemconfig(int(self.cell_items[y, x]), fill=self.current_color)
+        self.shape_preview = mask
+    
+    def clear_shape_preview(self, keep=None):
+        """Restore the cells of the rubber-band preview, except those still under keep"""
+        if self.shape_preview is None:
+            return
+        restore = self.shape_preview if keep is None else self.shape_preview & ~keep
+        display = self.display_pixels()
+        for y, x in zip(*np.nonzero(restore)):
+            r, g, b = display[y, x]
+            self.canvas.itemconfig(int(self.cell_items[y, x]), fill=f"#{r:02x}{g:02x}{b:02x}")
+        self.shape_preview = None if keep is None else self.shape_preview & keep
+    
+    @profiled("stage")
     def fill_area(self, start_x, start_y):
         # Get the color to replace
         orig_r, orig_g, orig_b = self.pixel_data[start_y, start_x]
         orig_color = (orig_r, orig_g, orig_b)
         
         # Parse the new color
-        hex_color = self.current_color.lstrip('#')
-        new_r, new_g, new_b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-        new_color = [new_r, new_g, new_b]
+        new_color = list(hex_to_rgb(self.snap_color(self.current_color)))
         
         # If old and new colors are the same, do nothing
         if orig_color == tuple(new_color):
@@ -532,6 +2250,7 @@ class PixelEditorApp:
             queue.append((x, y-1))
         
         # Redraw the editor
+        self.layer_stack.invalidate()
         self.draw_editor()
         
         # Update the edited image
@@ -540,14 +2259,16 @@ class PixelEditorApp:
         # Update the preview
         self.update_preview()
     
+    @profiled("stage")
     def pick_color(self, x, y):
-        # Get the color from the pixel
-        r, g, b = self.pixel_data[y, x]
+        # Get the color from the pixel as it appears with all layers
+        r, g, b = self.composite()[y, x]
         
         # Ensure RGB values are in the correct range
         r = max(0, min(255, int(r)))
         g = max(0, min(255, int(g)))
         b = max(0, min(255, int(b)))
+        r, g, b = self.snap_rgb(r, g, b)
         
         # Format as hex color
         picked_color = f"#{r:02x}{g:02x}{b:02x}"
@@ -556,39 +2277,648 @@ class PixelEditorApp:
         self.current_color = picked_color
         self.color_preview.config(bg=self.current_color)
         
-        # Calculate 16-bit RGB565 value
-        r5 = (r * 31) // 255
-        g6 = (g * 63) // 255
-        b5 = (b * 31) // 255
-        color16 = (r5 << 11) | (g6 << 5) | b5
+        # Calculate 16-bit RGB565 value
+        r5 = (r * 31) // 255
+        g6 = (g * 63) // 255
+        b5 = (b * 31) // 255
+        color16 = (r5 << 11) | (g6 << 5) | b5
+        
+        # Show color info in title
+        self.root.title(f"Pixel Editor - Color: {picked_color} RGB({r},{g},{b}) VGA: 0x{color16:04X}")
+    
+    def background_color(self):
+        """Return what erased pixels of the active layer become: its key, or white"""
+        layer = self.layer_stack.layers[self.layer_stack.active]
+        return layer.key if layer.key is not None else (255, 255, 255)
+    
+    def draw_selection(self):
+        """Outline the selection on the editor canvas"""
+        self.canvas.delete("selection")
+        if self.selection is None:
+            return
+        cell_size = int(self.cell_size * self.editor_zoom)
+        x0, y0, x1, y1 = self.selection
+        self.canvas.create_rectangle(x0 * cell_size, y0 * cell_size, x1 * cell_size, y1 * cell_size,
+                                     outline="#0000FF", dash=(4, 4), width=2, tags="selection")
+    
+    def set_selection(self, rect, mask=None):
+        """Select a rectangle, or the mask's pixels within it"""
+        self.commit_selection()
+        x0, y0, x1, y1 = rect
+        self.selection = rect
+        self.selection_mask = mask if mask is not None else np.ones((y1 - y0, x1 - x0), dtype=bool)
+        self.draw_selection()
+    
+    def select_all(self):
+        self.set_selection((0, 0, self.editor_width, self.editor_height))
+    
+    def deselect(self):
+        self.commit_selection()
+        self.selection = None
+        self.draw_selection()
+    
+    def commit_selection(self):
+        """Drop a floating selection into the layer; its pixels are already there"""
+        self.floating = None
+        self.drag_start = None
+        
+        # Keep only the part of the selection that landed on the image
+        if self.selection is not None:
+            x0, y0, x1, y1 = self.selection
+            clipped = (max(0, x0), max(0, y0), min(self.editor_width, x1), min(self.editor_height, y1))
+            if clipped != self.selection:
+                if clipped[2] <= clipped[0] or clipped[3] <= clipped[1]:
+                    self.selection = None
+                else:
+                    self.selection_mask = self.selection_mask[clipped[1] - y0:clipped[3] - y0,
+                                                              clipped[0] - x0:clipped[2] - x0]
+                    self.selection = clipped
+                self.draw_selection()
+    
+    def wand_select(self, x, y):
+        """Select the contiguous area with the same color as (x, y)"""
+        mask = flood_mask(self.pixel_data, x, y)
+        x0, y0, x1, y1 = mask_bounds(mask)
+        self.set_selection((x0, y0, x1, y1), mask[y0:y1, x0:x1])
+    
+    def start_selection_drag(self, x, y):
+        """Start moving the selection, or start a new rectangle outside it"""
+        if self.selection is not None:
+            x0, y0, x1, y1 = self.selection
+            if x0 <= x < x1 and y0 <= y < y1:
+                self.drag_start = ("move", x, y, x0, y0)
+                return
+        self.set_selection((x, y, x + 1, y + 1))
+        self.drag_start = ("rect", x, y)
+    
+    def drag_selection(self, x, y):
+        if self.drag_start[0] == "move":
+            _, start_x, start_y, x0, y0 = self.drag_start
+            self.move_selection(x0 + x - start_x, y0 + y - start_y)
+        else:
+            _, start_x, start_y = self.drag_start
+            x = max(0, min(self.editor_width - 1, x))
+            y = max(0, min(self.editor_height - 1, y))
+            rect = (min(x, start_x), min(y, start_y), max(x, start_x) + 1, max(y, start_y) + 1)
+            if rect != self.selection:
+                self.selection = rect
+                self.selection_mask = np.ones((rect[3] - rect[1], rect[2] - rect[0]), dtype=bool)
+                self.draw_selection()
+    
+    def lift_selection(self):
+        """Make the selection floating so it can be moved and transformed
+        
+        The layer as it would be without the selected pixels is kept as the
+        base that each move restores from.
+        """
+        if self.floating is not None:
+            return self.floating[0]
+        x0, y0, x1, y1 = self.selection
+        pixels = self.pixel_data[y0:y1, x0:x1].copy()
+        base = self.pixel_data.copy()
+        base[y0:y1, x0:x1][self.selection_mask] = self.background_color()
+        self.floating = (pixels, base)
+        return pixels
+    
+    def place_floating(self, pixels, mask, x, y):
+        """Put the floating pixels at (x, y), redrawing only the old and new areas"""
+        old = self.selection
+        height, width = mask.shape
+        new = (x, y, x + width, y + height)
+        base = self.floating[1]
+        
+        # Restore what was under the old position, then stamp at the new one
+        x0, y0 = max(0, min(old[0], new[0])), max(0, min(old[1], new[1]))
+        x1 = min(self.editor_width, max(old[2], new[2]))
+        y1 = min(self.editor_height, max(old[3], new[3]))
+        self.pixel_data[y0:y1, x0:x1] = base[y0:y1, x0:x1]
+        stamp(self.pixel_data, pixels, mask, x, y)
+        
+        self.floating = (pixels, base)
+        self.selection = new
+        self.selection_mask = mask
+        self.refresh_cells(x0, y0, x1, y1)
+        self.draw_selection()
+        self.update_preview()
+    
+    def move_selection(self, x, y):
+        if self.selection is None or (x, y) == self.selection[:2]:
+            return
+        pixels = self.lift_selection()
+        self.place_floating(pixels, self.selection_mask, x, y)
+    
+    def nudge_selection(self, dx, dy):
+        if self.selection is not None:
+            self.move_selection(self.selection[0] + dx, self.selection[1] + dy)
+    
+    def flip_selection(self, axis):
+        """Mirror the selection; axis 1 flips left-right, axis 0 top-bottom"""
+        if self.selection is None:
+            return
+        pixels = np.flip(self.lift_selection(), axis)
+        self.place_floating(pixels, np.flip(self.selection_mask, axis), *self.selection[:2])
+    
+    def rotate_selection(self):
+        """Rotate the selection 90 degrees clockwise about its top-left corner"""
+        if self.selection is None:
+            return
+        pixels = np.rot90(self.lift_selection(), -1)
+        self.place_floating(pixels, np.rot90(self.selection_mask, -1), *self.selection[:2])
+    
+    def scale_selection(self):
+        """Resize the selection with nearest-neighbour sampling"""
+        if self.selection is None:
+            messagebox.showinfo("Info", "Select an area first.")
+            return
+        x0, y0, x1, y1 = self.selection
+        size = simpledialog.askstring("Scale Selection", "New size (width x height):",
+                                      initialvalue=f"{x1 - x0}x{y1 - y0}", parent=self.root)
+        if not size:
+            return
+        try:
+            width, height = (int(value) for value in size.lower().split("x"))
+            if width <= 0 or height <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Enter the size as width x height, e.g. 32x16")
+            return
+        
+        pixels = scale_nearest(self.lift_selection(), width, height)
+        self.place_floating(pixels, scale_nearest(self.selection_mask, width, height), x0, y0)
+    
+    def copy_selection(self):
+        if self.selection is None:
+            return
+        if self.floating is not None:
+            pixels = self.floating[0]
+        else:
+            x0, y0, x1, y1 = self.selection
+            pixels = self.pixel_data[y0:y1, x0:x1]
+        self.clipboard = (pixels.copy(), self.selection_mask.copy())
+    
+    def cut_selection(self):
+        self.copy_selection()
+        self.delete_selection()
+    
+    def delete_selection(self):
+        """Erase the selected pixels to the layer background"""
+        if self.selection is None:
+            return
+        self.lift_selection()
+        base = self.floating[1]
+        x0, y0, x1, y1 = self.selection
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(self.editor_width, x1), min(self.editor_height, y1)
+        self.pixel_data[y0:y1, x0:x1] = base[y0:y1, x0:x1]
+        self.deselect()
+        self.refresh_cells(x0, y0, x1, y1)
+        self.update_preview()
+    
+    def paste(self):
+        """Paste the clipboard as a floating selection at the selection's corner"""
+        if self.clipboard is None:
+            return
+        pixels, mask = self.clipboard
+        x, y = self.selection[:2] if self.selection is not None else (0, 0)
+        self.commit_selection()
+        
+        # Start from an empty selection at the paste point, so nothing is lifted
+        self.floating = (pixels, self.pixel_data.copy())
+        self.selection = (x, y, x, y)
+        self.place_floating(pixels.copy(), mask.copy(), x, y)
+    
+    def rgb565_picker(self):
+        """Pick any of the 65,536 RGB565 colors from a red/green plane and a blue slider"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("RGB565 Color Picker")
+        dialog.transient(self.root)
+        
+        scale = 4
+        r, g, b = hex_to_rgb(self.current_color)
+        blue_var = tk.IntVar(value=(b * 31) // 255)
+        picked = {"value": (r * 31 // 255) << 11 | (g * 63 // 255) << 5 | blue_var.get(), "photo": None}
+        
+        plane_canvas = tk.Canvas(dialog, width=64 * scale, height=32 * scale, highlightthickness=0)
+        plane_canvas.pack(padx=10, pady=(10, 5))
+        
+        ttk.Label(dialog, text="Blue (0-31):").pack(anchor=tk.W, padx=10)
+        tk.Scale(dialog, from_=0, to=31, orient=tk.HORIZONTAL, variable=blue_var,
+                 command=lambda value: draw_plane()).pack(fill=tk.X, padx=10)
+        
+        swatch = tk.Canvas(dialog, width=64, height=24, highlightthickness=1)
+        swatch.pack(pady=5)
+        info_var = tk.StringVar()
+        ttk.Label(dialog, textvariable=info_var).pack()
+        
+        def show_picked():
+            value = picked["value"]
+            red, green, blue = (int(v) for v in rgb565_to_rgb888(np.array(value)))
+            color = f"#{red:02x}{green:02x}{blue:02x}"
+            swatch.config(bg=color)
+            info_var.set(f"{color}  RGB({red},{green},{blue})  VGA: 0x{value:04X}")
+            
+            # Mark the picked red/green cell on the plane
+            plane_canvas.delete("marker")
+            x = ((value >> 5) & 0x3F) * scale
+            y = (value >> 11) * scale
+            plane_canvas.create_rectangle(x - 1, y - 1, x + scale, y + scale, outline="white", tags="marker")
+            return color
+        
+        def draw_plane():
+            picked["value"] = (picked["value"] & ~0x1F) | blue_var.get()
+            picked["photo"] = ImageTk.PhotoImage(Image.fromarray(rgb565_plane(blue_var.get(), scale)))
+            plane_canvas.delete("plane")
+            plane_canvas.create_image(0, 0, anchor=tk.NW, image=picked["photo"], tags="plane")
+            plane_canvas.tag_lower("plane")
+            show_picked()
+        
+        def on_plane_click(event):
+            column = min(63, max(0, event.x // scale))
+            row = min(31, max(0, event.y // scale))
+            picked["value"] = row << 11 | column << 5 | blue_var.get()
+            show_picked()
+        
+        plane_canvas.bind("<Button-1>", on_plane_click)
+        plane_canvas.bind("<B1-Motion>", on_plane_click)
+        draw_plane()
+        
+        def on_use():
+            self.current_color = self.snap_color(show_picked())
+            self.color_preview.config(bg=self.current_color)
+            dialog.destroy()
+        
+        def on_add():
+            color = show_picked().upper()
+            if color not in self.palette_colors:
+                self.palette_colors.append(color)
+                self.palette_changed()
+        
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(fill=tk.X, pady=10)
+        ttk.Button(button_frame, text="Use Color", command=on_use).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Add to Palette", command=on_add).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Close", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+    
+    def choose_color(self):
+        color = colorchooser.askcolor(initialcolor=self.current_color)
+        if color[1]:  # If a color was chosen (not canceled)
+            self.current_color = self.snap_color(color[1])
+            self.color_preview.config(bg=self.current_color)
+            
+            # Parse RGB values
+            hex_color = self.current_color.lstrip('#')
+            r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+            
+            # Calculate 16-bit RGB565 value
+            r5 = (r * 31) // 255
+            g6 = (g * 63) // 255
+            b5 = (b * 31) // 255
+            color16 = (r5 << 11) | (g6 << 5) | b5
+            
+            # Show color info in title
+            self.root.title(f"Pixel Editor - Color: {self.current_color} RGB({r},{g},{b}) VGA: 0x{color16:04X}")
+    
+    def snap_pixels(self, pixels):
+        """Snap an (..., 3) array to the palette while it is locked"""
+        if not self.palette_lock_var.get():
+            return pixels
+        flat = np.asarray(pixels).reshape(-1, 3)
+        snapped = self.palette_lut.snap(flat)
+        
+        # The transparency key is not a real color, so it is left alone
+        key = self.transparent_key()
+        if key is not None:
+            keep = (flat == key).all(axis=-1)
+            snapped[keep] = flat[keep]
+        return snapped.reshape(np.shape(pixels))
+    
+    def snap_rgb(self, r, g, b):
+        r, g, b = self.snap_pixels(np.array([r, g, b], dtype=np.uint8))
+        return int(r), int(g), int(b)
+    
+    def snap_color(self, color):
+        """Snap a #RRGGBB color to the palette while it is locked"""
+        if not self.palette_lock_var.get():
+            return color
+        r, g, b = self.snap_rgb(*hex_to_rgb(color))
+        return f"#{r:02x}{g:02x}{b:02x}"
+    
+    def load_palette_lut(self):
+        """Match the palette's lookup table while it is locked, so snapping is a plain lookup"""
+        if self.palette_lock_var.get():
+            self.palette_lut.load(palette_array(self.palette_colors))
+    
+    def palette_changed(self):
+        self.load_palette_lut()
+        self.draw_palette()
+    
+    def toggle_palette_lock(self):
+        """Restrict painting, picking and imports to the palette colors"""
+        if not self.palette_lock_var.get():
+            return
+        self.current_color = self.snap_color(self.current_color)
+        self.color_preview.config(bg=self.current_color)
+        
+        if messagebox.askyesno("Lock to Palette", "Snap the current layer to the palette as well?"):
+            self.pixel_data[...] = self.snap_pixels(self.pixel_data)
+            self.layer_stack.invalidate()
+            self.draw_editor()
+            self.update_preview()
+
+    def add_reduce_options(self, parent, reduce_var):
+        """Add the color reduction controls to an import dialog; returns (colors, quantizer) variables"""
+        ttk.Checkbutton(parent, text="Reduce colors", variable=reduce_var).pack(anchor=tk.W)
+        reduce_frame = ttk.Frame(parent)
+        reduce_frame.pack(anchor=tk.W)
+
+        colors_var = tk.StringVar(value=str(self.reduce_count.get()))
+        ttk.Spinbox(reduce_frame, from_=2, to=256, textvariable=colors_var, width=5).pack(side=tk.LEFT, padx=(0, 5))
+        quantizer_var = tk.StringVar(value=self.quantizer.get())
+        ttk.Combobox(reduce_frame, textvariable=quantizer_var, values=QUANTIZERS,
+                     state="readonly", width=11).pack(side=tk.LEFT)
+        return colors_var, quantizer_var
+
+    def reduce_image_colors(self):
+        """Reduce the active layer to a smaller set of colors"""
+        if self.pixel_data is None:
+            messagebox.showinfo("Info", "No image data available.")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Reduce Colors")
+        dialog.geometry("260x170")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        option_frame = ttk.Frame(dialog, padding=10)
+        option_frame.pack(fill=tk.X)
+
+        ttk.Label(option_frame, text="Colors (2-256):").grid(row=0, column=0, padx=5, sticky=tk.W)
+        colors_var = tk.StringVar(value=str(self.reduce_count.get()))
+        ttk.Spinbox(option_frame, from_=2, to=256, textvariable=colors_var, width=5).grid(row=0, column=1, padx=5)
+
+        ttk.Label(option_frame, text="Method:").grid(row=1, column=0, padx=5, sticky=tk.W)
+        quantizer_var = tk.StringVar(value=self.quantizer.get())
+        ttk.Combobox(option_frame, textvariable=quantizer_var, values=QUANTIZERS,
+                     state="readonly", width=11).grid(row=1, column=1, padx=5)
+
+        replace_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text="Use result as the palette",
+                        variable=replace_var).grid(row=2, column=0, columnspan=2, sticky=tk.W)
+
+        def on_ok():
+            try:
+                colors = int(colors_var.get())
+            except ValueError:
+                messagebox.showerror("Error", "Colors must be an integer")
+                return
+            colors = min(256, max(2, colors))
+            self.reduce_count.set(colors)
+            self.quantizer.set(quantizer_var.get())
+
+            # Pixels showing the layer's key or the transparency key stay see-through
+            keys = [key for key in (self.layer_stack.layers[self.layer_stack.active].key, self.transparent_key())
+                    if key is not None]
+            mask = None
+            for key in keys:
+                keep = (self.pixel_data != np.array(key, dtype=np.uint8)).any(axis=-1)
+                mask = keep if mask is None else mask & keep
+            palette, indices = reduce_colors(self.pixel_data, colors, quantizer_var.get(), mask)
+            reduced = palette[indices]
+            if mask is None:
+                self.pixel_data[...] = reduced
+            else:
+                self.pixel_data[mask] = reduced[mask]
+            self.layer_stack.invalidate()
+
+            if replace_var.get():
+                self.palette_colors = [f"#{r:02X}{g:02X}{b:02X}" for r, g, b in palette]
+                self.palette_changed()
+
+            self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
+            self.draw_editor()
+            self.update_preview()
+            dialog.destroy()
+
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(pady=10, fill=tk.X)
+        ttk.Button(button_frame, text="OK", command=on_ok).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+
+    def color_usage(self):
+        """Show how many pixels each color of the image covers, most used first"""
+        if self.pixel_data is None:
+            messagebox.showinfo("Info", "No image data available.")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Color Usage")
+        dialog.geometry("360x420")
+        dialog.transient(self.root)
+
+        status_var = tk.StringVar(value="")
+        ttk.Label(dialog, textvariable=status_var, padding=5).pack(fill=tk.X)
+
+        list_frame = ttk.Frame(dialog)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        canvas = tk.Canvas(list_frame, bg="white", highlightthickness=0)
+        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=canvas.yview)
+        canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        row_height = 18
+        max_rows = 256  # Drawing every one of up to 65,536 colors would stall Tk
+        usage = {"colors": []}
+
+        def refresh():
+            canvas.delete("all")
+            # Exact 24-bit colors, so the swatches and picks match the pixels
+            values, counts = np.unique(rgb888_codes(self.composite()).ravel(), return_counts=True)
+            key565 = self.transparent_key565()
+            hidden = 0
+            if key565 is not None:
+                # Whatever packs to the key is transparent once exported
+                keep = rgb888_to_rgb565(code_colors(values)) != key565
+                hidden = int(counts[~keep].sum())
+                values, counts = values[keep], counts[keep]
+            order = np.argsort(-counts, kind="stable")[:max_rows]
+            total = max(1, int(counts.sum()))
+            colors = code_colors(values[order])
+            usage["colors"] = [f"#{r:02X}{g:02X}{b:02X}" for r, g, b in colors]
+
+            peak = int(counts[order[0]]) if len(order) else 1
+            for row, (color, count) in enumerate(zip(usage["colors"], counts[order])):
+                y = row * row_height
+                canvas.create_rectangle(4, y + 2, 18, y + row_height - 2, fill=color, outline="#808080")
+                canvas.create_text(24, y + row_height // 2, text=color, anchor=tk.W, font=("Courier", 9))
+                canvas.create_rectangle(90, y + 4, 90 + int(150 * count / peak), y + row_height - 4,
+                                        fill="#4A90D9", outline="")
+                canvas.create_text(330, y + row_height // 2, text=f"{count} ({100.0 * count / total:.1f}%)",
+                                   anchor=tk.E, font=("Courier", 9))
+            canvas.configure(scrollregion=(0, 0, 330, len(order) * row_height))
+
+            status = f"{len(values)} colors"
+            if len(values) > max_rows:
+                status += f", top {max_rows} shown"
+            if hidden:
+                status += f"; {hidden} transparent pixels not counted"
+            status_var.set(status)
+
+        def on_click(event):
+            row = int(canvas.canvasy(event.y)) // row_height
+            if 0 <= row < len(usage["colors"]):
+                self.current_color = self.snap_color(usage["colors"][row])
+                self.color_preview.config(bg=self.current_color)
+
+        canvas.bind("<Button-1>", on_click)
+        refresh()
+
+        button_frame = ttk.Frame(dialog, padding=10)
+        button_frame.pack(fill=tk.X)
+        ttk.Button(button_frame, text="Close", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Refresh", command=refresh).pack(side=tk.RIGHT, padx=5)
+
+    def transparent_key(self):
+        """Return the transparency key as an RGB tuple, or None"""
+        if self.transparent_color is None:
+            return None
+        return hex_to_rgb(self.transparent_color)
+    
+    def transparent_key565(self):
+        """Return the transparency key as an RGB565 value, or None"""
+        key = self.transparent_key()
+        if key is None:
+            return None
+        return int(rgb888_to_rgb565(np.array(key, dtype=np.uint8)))
+    
+    def set_transparent_color(self):
+        """Use the current color as the transparency key"""
+        self.transparent_color = self.current_color
+        self.root.title(f"Pixel Editor - Transparent color: {self.transparent_color} "
+                        f"VGA: 0x{self.transparent_key565():04X}")
+    
+    def clear_transparent_color(self):
+        """Remove the transparency key so every pixel is opaque"""
+        self.transparent_color = None
+        self.root.title("Pixel Editor - No transparent color")
+    
+    def set_alpha_threshold(self):
+        """Ask for the alpha level below which imported pixels become transparent"""
+        value = simpledialog.askinteger("Alpha Threshold", "Alpha values below this become transparent (0-255):",
+                                        initialvalue=self.alpha_threshold, minvalue=0, maxvalue=255,
+                                        parent=self.root)
+        if value is not None:
+            self.alpha_threshold = value
+    
+    def start_trace_recording(self):
+        """Start recording input events for later replay"""
+        from input_trace import TraceRecorder
+        
+        if self.trace_recorder is not None:
+            messagebox.showinfo("Info", "A trace is already being recorded.")
+            return
+        self.trace_recorder = TraceRecorder(self)
+        self.trace_recorder.start()
+        self.root.title("Pixel Editor - Recording input trace")
+    
+    def stop_trace_recording(self):
+        """Stop recording and save the trace file"""
+        if self.trace_recorder is None:
+            messagebox.showinfo("Info", "No trace is being recorded.")
+            return
+        recorder = self.trace_recorder
+        recorder.stop()
+        self.trace_recorder = None
+        self.root.title("Pixel Editor")
+        
+        file_path = filedialog.asksaveasfilename(
+            title="Save Input Trace",
+            defaultextension=".jsonl",
+            filetypes=(
+                ("Input traces", "*.jsonl"),
+                ("All files", "*.*")
+            )
+        )
         
-        # Show color info in title
-        self.root.title(f"Pixel Editor - Color: {picked_color} RGB({r},{g},{b}) VGA: 0x{color16:04X}")
+        if file_path:
+            try:
+                recorder.save(file_path)
+                messagebox.showinfo("Success", f"{len(recorder.events)} events saved to {file_path}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save trace: {str(e)}")
     
-    def choose_color(self):
-        color = colorchooser.askcolor(initialcolor=self.current_color)
-        if color[1]:  # If a color was chosen (not canceled)
-            self.current_color = color[1]
-            self.color_preview.config(bg=self.current_color)
-            
-            # Parse RGB values
-            hex_color = self.current_color.lstrip('#')
-            r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-            
-            # Calculate 16-bit RGB565 value
-            r5 = (r * 31) // 255
-            g6 = (g * 63) // 255
-            b5 = (b * 31) // 255
-            color16 = (r5 << 11) | (g6 << 5) | b5
-            
-            # Show color info in title
-            self.root.title(f"Pixel Editor - Color: {self.current_color} RGB({r},{g},{b}) VGA: 0x{color16:04X}")
+    def toggle_profiling(self):
+        """Turn hot-path instrumentation and its overlay on or off"""
+        if self.profiling_var.get():
+            PROFILER.start()
+            self.hud_label = tk.Label(self.canvas_frame, font=("Courier", 9), justify=tk.LEFT,
+                                      bg="#FFFFE0", relief=tk.SOLID, borderwidth=1)
+            self.hud_label.place(relx=1.0, x=-5, y=5, anchor=tk.NE)
+            self.hud_tick = time.perf_counter()
+            self.hud_after = self.root.after(self.hud_interval, self.update_hud)
+        else:
+            PROFILER.stop()
+            if self.hud_after is not None:
+                self.root.after_cancel(self.hud_after)
+                self.hud_after = None
+            if self.hud_label is not None:
+                self.hud_label.destroy()
+                self.hud_label = None
+    
+    def update_hud(self):
+        """Refresh the profiling overlay with the costs since the last refresh"""
+        now = time.perf_counter()
+        elapsed = now - self.hud_tick
+        self.hud_tick = now
+        
+        # Time the event loop was held up beyond the refresh interval
+        lag = max(0.0, elapsed - self.hud_interval / 1000)
+        items = len(self.canvas.find_all())
+        PROFILER.counter("canvas_items", items)
+        PROFILER.counter("event_loop_lag_ms", lag * 1000)
+        
+        frame = PROFILER.take_frame()
+        busy = sum(total for name, (count, total, last, peak) in frame.items())
+        lines = [f"{'stage':18s} {'n':>4s} {'ms':>8s} {'last':>7s} {'KiB':>7s}"]
+        for name, (count, total, last, peak) in sorted(frame.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name[:18]:18s} {count:4d} {total * 1000:8.1f} {last * 1000:7.1f} {peak / 1024:7.0f}")
+        lines.append(f"canvas items {items}  loop lag {lag * 1000:.0f} ms")
+        lines.append(f"instrumented {busy * 1000:.0f} of {elapsed * 1000:.0f} ms")
+        self.hud_label.config(text="\n".join(lines))
+        
+        self.hud_after = self.root.after(self.hud_interval, self.update_hud)
+    
+    def dump_profile_trace(self):
+        """Save the recorded spans as a Chrome trace-format JSON file"""
+        if not PROFILER.events:
+            messagebox.showinfo("Info", "No profile data recorded. Turn on View > Profiling HUD first.")
+            return
+        
+        file_path = filedialog.asksaveasfilename(
+            title="Save Profile Trace",
+            defaultextension=".json",
+            filetypes=(
+                ("Chrome trace files", "*.json"),
+                ("All files", "*.*")
+            )
+        )
+        
+        if file_path:
+            try:
+                PROFILER.dump(file_path)
+                messagebox.showinfo("Success", f"Profile trace saved to {file_path}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save trace: {str(e)}")
     
     def clear_all(self):
         # Ask for confirmation
         if messagebox.askyesno("Clear All", "Are you sure you want to clear the entire image?"):
-            # Reset pixel data to white
-            self.pixel_data = np.ones((self.editor_height, self.editor_width, 3), dtype=np.uint8) * 255
+            # Reset the active layer to white, or to its key so it becomes see-through
+            self.pixel_data[...] = self.background_color()
+            self.layer_stack.invalidate()
+            self.selection = None
+            self.floating = None
             
             # Update the edited image
             self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
@@ -623,6 +2953,9 @@ class PixelEditorApp:
             self.editor_width = new_width
             self.editor_height = new_height
             self.pixel_data = new_pixel_data
+            if self.layer_stack.active == 0:
+                self.frames[self.current_frame] = self.pixel_data
+            self.conform_layers()
             
             # Update the edited image
             self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
@@ -647,15 +2980,13 @@ class PixelEditorApp:
         
         if file_path:
             try:
-                # Open the image with PIL
-                self.reference_image = Image.open(file_path)
-                
-                # Display the reference image
-                self.display_reference()
+                # Open the image with PIL and display it
+                self.set_reference(Image.open(file_path))
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to open reference image: {str(e)}")
     
+    @profiled("handler")
     def on_reference_click(self, event):
         """Handle clicks on the reference image for color picking"""
         if self.reference_image is None:
@@ -704,6 +3035,7 @@ class PixelEditorApp:
                     r = max(0, min(255, int(r)))
                     g = max(0, min(255, int(g)))
                     b = max(0, min(255, int(b)))
+                    r, g, b = self.snap_rgb(r, g, b)
                     
                     # Format as hex color
                     picked_color = f"#{r:02x}{g:02x}{b:02x}"
@@ -740,6 +3072,15 @@ class PixelEditorApp:
         except Exception as e:
             print(f"Error in reference click handler: {e}")
     
+    def set_reference(self, image):
+        """Show a new reference image, dropping the onion skin made from the old one"""
+        self.reference_image = image
+        self.onion_underlay = None
+        self.onion_blend = None
+        self.display_reference()
+        if self.onion_var.get():
+            self.draw_editor()
+    
     def display_reference(self):
         """Display the reference image in the reference canvas"""
         if self.reference_image:
@@ -778,106 +3119,673 @@ class PixelEditorApp:
                 text="Click on image to pick colors - shows VGA and RGB values",
                 fill="black", font=("Arial", 10)
             )
+            
+            if self.onion_var.get():
+                self.draw_editor()
+    
+    def clear_reference(self):
+        """Clear the reference image"""
+        self.reference_image = None
+        self.reference_canvas.delete("all")
+        self.onion_underlay = None
+        self.onion_blend = None
+        if self.onion_var.get():
+            self.draw_editor()
+    
+    def import_to_editor(self):
+        """Import the reference image into the pixel editor"""
+        if not self.reference_image:
+            messagebox.showinfo("Info", "No reference image loaded.")
+            return
+        
+        # Ask user for dimensions
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Import Options")
+        dialog.geometry("300x430")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        ttk.Label(dialog, text="Import Dimensions:").pack(pady=(10, 5))
+        
+        # Dimension frame
+        dim_frame = ttk.Frame(dialog)
+        dim_frame.pack(pady=5)
+        
+        # Get reference image size
+        ref_width, ref_height = self.reference_image.size
+        
+        # Limit to max size
+        target_width = min(ref_width, self.max_width)
+        target_height = min(ref_height, self.max_height)
+        
+        # Width entry
+        ttk.Label(dim_frame, text="Width:").grid(row=0, column=0, padx=5)
+        width_var = tk.StringVar(value=str(target_width))
+        ttk.Entry(dim_frame, textvariable=width_var, width=5).grid(row=0, column=1, padx=5)
+        
+        # Height entry
+        ttk.Label(dim_frame, text="Height:").grid(row=1, column=0, padx=5)
+        height_var = tk.StringVar(value=str(target_height))
+        ttk.Entry(dim_frame, textvariable=height_var, width=5).grid(row=1, column=1, padx=5)
+        
+        # Options
+        option_frame = ttk.Frame(dialog)
+        option_frame.pack(pady=5)
+        
+        ttk.Label(option_frame, text="Downscaler:").pack(anchor=tk.W)
+        method_var = tk.StringVar(value=self.downscale_method.get())
+        ttk.Combobox(option_frame, textvariable=method_var, values=DOWNSCALERS,
+                     state="readonly", width=16).pack(anchor=tk.W)
+        
+        dither_var = tk.BooleanVar(value=False)
+        colors_var, quantizer_var = self.add_reduce_options(option_frame, dither_var)
+        
+        # Live preview of the converted image
+        preview_canvas = tk.Canvas(dialog, width=256, height=192, bg="#f0f0f0")
+        preview_canvas.pack(pady=5)
+        preview = {"after": None, "photo": None}
+        
+        def render_preview():
+            preview["after"] = None
+            if not preview_canvas.winfo_exists():
+                return
+            preview_canvas.delete("all")
+            try:
+                width = min(self.max_width, max(1, int(width_var.get())))
+                height = min(self.max_height, max(1, int(height_var.get())))
+            except ValueError:
+                return
+            try:
+                colors = min(256, max(2, int(colors_var.get())))
+            except ValueError:
+                colors = self.reduce_count.get()
+            pixels = convert_frame(self.reference_image, width, height, dither_var.get(),
+                                   self.transparent_key(), self.alpha_threshold, method_var.get(),
+                                   colors, quantizer_var.get())
+            pixels = self.snap_pixels(pixels)
+            
+            # Enlarge with hard pixel edges so the filter's effect is visible
+            scale = min(256 / width, 192 / height)
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            preview["photo"] = ImageTk.PhotoImage(Image.fromarray(pixels).resize(size, Image.NEAREST))
+            preview_canvas.create_image(128, 96, image=preview["photo"], anchor=tk.CENTER)
+        
+        def schedule_preview(*args):
+            # Typing in the size entries fires on every key; only render once input settles
+            if preview["after"] is not None:
+                dialog.after_cancel(preview["after"])
+            preview["after"] = dialog.after(150, render_preview)
+        
+        for var in (width_var, height_var, method_var, dither_var, colors_var, quantizer_var):
+            var.trace_add("write", schedule_preview)
+        schedule_preview()
+        
+        # Buttons
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(pady=10, fill=tk.X)
+        
+        def on_import():
+            try:
+                width = int(width_var.get())
+                height = int(height_var.get())
+                dither = dither_var.get()
+                colors = int(colors_var.get())
+                
+                # Ensure dimensions are within limits
+                width = min(self.max_width, max(1, width))
+                height = min(self.max_height, max(1, height))
+                
+                # Import the image
+                self.downscale_method.set(method_var.get())
+                self.reduce_count.set(min(256, max(2, colors)))
+                self.quantizer.set(quantizer_var.get())
+                self.do_import(width, height, dither)
+                dialog.destroy()
+            except ValueError:
+                messagebox.showerror("Error", "Width, height and colors must be integers")
+        
+        ttk.Button(button_frame, text="Import", command=on_import).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+    
+    @profiled("stage")
+    def do_import(self, width, height, dither=False):
+        """Perform the actual import"""
+        # Resize the reference image to the specified dimensions
+        pixel_data = self.large_converter().convert_frame(
+            self.reference_image, width, height, dither, self.transparent_key(), self.alpha_threshold,
+            self.downscale_method.get(), self.reduce_count.get(), self.quantizer.get())
+        pixel_data = self.snap_pixels(pixel_data)
+        
+        # Update the editor dimensions
+        self.editor_width = width
+        self.editor_height = height
+        self.width_var.set(str(width))
+        self.height_var.set(str(height))
+        
+        # Update the pixel data; an import into the background replaces the frames
+        self.pixel_data = pixel_data
+        if self.layer_stack.active == 0:
+            self.frames = [self.pixel_data]
+            self.current_frame = 0
+        self.conform_layers()
+        
+        # Create a new edited image
+        self.edited_image = Image.fromarray(self.pixel_data)
+        
+        # Reset canvas and redraw
+        self.setup_canvas()
+        self.draw_editor()
+        self.update_preview()
+    
+    def import_animation(self, file_path=None):
+        """Stream an animation or sprite sheet into the editor or a C file"""
+        if not file_path:
+            file_path = filedialog.askopenfilename(
+                title="Import Animation / Sprite Sheet",
+                filetypes=(
+                    ("Image files", "*.gif;*.png;*.apng;*.webp;*.bmp"),
+                    ("All files", "*.*")
+                )
+            )
+        if not file_path:
+            return
+        
+        try:
+            img = Image.open(file_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open image: {str(e)}")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Import Animation")
+        dialog.geometry("320x300")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        ttk.Label(dialog, text=f"{os.path.basename(file_path)} - {getattr(img, 'n_frames', 1)} frame(s)").pack(pady=(10, 5))
+        
+        # Frame dimensions
+        dim_frame = ttk.Frame(dialog)
+        dim_frame.pack(pady=5)
+        
+        ttk.Label(dim_frame, text="Frame Width:").grid(row=0, column=0, padx=5, sticky=tk.W)
+        width_var = tk.StringVar(value=str(min(img.width, self.max_width)))
+        ttk.Entry(dim_frame, textvariable=width_var, width=5).grid(row=0, column=1, padx=5)
+        
+        ttk.Label(dim_frame, text="Frame Height:").grid(row=1, column=0, padx=5, sticky=tk.W)
+        height_var = tk.StringVar(value=str(min(img.height, self.max_height)))
+        ttk.Entry(dim_frame, textvariable=height_var, width=5).grid(row=1, column=1, padx=5)
+        
+        # Sprite sheet grid
+        sheet_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(dim_frame, text="Sprite sheet grid", variable=sheet_var).grid(row=2, column=0, columnspan=2, sticky=tk.W)
+        
+        ttk.Label(dim_frame, text="Columns:").grid(row=3, column=0, padx=5, sticky=tk.W)
+        cols_var = tk.StringVar(value="1")
+        ttk.Entry(dim_frame, textvariable=cols_var, width=5).grid(row=3, column=1, padx=5)
+        
+        ttk.Label(dim_frame, text="Rows:").grid(row=4, column=0, padx=5, sticky=tk.W)
+        rows_var = tk.StringVar(value="1")
+        ttk.Entry(dim_frame, textvariable=rows_var, width=5).grid(row=4, column=1, padx=5)
+        
+        # Options
+        option_frame = ttk.Frame(dialog)
+        option_frame.pack(pady=5)
+        
+        dither_var = tk.BooleanVar(value=False)
+        colors_var, quantizer_var = self.add_reduce_options(option_frame, dither_var)
+        
+        target_var = tk.StringVar(value="editor")
+        ttk.Radiobutton(option_frame, text="Import into editor frames", variable=target_var, value="editor").pack(anchor=tk.W)
+        ttk.Radiobutton(option_frame, text="Export straight to C file", variable=target_var, value="file").pack(anchor=tk.W)
+        
+        # Buttons
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(pady=10, fill=tk.X)
+        
+        def on_import():
+            try:
+                width = min(self.max_width, max(1, int(width_var.get())))
+                height = min(self.max_height, max(1, int(height_var.get())))
+                grid = None
+                if sheet_var.get():
+                    grid = (max(1, int(cols_var.get())), max(1, int(rows_var.get())))
+                self.reduce_count.set(min(256, max(2, int(colors_var.get()))))
+            except ValueError:
+                messagebox.showerror("Error", "Dimensions, grid size and colors must be integers")
+                return
+            self.quantizer.set(quantizer_var.get())
+            
+            frames = iter_import_frames(img, width, height, dither_var.get(), grid,
+                                        self.transparent_key(), self.alpha_threshold, self.downscale_method.get(),
+                                        self.reduce_count.get(), self.quantizer.get())
+            dialog.destroy()
+            
+            if target_var.get() == "file":
+                self.export_frames(frames, width, height)
+            else:
+                self.load_frames(frames, width, height)
+        
+        ttk.Button(button_frame, text="Import", command=on_import).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+    
+    def load_frames(self, frames, width, height):
+        """Fill the editor's frame list from a stream of converted frames"""
+        try:
+            loaded = [self.snap_pixels(frame) for frame in frames]
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to import frames: {str(e)}")
+            return
+        
+        if not loaded:
+            messagebox.showinfo("Info", "The image has no frames to import.")
+            return
+        
+        # Update the editor dimensions
+        self.editor_width = width
+        self.editor_height = height
+        self.width_var.set(str(width))
+        self.height_var.set(str(height))
+        
+        self.layer_stack.reset()
+        self.refresh_layer_list()
+        self.frames = loaded
+        self.current_frame = -1
+        self.setup_canvas()
+        self.show_frame(0)
+    
+    def export_frames(self, frames, width, height):
+        """Write a stream of converted frames to a C file without keeping them"""
+        file_path = filedialog.asksaveasfilename(
+            title="Save Animation C Array",
+            defaultextension=".h",
+            filetypes=(
+                ("Header files", "*.h"),
+                ("C files", "*.c"),
+                ("All files", "*.*")
+            )
+        )
+        
+        if file_path:
+            var_name = self.var_name.get().strip() or "pixel_data"
+            try:
+                with open(file_path, 'w') as f:
+                    count = write_frames_c_array(f, frames, var_name, width, height)
+                messagebox.showinfo("Success", f"{count} frames saved to {file_path}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save file: {str(e)}")
+    
+    @profiled("stage")
+    def show_frame(self, index):
+        """Switch the editor to another animation frame"""
+        if not self.frames:
+            return
+        index = index % len(self.frames)
+        if index == self.current_frame:
+            return
+        
+        # Frames live in the background layer
+        if self.layer_stack.active != 0:
+            self.set_active_layer(0, redraw=False)
+        
+        # Keep any edits to the frame we are leaving
+        if 0 <= self.current_frame < len(self.frames):
+            self.frames[self.current_frame] = self.pixel_data
+        
+        self.current_frame = index
+        self.pixel_data = self.frames[index]
+        
+        # Frames may have been resized independently
+        height, width = self.pixel_data.shape[:2]
+        if (width, height) != (self.editor_width, self.editor_height):
+            self.editor_width = width
+            self.editor_height = height
+            self.width_var.set(str(width))
+            self.height_var.set(str(height))
+            self.setup_canvas()
+            self.conform_layers()
+        
+        self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
+        self.draw_editor()
+        self.update_preview()
+        
+        self.root.title(f"Pixel Editor - Frame {index + 1}/{len(self.frames)}")
+    
+    def composite(self):
+        """Return the visible layers flattened, from the cache where possible"""
+        return self.layer_stack.composite(self.pixel_data)
+    
+    def layer_pixels(self, index):
+        return self.layer_stack.layer_pixels(index, self.pixel_data)
+    
+    def conform_layers(self):
+        """Crop or pad the inactive layers after the active one changed size"""
+        stack = self.layer_stack
+        for index, layer in enumerate(stack.layers):
+            if index != stack.active and layer.pixels.shape != self.pixel_data.shape:
+                stack.conform(layer, self.pixel_data.shape)
+        if stack.active != 0:
+            self.frames[self.current_frame] = stack.layers[0].pixels
+        stack.invalidate()
+    
+    def set_active_layer(self, index, redraw=True):
+        """Move editing to another layer"""
+        stack = self.layer_stack
+        if index != stack.active:
+            stack.layers[stack.active].pixels = self.pixel_data
+            stack.active = index
+            pixels = stack.layers[index].pixels
+            stack.layers[index].pixels = None
+            self.pixel_data = pixels
+        self.refresh_layer_list()
+        if redraw:
+            self.draw_editor()
+            self.update_preview()
+    
+    def refresh_layer_list(self):
+        """Show the layers top-first in the layer panel"""
+        if not hasattr(self, 'layer_list'):
+            return
+        stack = self.layer_stack
+        self.layer_list.delete(0, tk.END)
+        for layer in reversed(stack.layers):
+            label = layer.name
+            if layer.opacity < 1.0:
+                label += f" ({int(round(layer.opacity * 100))}%)"
+            if not layer.visible:
+                label += " [hidden]"
+            self.layer_list.insert(tk.END, label)
+        row = len(stack.layers) - 1 - stack.active
+        self.layer_list.selection_set(row)
+        self.layer_list.see(row)
+        
+        active = stack.layers[stack.active]
+        self.layer_visible_var.set(active.visible)
+        self.layer_opacity_var.set(int(round(active.opacity * 100)))
+    
+    def on_layer_select(self, event):
+        selection = self.layer_list.curselection()
+        if selection:
+            self.set_active_layer(len(self.layer_stack.layers) - 1 - selection[0])
+    
+    def add_layer(self):
+        """Add a transparent layer above the active one"""
+        stack = self.layer_stack
+        key = self.transparent_key() or (255, 0, 255)
+        pixels = np.empty_like(self.pixel_data)
+        pixels[...] = key
+        stack.layers.insert(stack.active + 1, Layer(f"Layer {len(stack.layers)}", pixels, key=key))
+        stack.invalidate()
+        self.set_active_layer(stack.active + 1)
+    
+    def delete_layer(self):
+        stack = self.layer_stack
+        if stack.active == 0:
+            messagebox.showinfo("Info", "The background layer holds the image frames and cannot be deleted.")
+            return
+        if not messagebox.askyesno("Delete Layer", f"Delete layer '{stack.layers[stack.active].name}'?"):
+            return
+        index = stack.active
+        stack.active = index - 1
+        self.pixel_data = stack.layers[index - 1].pixels
+        stack.layers[index - 1].pixels = None
+        del stack.layers[index]
+        self.set_active_layer(index - 1)
+    
+    def move_layer(self, offset):
+        """Move the active layer up or down the stack, keeping the background at the bottom"""
+        stack = self.layer_stack
+        index = stack.active
+        target = index + offset
+        if index == 0 or not 1 <= target < len(stack.layers):
+            return
+        stack.layers[index], stack.layers[target] = stack.layers[target], stack.layers[index]
+        stack.active = target
+        stack.invalidate()
+        self.set_active_layer(target)
+    
+    def toggle_layer_visible(self):
+        self.layer_stack.layers[self.layer_stack.active].visible = self.layer_visible_var.get()
+        self.layer_stack.invalidate()
+        self.set_active_layer(self.layer_stack.active)
+    
+    def set_layer_opacity(self, value):
+        layer = self.layer_stack.layers[self.layer_stack.active]
+        opacity = int(float(value)) / 100.0
+        if opacity != layer.opacity:
+            layer.opacity = opacity
+            self.layer_stack.invalidate()
+            self.set_active_layer(self.layer_stack.active)
+    
+    def set_layer_key(self):
+        """Make the current color see-through on the active layer"""
+        self.layer_stack.layers[self.layer_stack.active].key = hex_to_rgb(self.current_color)
+        self.layer_stack.invalidate()
+        self.set_active_layer(self.layer_stack.active)
+    
+    def clear_layer_key(self):
+        self.layer_stack.layers[self.layer_stack.active].key = None
+        self.layer_stack.invalidate()
+        self.set_active_layer(self.layer_stack.active)
+    
+    def project_chunks(self):
+        """Snapshot the document as project chunks
+        
+        Called on the Tk thread; the returned bytes are copies, so writing
+        them can safely happen on another thread.
+        """
+        frames = list(self.frames) or [self.pixel_data]
+        frames[min(self.current_frame, len(frames) - 1)] = self.layer_pixels(0)
+        stack = self.layer_stack
+        
+        meta = {
+            "frames": [[int(frame.shape[1]), int(frame.shape[0])] for frame in frames],
+            "current_frame": self.current_frame,
+            "band_rows": project_format.BAND_ROWS,
+            "current_color": self.current_color,
+            "transparent_color": self.transparent_color,
+            "alpha_threshold": self.alpha_threshold,
+            "palette_lock": self.palette_lock_var.get(),
+            "export": self.export_settings(self.var_name.get().strip() or "pixel_data"),
+            "layers": [{"name": layer.name, "visible": layer.visible, "opacity": layer.opacity,
+                        "key": list(layer.key) if layer.key is not None else None,
+                        "size": [int(self.layer_pixels(index).shape[1]), int(self.layer_pixels(index).shape[0])]}
+                       for index, layer in enumerate(stack.layers)],
+            "active_layer": stack.active,
+        }
+        del meta["export"]["key565"]
+        
+        chunks = {
+            "meta": json.dumps(meta).encode("utf-8"),
+            "palette": json.dumps(self.palette_colors).encode("utf-8"),
+            "saves": json.dumps(self.project_saves).encode("utf-8"),
+        }
+        for index, frame in enumerate(frames):
+            chunks.update(project_format.frame_chunks(index, np.asarray(frame, dtype=np.uint8)))
+        # The background layer is the frames; the layers above it are shared by every frame
+        for index in range(1, len(stack.layers)):
+            chunks.update(project_format.frame_chunks(index, np.asarray(self.layer_pixels(index), dtype=np.uint8),
+                                                      prefix="layers"))
+        return chunks
     
-    def clear_reference(self):
-        """Clear the reference image"""
-        self.reference_image = None
-        self.reference_canvas.delete("all")
+    def write_project(self, chunks):
+        """Write chunks to the current project file, returning the changed names"""
+        with self.project_lock:
+            return self.project.write(chunks)
     
-    def import_to_editor(self):
-        """Import the reference image into the pixel editor"""
-        if not self.reference_image:
-            messagebox.showinfo("Info", "No reference image loaded.")
+    def save_project(self):
+        """Save the document to its project file, writing only changed chunks"""
+        if self.project is None:
+            self.save_project_as()
             return
         
-        # Ask user for dimensions
-        dialog = tk.Toplevel(self.root)
-        dialog.title("Import Options")
-        dialog.geometry("300x150")
-        dialog.transient(self.root)
-        dialog.grab_set()
-        
-        ttk.Label(dialog, text="Import Dimensions:").pack(pady=(10, 5))
-        
-        # Dimension frame
-        dim_frame = ttk.Frame(dialog)
-        dim_frame.pack(pady=5)
-        
-        # Get reference image size
-        ref_width, ref_height = self.reference_image.size
+        self.project_saves.append({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "kind": "save"})
+        try:
+            changed = self.write_project(self.project_chunks())
+            self.root.title(f"Pixel Editor - {os.path.basename(self.project.path)} saved "
+                            f"({len(changed)} chunk(s) written)")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save project: {str(e)}")
+    
+    def save_project_as(self):
+        file_path = filedialog.asksaveasfilename(
+            title="Save Project",
+            defaultextension=".pxproj",
+            filetypes=(
+                ("Pixel Editor projects", "*.pxproj"),
+                ("All files", "*.*")
+            )
+        )
         
-        # Limit to max size
-        target_width = min(ref_width, self.max_width)
-        target_height = min(ref_height, self.max_height)
+        if file_path:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                self.project = project_format.ProjectFile(file_path)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to create project: {str(e)}")
+                return
+            self.save_project()
+    
+    def open_project(self):
+        """Load a project file losslessly, including frames, palette and settings"""
+        file_path = filedialog.askopenfilename(
+            title="Open Project",
+            filetypes=(
+                ("Pixel Editor projects", "*.pxproj"),
+                ("All files", "*.*")
+            )
+        )
         
-        # Width entry
-        ttk.Label(dim_frame, text="Width:").grid(row=0, column=0, padx=5)
-        width_var = tk.StringVar(value=str(target_width))
-        ttk.Entry(dim_frame, textvariable=width_var, width=5).grid(row=0, column=1, padx=5)
+        if not file_path:
+            return
         
-        # Height entry
-        ttk.Label(dim_frame, text="Height:").grid(row=1, column=0, padx=5)
-        height_var = tk.StringVar(value=str(target_height))
-        ttk.Entry(dim_frame, textvariable=height_var, width=5).grid(row=1, column=1, padx=5)
+        try:
+            project = project_format.ProjectFile(file_path)
+            meta = project.read_json("meta")
+            band_rows = meta.get("band_rows", project_format.BAND_ROWS)
+            frames = [project_format.read_frame(project, index, width, height, band_rows)
+                      for index, (width, height) in enumerate(meta["frames"])]
+            layers = []
+            for index, info in enumerate(meta.get("layers", [{"name": "Background"}])):
+                layer = Layer(info["name"], visible=info.get("visible", True), opacity=info.get("opacity", 1.0),
+                              key=tuple(info["key"]) if info.get("key") is not None else None)
+                if index > 0:
+                    width, height = info["size"]
+                    layer.pixels = project_format.read_frame(project, index, width, height, band_rows,
+                                                             prefix="layers")
+                layers.append(layer)
+            palette = project.read_json("palette")
+            # Older projects kept the save log under the name "history"
+            saves_chunk = "saves" if "saves" in project.names() else "history"
+            saves = project.read_json(saves_chunk) if saves_chunk in project.names() else []
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open project: {str(e)}")
+            return
         
-        # Options
-        option_frame = ttk.Frame(dialog)
-        option_frame.pack(pady=5)
+        self.project = project
+        self.project_saves = saves
+        self.palette_colors = palette
+        self.palette_changed()
         
-        dither_var = tk.BooleanVar(value=False)
-        ttk.Checkbutton(option_frame, text="Apply dithering", variable=dither_var).pack(anchor=tk.W)
+        # Restore settings
+        self.current_color = meta["current_color"]
+        self.color_preview.config(bg=self.current_color)
+        self.transparent_color = meta["transparent_color"]
+        self.alpha_threshold = meta["alpha_threshold"]
+        self.palette_lock_var.set(meta.get("palette_lock", False))
+        export = meta["export"]
+        self.var_name.set(export["var_name"])
+        self.export_format_var.set(export["format"])
+        self.export_rotation.set(export["rotation"])
+        self.export_mirror_h.set(export["mirror_h"])
+        self.export_mirror_v.set(export["mirror_v"])
+        self.export_scan.set(export["scan"])
+        self.export_tile_width.set(export["tile_size"][0])
+        self.export_tile_height.set(export["tile_size"][1])
+        self.export_bits.set(export["bits"])
+        self.export_mip_levels.set(export.get("mip_levels", 0))
+        
+        # Restore the frames and layers and show the frame that was being edited
+        self.layer_stack.reset()
+        self.layer_stack.layers = layers
+        self.frames = frames
+        self.current_frame = -1
+        self.show_frame(min(meta["current_frame"], len(frames) - 1))
+        self.set_active_layer(meta.get("active_layer", 0))
+        self.setup_canvas()
+        self.root.title(f"Pixel Editor - {os.path.basename(file_path)}")
+    
+    def toggle_autosave(self):
+        if self.autosave_after is not None:
+            self.root.after_cancel(self.autosave_after)
+            self.autosave_after = None
+        if self.autosave_var.get():
+            if self.project is None:
+                messagebox.showinfo("Info", "Save the project once to choose where autosaves go.")
+                self.save_project_as()
+                if self.project is None:
+                    self.autosave_var.set(False)
+                    return
+            self.autosave_failures = 0
+            self.schedule_autosave()
+    
+    def schedule_autosave(self):
+        """Queue the next autosave, backing off after failures"""
+        if self.autosave_after is not None:
+            self.root.after_cancel(self.autosave_after)
+            self.autosave_after = None
+        if self.autosave_var.get():
+            delay = self.autosave_interval * 2 ** min(self.autosave_failures, 4)
+            self.autosave_after = self.root.after(delay, self.autosave)
+    
+    def autosave(self):
+        """Write changed chunks on a background thread, then reschedule"""
+        self.autosave_after = None
+        if self.project is None or self.autosave_running:
+            self.schedule_autosave()
+            return
         
-        # Buttons
-        button_frame = ttk.Frame(dialog)
-        button_frame.pack(pady=10, fill=tk.X)
+        # Snapshot on the Tk thread, compress and write on a worker
+        chunks = self.project_chunks()
+        self.autosave_running = True
+        results = queue.Queue()
         
-        def on_import():
+        def worker():
             try:
-                width = int(width_var.get())
-                height = int(height_var.get())
-                dither = dither_var.get()
-                
-                # Ensure dimensions are within limits
-                width = min(self.max_width, max(1, width))
-                height = min(self.max_height, max(1, height))
-                
-                # Import the image
-                self.do_import(width, height, dither)
-                dialog.destroy()
-            except ValueError:
-                messagebox.showerror("Error", "Width and height must be integers")
+                self.write_project(chunks)
+                results.put(None)
+            except Exception as e:
+                results.put(e)
         
-        ttk.Button(button_frame, text="Import", command=on_import).pack(side=tk.RIGHT, padx=5)
-        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+        def poll():
+            try:
+                error = results.get_nowait()
+            except queue.Empty:
+                self.root.after(100, poll)
+                return
+            self.autosave_running = False
+            self.finish_autosave(error)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(100, poll)
     
-    def do_import(self, width, height, dither=False):
-        """Perform the actual import"""
-        # Resize the reference image to the specified dimensions
-        resample_method = Image.LANCZOS
-        if dither:
-            # Use reduced quantizer for dithering
-            resized = self.reference_image.resize((width, height), resample_method).convert(
-                "P", palette=Image.ADAPTIVE, colors=16
-            ).convert("RGB")
+    def finish_autosave(self, error):
+        """Report the outcome of an autosave on the Tk thread and schedule the next one"""
+        name = os.path.basename(self.project.path) if self.project is not None else "project"
+        if error is None:
+            if self.autosave_failures:
+                self.root.title(f"Pixel Editor - {name} autosaved")
+            self.autosave_failures = 0
         else:
-            resized = self.reference_image.resize((width, height), resample_method)
-        
-        # Update the editor dimensions
-        self.editor_width = width
-        self.editor_height = height
-        self.width_var.set(str(width))
-        self.height_var.set(str(height))
-        
-        # Update the pixel data
-        self.pixel_data = np.array(resized)
-        
-        # Create a new edited image
-        self.edited_image = Image.fromarray(self.pixel_data)
-        
-        # Reset canvas and redraw
-        self.setup_canvas()
-        self.draw_editor()
-        self.update_preview()
+            self.autosave_failures += 1
+            retry = self.autosave_interval * 2 ** min(self.autosave_failures, 4) // 1000
+            self.root.title(f"Pixel Editor - {name} autosave failed, retrying in {retry} s")
+            # Say it once per run of failures rather than every retry
+            if self.autosave_failures == 1:
+                messagebox.showerror("Autosave", f"Failed to autosave {name}: {error}\n\n"
+                                                 f"Autosave will retry in {retry} seconds.")
+        self.schedule_autosave()
     
     def import_c_array(self):
         """Import a C array and convert it back to an image for editing"""
@@ -950,6 +3858,178 @@ class PixelEditorApp:
         ttk.Button(button_frame, text="Import", command=on_import).pack(side=tk.RIGHT, padx=5)
         ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
     
+    def import_binary(self):
+        """Import a bitmap from a data symbol of a compiled ELF image or object file"""
+        from elf_symbols import ElfFile
+
+        file_path = filedialog.askopenfilename(
+            title="Import from Binary",
+            filetypes=(
+                ("ELF images and objects", "*.elf;*.o;*.axf;*.out;*.so"),
+                ("All files", "*.*")
+            )
+        )
+        if not file_path:
+            return
+
+        try:
+            elf = ElfFile(file_path)
+            symbols = elf.data_symbols()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Failed to read {os.path.basename(file_path)}: {e}")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Import from {os.path.basename(file_path)}")
+        dialog.geometry("560x600")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        def close():
+            elf.close()
+            dialog.destroy()
+
+        def on_destroy(event):
+            # Also release the mapping when the dialog goes away some other way
+            if event.widget is dialog:
+                elf.close()
+
+        dialog.protocol("WM_DELETE_WINDOW", close)
+        dialog.bind("<Destroy>", on_destroy)
+
+        # Symbol list with a name filter
+        filter_frame = ttk.Frame(dialog, padding=(10, 10, 10, 0))
+        filter_frame.pack(fill=tk.X)
+        ttk.Label(filter_frame, text="Filter:").pack(side=tk.LEFT)
+        filter_var = tk.StringVar(value="")
+        ttk.Entry(filter_frame, textvariable=filter_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+
+        list_frame = ttk.Frame(dialog, padding=10)
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        # Statics from different source files can share a name; the offset tells them apart
+        columns = ("name", "section", "size", "offset")
+        tree = ttk.Treeview(list_frame, columns=columns, show="headings", height=10, selectmode="browse")
+        for column, heading, width in zip(columns, ("Symbol", "Section", "Bytes", "Offset"), (220, 100, 80, 90)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor=tk.E if column in ("size", "offset") else tk.W)
+        tree_scroll = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscrollcommand=tree_scroll.set)
+        tree_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        def refresh_list(*args):
+            tree.delete(*tree.get_children())
+            text = filter_var.get().lower()
+            for index, symbol in enumerate(symbols):
+                if text in symbol.name.lower():
+                    offset = f"0x{symbol.offset:X}" if symbol.offset is not None else ""
+                    tree.insert("", tk.END, iid=str(index), values=(symbol.name, symbol.section, symbol.size, offset))
+
+        filter_var.trace_add("write", refresh_list)
+        refresh_list()
+
+        # Decoding options
+        option_frame = ttk.Frame(dialog, padding=(10, 0))
+        option_frame.pack(fill=tk.X)
+        ttk.Label(option_frame, text="Format:").grid(row=0, column=0, padx=5, sticky=tk.W)
+        format_var = tk.StringVar(value="RGB565")
+        ttk.Combobox(option_frame, textvariable=format_var, values=tuple(RAW_FORMATS),
+                     state="readonly", width=18).grid(row=0, column=1, padx=5, sticky=tk.W)
+        ttk.Label(option_frame, text="Width:").grid(row=1, column=0, padx=5, sticky=tk.W)
+        width_var = tk.StringVar(value="32")
+        ttk.Entry(option_frame, textvariable=width_var, width=8).grid(row=1, column=1, padx=5, sticky=tk.W)
+        size_var = tk.StringVar(value="")
+        ttk.Label(option_frame, textvariable=size_var).grid(row=2, column=0, columnspan=2, padx=5, sticky=tk.W)
+
+        preview_canvas = tk.Canvas(dialog, width=256, height=160, bg="#f0f0f0")
+        preview_canvas.pack(pady=5)
+        preview = {"photo": None}
+
+        def selected_symbol():
+            selection = tree.selection()
+            return symbols[int(selection[0])] if selection else None
+
+        def decode():
+            """Decode the selected symbol, or return None and explain why in the size label"""
+            symbol = selected_symbol()
+            if symbol is None:
+                size_var.set("Select a symbol")
+                return None
+            try:
+                width = int(width_var.get())
+                return decode_raw_pixels(elf.symbol_bytes(symbol), width, format_var.get())
+            except ValueError as e:
+                size_var.set(str(e))
+                return None
+
+        def render_preview(*args):
+            preview_canvas.delete("all")
+            pixels = decode()
+            if pixels is None:
+                return
+            pixels = self.snap_pixels(pixels)
+            height, width = pixels.shape[:2]
+            size_var.set(f"{width}x{height} pixels")
+            scale = min(256 / width, 160 / height)
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            preview["photo"] = ImageTk.PhotoImage(Image.fromarray(pixels).resize(size, Image.NEAREST))
+            preview_canvas.create_image(128, 80, image=preview["photo"], anchor=tk.CENTER)
+
+        def on_select(event):
+            # Square images are common, so start from the width that makes one
+            symbol = selected_symbol()
+            if symbol is not None:
+                pixel_count = symbol.size * 8 // RAW_FORMATS[format_var.get()]
+                side = int(np.sqrt(pixel_count))
+                if side > 0 and side * side == pixel_count:
+                    width_var.set(str(side))
+            render_preview()
+
+        tree.bind("<<TreeviewSelect>>", on_select)
+        for var in (width_var, format_var):
+            var.trace_add("write", render_preview)
+
+        def on_import():
+            pixels = decode()
+            if pixels is None:
+                return
+            height, width = pixels.shape[:2]
+            if width > self.max_width or height > self.max_height:
+                messagebox.showerror("Error", f"{width}x{height} is larger than the "
+                                              f"{self.max_width}x{self.max_height} limit")
+                return
+            close()
+            self.load_pixels(self.snap_pixels(pixels))
+
+        button_frame = ttk.Frame(dialog, padding=10)
+        button_frame.pack(fill=tk.X)
+        ttk.Button(button_frame, text="Import", command=on_import).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=close).pack(side=tk.RIGHT, padx=5)
+
+    def load_pixels(self, pixel_data):
+        """Replace the document with a single frame holding pixel_data"""
+        height, width = pixel_data.shape[:2]
+        
+        # Update the editor dimensions
+        self.editor_width = width
+        self.editor_height = height
+        self.width_var.set(str(width))
+        self.height_var.set(str(height))
+        
+        # Update pixel data and image
+        self.layer_stack.reset()
+        self.refresh_layer_list()
+        self.pixel_data = pixel_data
+        self.frames = [self.pixel_data]
+        self.current_frame = 0
+        self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
+        
+        # Reset canvas and redraw
+        self.setup_canvas()
+        self.draw_editor()
+        self.update_preview()
+    
+    @profiled("stage")
     def parse_c_array(self, array_text, width, height):
         """Parse C array text and convert to image data
            Returns True if successful, False otherwise
@@ -1035,21 +4115,7 @@ class PixelEditorApp:
                     # Store in pixel data
                     pixel_data[y, x] = [r8, g8, b8]
             
-            # Update the editor dimensions
-            self.editor_width = width
-            self.editor_height = height
-            self.width_var.set(str(width))
-            self.height_var.set(str(height))
-            
-            # Update pixel data and image
-            self.pixel_data = pixel_data
-            self.edited_image = Image.fromarray(self.pixel_data.astype('uint8'))
-            
-            # Reset canvas and redraw
-            self.setup_canvas()
-            self.draw_editor()
-            self.update_preview()
-            
+            self.load_pixels(pixel_data)
             messagebox.showinfo("Success", f"Successfully imported C array as {width}x{height} image")
             return True
             
@@ -1058,10 +4124,14 @@ class PixelEditorApp:
             print(f"Exception details: {e}")
             return False
                 
+    @profiled("stage")
     def update_preview(self):
         # Create a preview of the image for the VGA display
         if not hasattr(self, 'preview_canvas') or not self.edited_image:
             return
+        
+        # Show all visible layers flattened
+        self.edited_image = Image.fromarray(self.composite())
             
         self.preview_canvas.delete("all")
         
@@ -1090,37 +4160,21 @@ class PixelEditorApp:
         
         # Generate the C array representation
         self.generate_c_array()
+        
+        # Keep a lazily formatted array listing in step with edits and resizes
+        if self.preview_map is not None:
+            self.show_array_view(self.preview_map[1], keep_position=True)
     
+    @profiled("stage")
     def generate_c_array(self):
         # Convert the image pixels to 5R-6G-5B format for VGA
         if self.edited_image is None:
             return
         
-        # Create output array for the 16-bit color values
-        output_array = np.zeros((self.editor_height, self.editor_width), dtype=np.uint16)
-        
-        # Process each pixel
-        for y in range(self.editor_height):
-            for x in range(self.editor_width):
-                r, g, b = self.pixel_data[y, x]
-                
-                # Ensure RGB values are in the correct range to avoid overflow
-                r = max(0, min(255, int(r)))
-                g = max(0, min(255, int(g)))
-                b = max(0, min(255, int(b)))
-                
-                # Convert to 5-6-5 format
-                r5 = (r * 31) // 255  # 5 bits (0-31)
-                g6 = (g * 63) // 255  # 6 bits (0-63)
-                b5 = (b * 31) // 255  # 5 bits (0-31)
-                
-                # Combine into 16-bit color
-                color16 = (r5 << 11) | (g6 << 5) | b5
-                output_array[y, x] = color16
-        
-        # Store the array data
-        self.vga_array = output_array
+        # The cached composite is reused, so export never re-blends unchanged layers
+        self.vga_array = rgb888_to_rgb565(self.composite())
     
+    @profiled("stage")
     def show_c_array(self):
         # Display the C array in the text widget
         if not hasattr(self, 'vga_array'):
@@ -1132,43 +4186,293 @@ class PixelEditorApp:
         if not var_name:
             var_name = "pixel_data"
         
-        # Create header
-        c_code = f"// VGA Image Data - {self.editor_width}x{self.editor_height} - 16-bit color (5R-6G-5B)\n"
-        c_code += f"// Generated by Pixel Editor\n\n"
-        c_code += f"#define IMAGE_WIDTH {self.editor_width}\n"
-        c_code += f"#define IMAGE_HEIGHT {self.editor_height}\n\n"
-        c_code += f"const unsigned short {var_name}[IMAGE_HEIGHT][IMAGE_WIDTH] = {{\n"
+        settings = self.export_settings(var_name)
+        self.preview_map = None
         
-        # Add array data
-        for y in range(self.editor_height):
-            c_code += "    {"
-            for x in range(self.editor_width):
-                c_code += f"0x{self.vga_array[y, x]:04X}"
-                if x < self.editor_width - 1:
-                    c_code += ", "
-            c_code += "}"
-            if y < self.editor_height - 1:
-                c_code += ",\n"
-            else:
-                c_code += "\n"
+        if settings["format"] == "Array" and settings["scan"] != "tile":
+            self.show_array_view(settings)
+        else:
+            try:
+                lines = "".join(self.iter_c_source(var_name)).splitlines()
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            self.array_preview.set_source(len(lines), lines.__getitem__)
+    
+    def show_array_view(self, settings, keep_position=False):
+        """Show a row- or column-major RGB565 array, formatting rows only as they scroll into view"""
+        rotation, mirror_h, mirror_v = settings["rotation"], settings["mirror_h"], settings["mirror_v"]
+        view = orient_array(self.vga_array, rotation, mirror_h, mirror_v)
+        header = (c_array_header(view.shape[1], view.shape[0], settings["key565"],
+                                 describe_orientation(rotation, mirror_h, mirror_v, settings["scan"]))
+                  + c_array_declaration(settings["var_name"], settings["scan"])).splitlines()
+        if settings["scan"] == "column":
+            view = view.T
+        footer = ["};", ""]
+        
+        def get_line(index):
+            if index < len(header):
+                return header[index]
+            row = index - len(header)
+            if row < len(view):
+                return format_c_row(view[row], row == len(view) - 1).rstrip("\n")
+            return footer[row - len(view)]
+        
+        # Element positions follow from the orientation, so only the settings are kept
+        height, width = self.vga_array.shape
+        self.preview_map = (len(header), settings, width, height)
+        line_count = len(header) + len(view) + len(footer)
+        if keep_position:
+            self.array_preview.update_source(line_count, get_line)
+        else:
+            self.array_preview.set_source(line_count, get_line)
+    
+    def preview_position(self, x, y):
+        """Return the (row, element) of pixel (x, y) in the shown C array"""
+        _, settings, width, height = self.preview_map
+        row, column = oriented_position(x, y, width, height, settings["rotation"],
+                                        settings["mirror_h"], settings["mirror_v"])
+        return (column, row) if settings["scan"] == "column" else (row, column)
+    
+    def select_preview_element(self, x, y):
+        """Scroll the C array preview to the element for pixel (x, y)"""
+        if self.preview_map is None:
+            return
+        header_lines, _, width, height = self.preview_map
+        if not (0 <= x < width and 0 <= y < height):
+            return
+        row, column = self.preview_position(x, y)
+        start = 5 + column * 8  # Elements are "0xXXXX" after "    {", with ", " between
+        self.array_preview.highlight(header_lines + row, start, start + 6)
+    
+    def on_array_text_click(self, event):
+        """Highlight the pixel for the C array element that was clicked"""
+        if self.preview_map is None:
+            return
+        header_lines, settings, width, height = self.preview_map
+        line, column = self.array_preview.position_at(event.x, event.y)
+        row = line - header_lines
+        element, offset = divmod(column - 5, 8)
+        
+        # Column-major listings hold the oriented view transposed
+        view_row, view_column = (element, row) if settings["scan"] == "column" else (row, element)
+        rows, columns = (height, width) if settings["rotation"] % 180 == 0 else (width, height)
+        if not (0 <= view_row < rows and 0 <= view_column < columns and column >= 5 and offset < 6):
+            return
         
-        c_code += "};\n\n"
+        x, y = source_position(view_row, view_column, width, height, settings["rotation"],
+                               settings["mirror_h"], settings["mirror_v"])
+        if x >= self.editor_width or y >= self.editor_height:
+            return
+        
+        self.array_preview.highlight(line, 5 + element * 8, 11 + element * 8)
+        
+        # Outline the matching cell in the editor
+        cell_size = int(self.cell_size * self.editor_zoom)
+        self.canvas.delete("highlight")
+        self.canvas.create_rectangle(x * cell_size, y * cell_size, (x + 1) * cell_size, (y + 1) * cell_size,
+                                     outline="#FF0000", width=2, tags="highlight")
+        
+    def export_settings(self, var_name):
+        """Collect the export options into a plain dict usable off the Tk thread"""
+        return {
+            "var_name": var_name,
+            "format": self.export_format_var.get(),
+            "rotation": self.export_rotation.get(),
+            "mirror_h": self.export_mirror_h.get(),
+            "mirror_v": self.export_mirror_v.get(),
+            "scan": self.export_scan.get(),
+            "tile_size": (self.export_tile_width.get(), self.export_tile_height.get()),
+            "bits": self.export_bits.get(),
+            "mip_levels": self.export_mip_levels.get(),
+            "key565": self.transparent_key565(),
+        }
+    
+    def iter_c_source(self, var_name):
+        """Yield the C source for the current image in the selected export format"""
+        return iter_export_source(self.composite(), self.export_settings(var_name))
+    
+    def export_options(self):
+        """Show a dialog for the export orientation and scan order"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Export Options")
+        dialog.geometry("300x430")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        # Orientation
+        orient_frame = ttk.LabelFrame(dialog, text="Orientation", padding=5)
+        orient_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Label(orient_frame, text="Rotation (clockwise):").grid(row=0, column=0, padx=5, sticky=tk.W)
+        rotation_var = tk.StringVar(value=str(self.export_rotation.get()))
+        ttk.Combobox(orient_frame, textvariable=rotation_var, values=("0", "90", "180", "270"),
+                     state="readonly", width=5).grid(row=0, column=1, padx=5)
+        
+        mirror_h_var = tk.BooleanVar(value=self.export_mirror_h.get())
+        ttk.Checkbutton(orient_frame, text="Mirror horizontally", variable=mirror_h_var).grid(row=1, column=0, columnspan=2, sticky=tk.W)
+        mirror_v_var = tk.BooleanVar(value=self.export_mirror_v.get())
+        ttk.Checkbutton(orient_frame, text="Mirror vertically", variable=mirror_v_var).grid(row=2, column=0, columnspan=2, sticky=tk.W)
+        
+        # Scan order
+        scan_frame = ttk.LabelFrame(dialog, text="Scan Order", padding=5)
+        scan_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        scan_var = tk.StringVar(value=self.export_scan.get())
+        ttk.Radiobutton(scan_frame, text="Row-major", variable=scan_var, value="row").grid(row=0, column=0, columnspan=4, sticky=tk.W)
+        ttk.Radiobutton(scan_frame, text="Column-major", variable=scan_var, value="column").grid(row=1, column=0, columnspan=4, sticky=tk.W)
+        ttk.Radiobutton(scan_frame, text="Tiles", variable=scan_var, value="tile").grid(row=2, column=0, columnspan=4, sticky=tk.W)
+        
+        ttk.Label(scan_frame, text="Tile:").grid(row=3, column=0, padx=5, sticky=tk.W)
+        tile_width_var = tk.StringVar(value=str(self.export_tile_width.get()))
+        ttk.Entry(scan_frame, textvariable=tile_width_var, width=4).grid(row=3, column=1)
+        ttk.Label(scan_frame, text="x").grid(row=3, column=2)
+        tile_height_var = tk.StringVar(value=str(self.export_tile_height.get()))
+        ttk.Entry(scan_frame, textvariable=tile_height_var, width=4).grid(row=3, column=3)
+        
+        # Indexed formats
+        indexed_frame = ttk.LabelFrame(dialog, text="Indexed Formats", padding=5)
+        indexed_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Label(indexed_frame, text="Bits per pixel:").grid(row=0, column=0, padx=5, sticky=tk.W)
+        bits_var = tk.StringVar(value=str(self.export_bits.get()))
+        ttk.Combobox(indexed_frame, textvariable=bits_var, values=("1", "2", "4", "8"),
+                     state="readonly", width=5).grid(row=0, column=1, padx=5)
+        
+        # Mipmap chain
+        mipmap_frame = ttk.LabelFrame(dialog, text="Mipmap Chain", padding=5)
+        mipmap_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Label(mipmap_frame, text="Levels (0 = down to 1x1):").grid(row=0, column=0, padx=5, sticky=tk.W)
+        mip_levels_var = tk.StringVar(value=str(self.export_mip_levels.get()))
+        ttk.Entry(mipmap_frame, textvariable=mip_levels_var, width=5).grid(row=0, column=1, padx=5)
+        
+        # Buttons
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(pady=10, fill=tk.X)
+        
+        def on_ok():
+            try:
+                tile_width = max(1, int(tile_width_var.get()))
+                tile_height = max(1, int(tile_height_var.get()))
+                mip_levels = max(0, int(mip_levels_var.get()))
+            except ValueError:
+                messagebox.showerror("Error", "Tile size and mipmap levels must be integers")
+                return
+            
+            self.export_rotation.set(int(rotation_var.get()))
+            self.export_mirror_h.set(mirror_h_var.get())
+            self.export_mirror_v.set(mirror_v_var.get())
+            self.export_scan.set(scan_var.get())
+            self.export_tile_width.set(tile_width)
+            self.export_tile_height.set(tile_height)
+            self.export_bits.set(int(bits_var.get()))
+            self.export_mip_levels.set(mip_levels)
+            dialog.destroy()
+        
+        ttk.Button(button_frame, text="OK", command=on_ok).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+    
+    def budget_report(self):
+        """Compare the flash cost of every export encoding for the current image"""
+        if self.pixel_data is None:
+            messagebox.showinfo("Info", "No image data available.")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Memory Budget Report")
+        dialog.geometry("480x360")
+        dialog.transient(self.root)
+        
+        # Constraints
+        limit_frame = ttk.Frame(dialog, padding=10)
+        limit_frame.pack(fill=tk.X)
+        
+        ttk.Label(limit_frame, text="Byte budget:").grid(row=0, column=0, padx=5, sticky=tk.W)
+        budget_var = tk.StringVar(value="")
+        ttk.Entry(limit_frame, textvariable=budget_var, width=10).grid(row=0, column=1, padx=5)
+        
+        ttk.Label(limit_frame, text="Max RMS error:").grid(row=1, column=0, padx=5, sticky=tk.W)
+        error_var = tk.StringVar(value="")
+        ttk.Entry(limit_frame, textvariable=error_var, width=10).grid(row=1, column=1, padx=5)
+        
+        # Results table
+        columns = ("encoding", "bytes", "ratio", "error")
+        tree = ttk.Treeview(dialog, columns=columns, show="headings", height=9)
+        for column, heading, width in zip(columns, ("Encoding", "Bytes", "% of RGB565", "RMS Error"), (160, 90, 90, 90)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor=tk.W if column == "encoding" else tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10)
+        
+        status_var = tk.StringVar(value="")
+        ttk.Label(dialog, textvariable=status_var).pack(fill=tk.X, padx=10, pady=5)
+        
+        # Measure with the current export orientation, which affects row padding and runs
+        try:
+            pixels = scan_view(self.composite(), self.export_rotation.get(), self.export_mirror_h.get(),
+                               self.export_mirror_v.get(),
+                               "row" if self.export_scan.get() == "tile" else self.export_scan.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            dialog.destroy()
+            return
+        results = evaluate_encodings(pixels, self.transparent_key565())
+        raw_size = self.editor_width * self.editor_height * 2
+        
+        def label(result):
+            if result["format"] == "Indexed":
+                return f"Indexed {result['bits']}bpp"
+            return result["format"]
         
+        for i, result in enumerate(results):
+            tree.insert("", tk.END, iid=str(i), values=(
+                label(result), result["bytes"], f"{100.0 * result['bytes'] / raw_size:.1f}%", f"{result['error']:.2f}"))
         
+        def on_optimize():
+            try:
+                budget = int(budget_var.get()) if budget_var.get().strip() else None
+                max_error = float(error_var.get()) if error_var.get().strip() else None
+            except ValueError:
+                messagebox.showerror("Error", "Budget must be an integer and error a number")
+                return
+            
+            best = choose_encoding(results, budget, max_error)
+            if best is None:
+                status_var.set("No encoding meets the constraints")
+                tree.selection_set(())
+                return
+            index = results.index(best)
+            tree.selection_set(str(index))
+            tree.see(str(index))
+            status_var.set(f"Cheapest: {label(best)} - {best['bytes']} bytes")
+        
+        def on_apply():
+            selection = tree.selection()
+            if not selection:
+                return
+            result = results[int(selection[0])]
+            self.export_format_var.set(result["format"])
+            if result["format"] == "Indexed":
+                self.export_bits.set(result["bits"])
+            # Only Array can be written in tiles; the others were measured row by row
+            if result["format"] != "Array" and self.export_scan.get() == "tile":
+                self.export_scan.set("row")
+            dialog.destroy()
         
-        # Display in the text widget
-        self.array_text.delete(1.0, tk.END)
-        self.array_text.insert(tk.END, c_code)
+        # Buttons
+        button_frame = ttk.Frame(dialog, padding=10)
+        button_frame.pack(fill=tk.X)
         
+        ttk.Button(button_frame, text="Use Selected", command=on_apply).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Optimize", command=on_optimize).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Close", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+    
     def save_c_array(self):
         # Save the C array to a file
         if not hasattr(self, 'vga_array'):
             messagebox.showinfo("Info", "No image data available.")
             return
         
-        # First make sure the C array is generated
-        self.show_c_array()
-        
         # Ask for file path
         file_path = filedialog.asksaveasfilename(
             title="Save C Array",
@@ -1181,21 +4485,66 @@ class PixelEditorApp:
         )
         
         if file_path:
+            var_name = self.var_name.get().strip() or "pixel_data"
+            self.start_background_export(file_path, self.composite().copy(), self.export_settings(var_name))
+    
+    def start_background_export(self, file_path, pixels, settings):
+        """Generate and write the C source on a worker thread with a progress dialog
+        
+        The worker only sees a snapshot of the pixel data and a plain settings
+        dict, and reports back through a queue polled from the Tk thread.
+        """
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Exporting")
+        dialog.geometry("320x110")
+        dialog.transient(self.root)
+        
+        ttk.Label(dialog, text=f"Saving {os.path.basename(file_path)}...").pack(pady=(10, 5))
+        progress_bar = ttk.Progressbar(dialog, orient=tk.HORIZONTAL, length=280, mode="determinate", maximum=100)
+        progress_bar.pack(padx=10, pady=5)
+        
+        cancel_event = threading.Event()
+        messages = queue.Queue()
+        converter = self.large_converter()
+        
+        def report(done, total):
+            messages.put(("progress", 100.0 * done / max(1, total)))
+        
+        def worker():
             try:
-                with open(file_path, 'w') as f:
-                    f.write(self.array_text.get(1.0, tk.END))
-                messagebox.showinfo("Success", f"C array saved to {file_path}")
+                chunks = converter.iter_export_source(pixels, settings, report)
+                if write_source_atomically(file_path, chunks, cancel_event):
+                    messages.put(("done", file_path))
+                else:
+                    messages.put(("cancelled", file_path))
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to save file: {str(e)}")
+                messages.put(("error", str(e)))
+        
+        def poll():
+            try:
+                while True:
+                    kind, value = messages.get_nowait()
+                    if kind == "progress":
+                        progress_bar["value"] = value
+                        continue
+                    
+                    dialog.destroy()
+                    if kind == "done":
+                        messagebox.showinfo("Success", f"C array saved to {value}")
+                    elif kind == "error":
+                        messagebox.showerror("Error", f"Failed to save file: {value}")
+                    return
+            except queue.Empty:
+                pass
+            self.root.after(50, poll)
+        
+        ttk.Button(dialog, text="Cancel", command=cancel_event.set).pack(pady=5)
+        dialog.protocol("WM_DELETE_WINDOW", cancel_event.set)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(50, poll)
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = PixelEditorApp(root)
-    
-    # Update palette on window resize
-    def on_window_resize(event):
-        app.draw_palette()
-    
-    root.bind("<Configure>", on_window_resize)
-    
     root.mainloop()
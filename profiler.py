@@ -0,0 +1,117 @@
+"""Optional hot-path instrumentation for the pixel editor
+
+Functions decorated with @profiled are timed only while PROFILER is
+enabled; when it is off the wrapper costs one attribute check per call.
+Recorded spans can be dumped in Chrome trace format (chrome://tracing or
+https://ui.perfetto.dev) with PROFILER.dump(path).
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+
+class Profiler:
+    """Collect timed spans, counters and allocation sizes"""
+
+    def __init__(self, max_events=200000):
+        self.enabled = False
+        self.track_allocations = True
+        self.events = deque(maxlen=max_events)
+        self.frame = {}
+        self.origin = time.perf_counter()
+        self.depth = 0
+        self.started_tracemalloc = False
+
+    def start(self):
+        self.events.clear()
+        self.frame = {}
+        self.origin = time.perf_counter()
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def call(self, name, category, func, args, kwargs):
+        """Run func, recording its duration and peak allocation"""
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if self.depth == 0:
+                tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            self.depth -= 1
+            # Peak traced memory above the level the call started at
+            alloc = max(0, tracemalloc.get_traced_memory()[1] - before) if tracing else 0
+            self.record(name, category, start, end, alloc)
+
+    def record(self, name, category, start, end, alloc=0):
+        duration = end - start
+        self.events.append(("X", name, category, start - self.origin, duration, alloc, threading.get_ident()))
+
+        count, total, last, peak = self.frame.get(name, (0, 0.0, 0.0, 0))
+        self.frame[name] = (count + 1, total + duration, duration, max(peak, alloc))
+
+    def counter(self, name, value):
+        self.events.append(("C", name, "counter", time.perf_counter() - self.origin, 0.0, value,
+                            threading.get_ident()))
+
+    def take_frame(self):
+        """Return and reset the per-name stats gathered since the last call
+
+        Each value is (calls, total seconds, last call seconds, peak bytes).
+        """
+        frame, self.frame = self.frame, {}
+        return frame
+
+    def chrome_trace(self):
+        """Return the recorded events as a Chrome trace-format dict"""
+        pid = os.getpid()
+        trace_events = []
+        for phase, name, category, ts, duration, value, tid in list(self.events):
+            if phase == "X":
+                trace_events.append({
+                    "name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                    "ts": ts * 1e6, "dur": duration * 1e6, "args": {"alloc_bytes": value},
+                })
+            else:
+                trace_events.append({
+                    "name": name, "ph": "C", "pid": pid, "tid": tid, "ts": ts * 1e6, "args": {name: value},
+                })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def dump(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+PROFILER = Profiler()
+
+
+def profiled(category="stage", name=None):
+    """Decorator timing a function whenever the global profiler is enabled"""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            return PROFILER.call(label, category, func, args, kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,180 @@
+"""Native compressed project container with incremental saves
+
+A project file is a sequence of zlib-compressed chunks followed by a
+compressed JSON index and a fixed-size trailer:
+
+    b"PXPJ" version | chunk data ... | index | trailer
+
+The trailer holds the index offset and length and ends with TRAILER_MAGIC.
+Saving only appends the chunks whose contents changed, then a new index and
+trailer, so an autosave of a large document after a small edit writes a few
+kilobytes. Readers use the last complete trailer in the file, which means a
+save interrupted half way leaves the previous state readable. Once dead data
+outweighs live data the file is compacted into a fresh copy.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from file_modes import replacement_mode
+
+MAGIC = b"PXPJ"
+VERSION = 1
+HEADER = struct.Struct("<4sI")
+TRAILER_MAGIC = b"PXPJEND!"
+TRAILER = struct.Struct("<QQ8s")
+
+# Rows of pixels per stored chunk; smaller bands mean finer-grained autosaves
+BAND_ROWS = 32
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def encode_planes(pixels):
+    """Store an (h, w, 3) band as separate R, G and B planes, which compress better"""
+    return np.ascontiguousarray(np.moveaxis(pixels, -1, 0)).tobytes()
+
+
+def decode_planes(data, height, width, channels=3):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(channels, height, width)
+    return np.ascontiguousarray(np.moveaxis(planes, 0, -1))
+
+
+def frame_chunks(index, pixels, band_rows=BAND_ROWS, prefix="frames"):
+    """Split a frame (or layer, with prefix="layers") into row-band chunks keyed by name"""
+    height = pixels.shape[0]
+    return {f"{prefix}/{index:04d}/{band:04d}": encode_planes(pixels[top:top + band_rows])
+            for band, top in enumerate(range(0, height, band_rows))}
+
+
+def read_frame(project, index, width, height, band_rows=BAND_ROWS, prefix="frames"):
+    """Reassemble a frame from its row-band chunks"""
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for band, top in enumerate(range(0, height, band_rows)):
+        rows = min(band_rows, height - top)
+        pixels[top:top + rows] = decode_planes(project.read(f"{prefix}/{index:04d}/{band:04d}"), rows, width)
+    return pixels
+
+
+class ProjectFile:
+    """Read and incrementally write a project container"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.file_size = 0
+        if os.path.exists(path):
+            self.read_index()
+
+    def read_index(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+                raise ValueError("Not a pixel editor project file")
+            if HEADER.unpack(header)[1] > VERSION:
+                raise ValueError(f"Project file version {HEADER.unpack(header)[1]} is newer than supported")
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Fall back to an earlier trailer if the last save was cut short
+                end = len(mm)
+                while True:
+                    position = mm.rfind(TRAILER_MAGIC, 0, end)
+                    if position < 0:
+                        raise ValueError("Project file has no valid index")
+                    start = position + len(TRAILER_MAGIC) - TRAILER.size
+                    if start >= HEADER.size:
+                        offset, length, _ = TRAILER.unpack(mm[start:start + TRAILER.size])
+                        if offset + length <= start:
+                            try:
+                                self.index = json.loads(zlib.decompress(mm[offset:offset + length]))
+                                break
+                            except (zlib.error, ValueError):
+                                pass
+                    end = position
+            self.file_size = start + TRAILER.size
+
+    def names(self):
+        return list(self.index)
+
+    def read(self, name):
+        entry = self.index[name]
+        with open(self.path, 'rb') as f:
+            f.seek(entry["offset"])
+            data = zlib.decompress(f.read(entry["length"]))
+        if chunk_digest(data) != entry["hash"]:
+            raise ValueError(f"Chunk {name} is corrupt")
+        return data
+
+    def read_json(self, name):
+        return json.loads(self.read(name))
+
+    def write(self, chunks):
+        """Save a complete set of chunks, writing only those that changed
+
+        chunks maps names to bytes; names missing from it are dropped from the
+        project. Returns the list of chunk names that were written.
+        """
+        digests = {name: chunk_digest(data) for name, data in chunks.items()}
+        changed = [name for name in chunks if self.index.get(name, {}).get("hash") != digests[name]]
+
+        live = sum(self.index[name]["length"] for name in chunks if name not in changed)
+        if not self.index or not os.path.exists(self.path) or self.file_size > 2 * live + 65536:
+            self.rewrite(chunks, digests)
+            return list(chunks)
+
+        index = {name: self.index[name] for name in chunks if name not in changed}
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.file_size)  # Drop anything a failed save left behind
+            f.seek(self.file_size)
+            for name in changed:
+                index[name] = self.append_chunk(f, chunks[name], digests[name])
+            self.file_size = self.append_index(f, index)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index = index
+        return changed
+
+    def rewrite(self, chunks, digests):
+        """Write a compact copy of the project and move it into place"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".project-", suffix=".tmp")
+        try:
+            index = {}
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+                for name, data in chunks.items():
+                    index[name] = self.append_chunk(f, data, digests[name])
+                file_size = self.append_index(f, index)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_path, replacement_mode(self.path))
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.index = index
+        self.file_size = file_size
+
+    @staticmethod
+    def append_chunk(f, data, digest):
+        compressed = zlib.compress(data, 6)
+        offset = f.tell()
+        f.write(compressed)
+        return {"offset": offset, "length": len(compressed), "size": len(data), "hash": digest}
+
+    @staticmethod
+    def append_index(f, index):
+        data = zlib.compress(json.dumps(index).encode("utf-8"))
+        offset = f.tell()
+        f.write(data)
+        f.write(TRAILER.pack(offset, len(data), TRAILER_MAGIC))
+        return f.tell()
@@ -0,0 +1,133 @@
+"""Crash-safe working pixel buffer backed by a memory-mapped scratch file
+
+Edits to the mapped array land in the OS page cache, so they survive the
+editor process dying without any explicit save. Each process has its own
+file, named after its PID, which is removed on a clean exit. A file whose
+process is no longer running was left by a session that crashed, and its
+pixels can be restored.
+"""
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+MAGIC = b"PXSCRTCH"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = 64  # Keeps the pixel data page-friendly and leaves room to grow
+
+SCRATCH_DIR = os.path.join(os.path.expanduser("~"), ".pixel_editor")
+
+
+def scratch_path(pid=None):
+    """Return the scratch file path owned by a process (this one by default)"""
+    return os.path.join(SCRATCH_DIR, f"scratch-{os.getpid() if pid is None else pid}.bin")
+
+
+def process_alive(pid):
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        try:
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        finally:
+            kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def find_leftovers(directory=SCRATCH_DIR):
+    """Return the valid scratch files whose owning process has exited, newest first"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    leftovers = []
+    for name in names:
+        if not (name.startswith("scratch-") and name.endswith(".bin")):
+            continue
+        try:
+            pid = int(name[len("scratch-"):-len(".bin")])
+        except ValueError:
+            continue
+        path = os.path.join(directory, name)
+        if pid != os.getpid() and not process_alive(pid) and read_header(path) is not None:
+            leftovers.append(path)
+    return sorted(leftovers, key=os.path.getmtime, reverse=True)
+
+
+def read_header(path):
+    """Return (width, height, channels) of a scratch file, or None if it is not valid"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+        magic, version, width, height, channels = HEADER.unpack(header)
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != VERSION:
+        return None
+    if os.path.getsize(path) < HEADER_SIZE + width * height * channels:
+        return None
+    return width, height, channels
+
+
+class ScratchBuffer:
+    """Owns the memory-mapped scratch file behind the working pixel buffer"""
+
+    def __init__(self, path=None):
+        self.path = scratch_path() if path is None else path
+        self.array = None
+
+    def restore(self, leftover):
+        """Take over a scratch file left by a crashed session and return its mapped pixels"""
+        header = read_header(leftover)
+        if header is None:
+            raise ValueError("Scratch file is corrupt")
+        width, height, channels = header
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        os.replace(leftover, self.path)
+        self.array = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=HEADER_SIZE,
+                               shape=(height, width, channels))
+        return self.array
+
+    def store(self, pixels):
+        """Copy pixels into the scratch file and return the mapped array"""
+        if self.array is not None and self.array.shape == pixels.shape:
+            self.array[...] = pixels
+            return self.array
+
+        # A new size gets a fresh file swapped into place; anything still mapping
+        # the old one keeps a valid (now unlinked) mapping instead of faulting
+        height, width, channels = pixels.shape
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".scratch-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, width, height, channels).ljust(HEADER_SIZE, b"\0"))
+                f.write(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.array = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=HEADER_SIZE, shape=pixels.shape)
+        return self.array
+
+    def discard(self):
+        """Remove the scratch file after a clean shutdown"""
+        self.array = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
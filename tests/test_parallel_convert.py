@@ -0,0 +1,49 @@
+"""The parallel converter must produce exactly what the serial path does"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import pixel_editor
+from parallel_convert import ParallelConverter
+
+
+@pytest.fixture(scope="module")
+def converter():
+    # min_pixels=0 sends even small test images through the worker bands
+    converter = ParallelConverter(2, min_pixels=0)
+    yield converter
+    converter.shutdown()
+
+
+def sample_rgba(width=97, height=61, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    pixels[..., 3] = np.where(rng.random((height, width)) < 0.3, 0, 255)
+    return pixels
+
+
+@pytest.mark.parametrize("method", pixel_editor.DOWNSCALERS)
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_convert_frame_matches_serial(converter, method, mode):
+    source = sample_rgba()
+    frame = Image.fromarray(source if mode == "RGBA" else source[..., :3].copy())
+    for dither, key in ((False, None), (True, None), (True, (255, 0, 255)), (False, (255, 0, 255))):
+        args = (frame, 40, 25, dither, key, 128, method, 24, "Median Cut")
+        np.testing.assert_array_equal(converter.convert_frame(*args), pixel_editor.convert_frame(*args))
+
+
+def test_convert_frame_keeps_few_colors_exact(converter):
+    palette = np.array([[200, 100, 50], [10, 20, 30], [7, 200, 9]], dtype=np.uint8)
+    frame = Image.fromarray(palette[np.random.default_rng(1).integers(0, 3, (64, 80))])
+    args = (frame, 80, 64, True, None, 128, "Box", 16, "K-Means")
+    np.testing.assert_array_equal(converter.convert_frame(*args), pixel_editor.convert_frame(*args))
+
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+@pytest.mark.parametrize("scan", ["row", "column"])
+def test_export_matches_serial(converter, rotation, scan):
+    pixels = sample_rgba(48, 36)[..., :3].copy()
+    settings = {"var_name": "image", "format": "Array", "rotation": rotation, "mirror_h": rotation == 90,
+                "mirror_v": False, "scan": scan, "tile_size": (8, 8), "bits": 4, "key565": 0xF81F}
+    assert ("".join(converter.iter_export_source(pixels, settings))
+            == "".join(pixel_editor.iter_export_source(pixels, settings)))
@@ -0,0 +1,139 @@
+"""Project container: round trips, incremental saves, recovery and compaction"""
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+import project_format
+from project_format import ProjectFile, chunk_digest, frame_chunks, read_frame
+
+
+def chunks(**values):
+    return {name: value.encode("utf-8") for name, value in values.items()}
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    ProjectFile(str(path)).write(chunks(meta='{"width": 3}', palette="[]"))
+
+    project = ProjectFile(str(path))
+    assert sorted(project.names()) == ["meta", "palette"]
+    assert project.read_json("meta") == {"width": 3}
+    assert project.read("palette") == b"[]"
+
+
+def test_frame_round_trip(tmp_path):
+    # A height that is not a multiple of the band size leaves a short last band
+    pixels = np.random.default_rng(0).integers(0, 256, (project_format.BAND_ROWS * 2 + 5, 7, 3), dtype=np.uint8)
+    path = tmp_path / "doc.pxproj"
+    ProjectFile(str(path)).write(frame_chunks(0, pixels))
+    np.testing.assert_array_equal(read_frame(ProjectFile(str(path)), 0, 7, len(pixels)), pixels)
+
+
+def test_incremental_write_appends_only_changed_chunks(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    big = os.urandom(50000).hex()
+    project = ProjectFile(str(path))
+    project.write(chunks(meta="1", band=big))
+    offset = project.index["band"]["offset"]
+    size = path.stat().st_size
+
+    assert project.write(chunks(meta="2", band=big)) == ["meta"]
+    assert project.index["band"]["offset"] == offset
+    assert size < path.stat().st_size < size + 1024
+
+    reopened = ProjectFile(str(path))
+    assert reopened.read("meta") == b"2"
+    assert reopened.read("band") == big.encode("utf-8")
+
+
+def test_write_drops_missing_chunks(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    project = ProjectFile(str(path))
+    project.write(chunks(meta="1", old="x" * 1000))
+    project.write(chunks(meta="1"))
+    assert ProjectFile(str(path)).names() == ["meta"]
+
+
+def test_truncated_save_falls_back_to_previous_trailer(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    project = ProjectFile(str(path))
+    project.write(chunks(meta="first", band="x" * 5000))
+    project.write(chunks(meta="second", band="x" * 5000))
+
+    # Cut the last save short, losing its trailer
+    with open(path, "r+b") as f:
+        f.truncate(path.stat().st_size - 3)
+    recovered = ProjectFile(str(path))
+    assert recovered.read("meta") == b"first"
+
+    # The next save discards the partial data and continues from the recovered state
+    recovered.write(chunks(meta="third", band="x" * 5000))
+    assert ProjectFile(str(path)).read("meta") == b"third"
+
+
+def test_garbage_after_last_trailer_is_ignored(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    ProjectFile(str(path)).write(chunks(meta="saved"))
+    with open(path, "ab") as f:
+        f.write(b"\0partial chunk data" * 10)
+    assert ProjectFile(str(path)).read("meta") == b"saved"
+
+
+def test_compaction_rewrites_when_dead_data_dominates(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    project = ProjectFile(str(path))
+    for version in range(20):
+        project.write({"meta": b"m", "band": os.urandom(20000)})
+    final = os.urandom(20000)
+    project.write({"meta": b"m", "band": final})
+
+    # Twenty superseded bands would be about 400 KB; compaction keeps the file near one band
+    assert path.stat().st_size < 3 * 20000 + 65536
+    reopened = ProjectFile(str(path))
+    assert reopened.read("band") == final
+    assert reopened.read("meta") == b"m"
+
+
+def test_corrupt_chunk_is_detected(tmp_path):
+    path = tmp_path / "doc.pxproj"
+    project = ProjectFile(str(path))
+    project.write(chunks(meta="x" * 100))
+    entry = project.index["meta"]
+    with open(path, "r+b") as f:
+        f.seek(entry["offset"])
+        f.write(zlib.compress(b"y" * 100)[:entry["length"]].ljust(entry["length"], b"\0"))
+    with pytest.raises(ValueError):
+        ProjectFile(str(path)).read("meta")
+
+
+def test_rejects_other_files_and_newer_versions(tmp_path):
+    other = tmp_path / "other.pxproj"
+    other.write_bytes(b"not a project")
+    with pytest.raises(ValueError):
+        ProjectFile(str(other))
+
+    newer = tmp_path / "newer.pxproj"
+    newer.write_bytes(project_format.HEADER.pack(project_format.MAGIC, project_format.VERSION + 1))
+    with pytest.raises(ValueError):
+        ProjectFile(str(newer))
+
+
+def test_reads_version_1_layout_written_by_hand(tmp_path):
+    # Built from the documented layout rather than by ProjectFile, so a change
+    # to the writer cannot hide a change that breaks existing files
+    data = b'{"width": 1}'
+    compressed = zlib.compress(data)
+    content = b"PXPJ" + struct.pack("<I", 1)
+    index = {"meta": {"offset": len(content), "length": len(compressed), "size": len(data),
+                      "hash": chunk_digest(data)}}
+    content += compressed
+    index_data = zlib.compress(json.dumps(index).encode("utf-8"))
+    content += index_data + struct.pack("<QQ8s", len(content), len(index_data), b"PXPJEND!")
+
+    path = tmp_path / "v1.pxproj"
+    path.write_bytes(content)
+    assert ProjectFile(str(path)).read_json("meta") == {"width": 1}